@@ -4,13 +4,12 @@ from configparser import ConfigParser
 
 import customtkinter as ctk
 
-import subtitling
 from constants import valid_video_file_types, supported_models, supported_languages, config_defaults
-from script_running import run_on_button_press
+from script_running import run_on_button_press, ModelPreloader
 
 class appUI:
 
-    def __init__(self):
+    def __init__(self, start_mainloop=True):
         self.root = ctk.CTk()
 
         self.root.title("WhisperSubs")
@@ -70,7 +69,13 @@ class appUI:
         self.confirm_frame.pack(expand=True, fill='both', padx = 20, pady = 20)
 
         self.bigframe.pack(expand=True, fill='both')
-        self.root.mainloop()
+
+        #Heavy libraries and the configured model are loaded in the background once the window has been drawn
+        self.preloader = ModelPreloader(self.config)
+        self.root.after(100, self.preloader.start)
+
+        if start_mainloop:
+            self.root.mainloop()
 
 class  LocationFrameUI(ctk.CTkFrame):
     def __init__(self, master, path, input_mode):
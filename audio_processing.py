@@ -1,8 +1,26 @@
 from pathlib import Path
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import os
+import subprocess
+
+import numpy as np
 from pydub import AudioSegment
 
-def extract_audio(video_path:Path):
-    """Extracts audio from video located at given path, and saves it as a .wav. Returns a path to that wav file."""
+from constants import whisper_sample_rate
+
+#Size in bytes of a single float32 sample as produced by ffmpeg's f32le output
+_bytes_per_sample = 4
+#Shortest range load_audio_ranges splits a file into, below which starting another ffmpeg process isn't worth it
+min_decode_range_s = 120
+#Audio decoded before each range and thrown away, so that the joins between separately decoded ranges are seamless
+decode_preroll_s = 0.5
+
+def extract_audio(video_path:Path, audio_path:Path = None):
+    """Extracts audio from video located at given path, and saves it as a .wav, by default next to the video with the same name.
+        Returns a path to that wav file."""
     # Load the video file
     try:
         video_clip = AudioSegment.from_file(video_path)
@@ -11,10 +29,277 @@ def extract_audio(video_path:Path):
 
     # Force the audio to be single channel, and sets the frame rate to 16kHz since these are expected input data for whisper model.
     video_clip = video_clip.set_channels(1)
-    video_clip = video_clip.set_frame_rate(16000)
+    video_clip = video_clip.set_frame_rate(whisper_sample_rate)
 
-    audio_path = video_path.with_suffix(".wav")
+    if audio_path is None:
+        audio_path = video_path.with_suffix(".wav")
     # Export audio to file
     video_clip.export(audio_path, format='wav')
 
     return audio_path
+
+def _ffmpeg_decode_command(video_path:Path, start_s:float = None, duration_s:float = None):
+    """Builds the ffmpeg command that decodes the audio track of video_path to mono 16kHz float32 samples on stdout,
+        optionally only duration_s seconds of it starting from start_s."""
+    #-ss before -i seeks in the input rather than decoding and discarding everything before start_s
+    seek = ["-ss", f"{start_s:.6f}"] if start_s else []
+    limit = ["-t", f"{duration_s:.6f}"] if duration_s is not None else []
+    return ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-threads", "0",
+            *seek, "-i", str(video_path), *limit,
+            "-vn", "-map", "0:a:0",
+            "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(whisper_sample_rate),
+            "-"]
+
+def _raise_decode_error(video_path:Path, stderr:bytes):
+    message = stderr.decode("utf-8", errors="replace").strip()
+    if "matches no streams" in message or "does not contain any stream" in message:
+        raise TypeError("Video file has no audio track.")
+    raise RuntimeError(f"ffmpeg failed to decode {video_path}: {message}")
+
+def load_audio(video_path:Path, ranges:int = 1):
+    """Decodes the audio of the video located at given path directly into memory, without writing a .wav.
+        Returns a float32 numpy array of mono 16kHz samples, which can be passed straight to the whisper pipeline.
+        With ranges > 1, long files are decoded in that many ranges in parallel, see load_audio_ranges."""
+    if ranges > 1:
+        return load_audio_ranges(video_path, ranges)
+    process = subprocess.run(_ffmpeg_decode_command(video_path), capture_output=True)
+    if process.returncode != 0:
+        _raise_decode_error(video_path, process.stderr)
+    if not process.stdout:
+        raise TypeError("Video file has no audio track.")
+    return np.frombuffer(process.stdout, dtype=np.float32)
+
+def split_timeline(total_samples:int, num_ranges:int):
+    """Splits total_samples samples into num_ranges consecutive (start_sample, end_sample) ranges of near equal length.
+        The end of the last range is None, so that it runs to the end of the track whatever its exact length."""
+    bounds = [round(i*total_samples/num_ranges) for i in range(num_ranges)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def decode_range(video_path:Path, start_sample:int, end_sample:int = None):
+    """Decodes samples start_sample to end_sample (or the end of the track if None) of the audio of video_path, seeking
+        to them rather than decoding everything before. Returns exactly end_sample - start_sample samples unless the
+        track ends first. Decoding starts decode_preroll_s early where possible and the preroll is dropped, so that the
+        resampler has settled by start_sample, and ranges decoded separately join up like a single decode."""
+    preroll = min(start_sample, int(decode_preroll_s*whisper_sample_rate))
+    first = start_sample - preroll
+    #A little more than needed is decoded and trimmed to the exact length, since ffmpeg rounds -t to whole frames
+    duration_s = None if end_sample is None else (end_sample - first)/whisper_sample_rate + 1
+    process = subprocess.run(_ffmpeg_decode_command(video_path, first/whisper_sample_rate, duration_s), capture_output=True)
+    if process.returncode != 0:
+        _raise_decode_error(video_path, process.stderr)
+    audio = np.frombuffer(process.stdout, dtype=np.float32)
+    return audio[preroll:] if end_sample is None else audio[preroll:end_sample - first]
+
+def iter_audio_ranges(video_path:Path, ranges, workers:int = None):
+    """Decodes the (start_sample, end_sample) ranges of video_path with up to workers ffmpeg processes at once, by default
+        one per range, and yields the decoded arrays in order, each as soon as it and those before it are ready.
+        A range that comes back short marks the end of the track, and the ranges after it are not yielded."""
+    ranges = list(ranges)
+    workers = max(1, min(workers or len(ranges), len(ranges)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        #Only workers ranges are decoded ahead of the one being yielded, so memory stays bounded however many ranges there are
+        pending = deque()
+        next_range = iter(ranges)
+        for start, end in islice(next_range, workers):
+            pending.append((start, end, executor.submit(decode_range, video_path, start, end)))
+        try:
+            while pending:
+                start, end, future = pending.popleft()
+                audio = future.result()
+                for new_start, new_end in islice(next_range, 1):
+                    pending.append((new_start, new_end, executor.submit(decode_range, video_path, new_start, new_end)))
+                if len(audio):
+                    yield audio
+                if end is not None and len(audio) < end - start:
+                    break
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+def load_audio_ranges(video_path:Path, ranges:int = 4, min_range_s:float = None):
+    """Version of load_audio that splits the timeline into up to ranges ranges of at least min_range_s seconds, decodes
+        them in parallel with one ffmpeg process each, and assembles them into one contiguous array. Files that are too
+        short to split, or whose duration can't be determined, are decoded in one go."""
+    duration_s = probe_duration(video_path)
+    if min_range_s is None:
+        min_range_s = min_decode_range_s
+    if min_range_s > 0:
+        ranges = min(ranges, int((duration_s or 0)//min_range_s))
+    ranges = min(ranges, os.cpu_count() or 1)
+    if ranges <= 1 or not duration_s:
+        return load_audio(video_path)
+
+    total = int(duration_s*whisper_sample_rate)
+    audio = np.empty(total, dtype=np.float32)
+    filled = 0
+    for piece in iter_audio_ranges(video_path, split_timeline(total, ranges)):
+        #The last range runs to the end of the track, which may be a little longer than the container says
+        if filled + len(piece) > len(audio):
+            audio = np.concatenate([audio[:filled], piece])
+        else:
+            audio[filled:filled + len(piece)] = piece
+        filled += len(piece)
+    if filled == 0:
+        raise TypeError("Video file has no audio track.")
+    return audio[:filled]
+
+def stream_audio(video_path:Path, chunk_length_s:float = 30):
+    """Generator version of load_audio. Yields consecutive float32 numpy arrays of at most chunk_length_s seconds
+        of mono 16kHz audio, so the full track never has to be held in memory at once."""
+    chunk_bytes = int(chunk_length_s*whisper_sample_rate)*_bytes_per_sample
+    process = subprocess.Popen(_ffmpeg_decode_command(video_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yielded_any = False
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            #Drop any trailing partial sample, which can only happen if ffmpeg was interrupted
+            data = data[:len(data) - len(data) % _bytes_per_sample]
+            yielded_any = True
+            yield np.frombuffer(data, dtype=np.float32)
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            _raise_decode_error(video_path, stderr)
+        if not yielded_any:
+            raise TypeError("Video file has no audio track.")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+def probe_duration(video_path:Path):
+    """Returns the duration in seconds of the video located at given path according to ffprobe, or None if it can't be determined."""
+    process = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration",
+                              "-of", "default=noprint_wrappers=1:nokey=1", str(video_path)], capture_output=True)
+    try:
+        return float(process.stdout.decode("utf-8").strip())
+    except ValueError:
+        return None
+
+def stream_windows(video_path:Path, window_s:float = 600, overlap_s:float = 10, ranges:int = 1):
+    """Decodes the audio of video_path a piece at a time, yielding (start_s, window) pairs of consecutive windows of at most
+        window_s seconds, each overlapping the previous one by overlap_s seconds. Only about one window is held in memory at once,
+        however long the input is. With ranges > 1, the pieces are decoded with seeks by up to that many ffmpeg processes at
+        once, so the first windows can be transcribed while the next ones are still decoding, holding about ranges windows."""
+    overlap = int(overlap_s*whisper_sample_rate)
+    piece = int((window_s - overlap_s)*whisper_sample_rate)
+    duration_s = probe_duration(video_path) if ranges > 1 else None
+    if duration_s:
+        bounds = list(range(0, int(duration_s*whisper_sample_rate), piece))
+        pieces = iter_audio_ranges(video_path, zip(bounds, bounds[1:] + [None]), workers=min(ranges, os.cpu_count() or 1))
+    else:
+        pieces = stream_audio(video_path, chunk_length_s=window_s - overlap_s)
+    tail = np.zeros(0, dtype=np.float32)
+    consumed = 0
+    for piece in pieces:
+        window = np.concatenate([tail, piece]) if len(tail) else piece
+        yield (consumed - len(tail))/whisper_sample_rate, window
+        consumed += len(piece)
+        tail = window[-overlap:].copy() if overlap else tail
+
+def pipeline_windows(lengths, chunk_length_s, stride_length_s=None):
+    """Returns the windows the whisper pipeline cuts inputs of the given lengths in samples into when called with
+        chunk_length_s and stride_length_s, mirroring its chunking. For each input, a list of (sequence, start_s,
+        keep_start_s, keep_end_s) tuples: the index of the window among the windows of all inputs, in the order they are
+        generated, the time it starts at, and the part of it that makes it into the merged result, outside its strides.
+        An input whose length is None, such as a .wav path, can't be split, so it and every input after it get None."""
+    if stride_length_s is None:
+        stride_length_s = chunk_length_s/6 if chunk_length_s else 0
+    chunk = int(round((chunk_length_s or 0)*whisper_sample_rate))
+    stride = int(round(stride_length_s*whisper_sample_rate))
+    result = []
+    sequence = 0
+    for length in lengths:
+        if length is None or sequence is None:
+            result.append(None)
+            sequence = None
+            continue
+        if not chunk:
+            #Without chunking, each input is a single window
+            result.append([(sequence, 0.0, 0.0, float("inf"))])
+            sequence += 1
+            continue
+        windows = []
+        for start in range(0, length, chunk - 2*stride):
+            stride_left = 0 if start == 0 else stride
+            is_last = start + chunk >= length
+            #The pipeline leaves out a final window that would lie entirely in the previous one's stride
+            if min(start + chunk, length) - start > stride_left:
+                keep_end_s = float("inf") if is_last else (start + chunk - stride)/whisper_sample_rate
+                windows.append((sequence, start/whisper_sample_rate, (start + stride_left)/whisper_sample_rate, keep_end_s))
+                sequence += 1
+            if is_last:
+                break
+        result.append(windows)
+    return result
+
+def detect_speech(audio, threshold_db=-45, noise_margin_db=10, frame_s=0.03, min_speech_s=0.25, min_silence_s=1.0, pad_s=0.5):
+    """Energy based voice activity detection on mono 16kHz audio. A frame counts as speech if its level is above both
+        threshold_db (dBFS) and the estimated noise floor plus noise_margin_db. Gaps shorter than min_silence_s are bridged,
+        regions shorter than min_speech_s are dropped, and pad_s seconds are kept either side of each region.
+        Returns a sorted list of non-overlapping (start_sample, end_sample) speech regions."""
+    frame = max(1, int(frame_s*whisper_sample_rate))
+    num_frames = len(audio)//frame
+    if num_frames == 0:
+        return []
+    frames = np.asarray(audio[:num_frames*frame], dtype=np.float64).reshape(num_frames, frame)
+    level_db = 10*np.log10(np.mean(np.square(frames), axis=1) + 1e-12)
+
+    #Estimate the noise floor from the quietest frames, so that constant background noise isn't mistaken for speech
+    noise_floor_db = np.percentile(level_db, 10)
+    is_speech = level_db > max(threshold_db, noise_floor_db + noise_margin_db)
+
+    regions = []
+    start = None
+    for i, speech in enumerate(is_speech):
+        if speech and start is None:
+            start = i
+        elif not speech and start is not None:
+            regions.append([start, i])
+            start = None
+    if start is not None:
+        regions.append([start, num_frames])
+
+    #Bridge short gaps, then drop short regions
+    merged = []
+    for region in regions:
+        if merged and (region[0] - merged[-1][1])*frame_s < min_silence_s:
+            merged[-1][1] = region[1]
+        else:
+            merged.append(region)
+    merged = [r for r in merged if (r[1] - r[0])*frame_s >= min_speech_s]
+
+    #Convert to samples and pad, joining regions whose padding overlaps
+    pad = int(pad_s*whisper_sample_rate)
+    speech_regions = []
+    for first, last in merged:
+        start_sample = max(0, first*frame - pad)
+        end_sample = min(len(audio), last*frame + pad)
+        if speech_regions and start_sample <= speech_regions[-1][1]:
+            speech_regions[-1] = (speech_regions[-1][0], end_sample)
+        else:
+            speech_regions.append((start_sample, end_sample))
+    return speech_regions
+
+def compact_speech(audio, regions):
+    """Concatenates the given speech regions of audio. Returns (compacted_audio, offsets), where offsets is a list of
+        (compacted_start_s, original_start_s, duration_s) used by to_original_time to map timestamps back."""
+    offsets = []
+    compacted_start = 0
+    for start, end in regions:
+        offsets.append((compacted_start/whisper_sample_rate, start/whisper_sample_rate, (end - start)/whisper_sample_rate))
+        compacted_start += end - start
+    if not regions:
+        return np.zeros(0, dtype=np.float32), offsets
+    return np.concatenate([audio[start:end] for start, end in regions]), offsets
+
+def to_original_time(timestamp, offsets):
+    """Maps a timestamp on the compacted timeline produced by compact_speech back onto the original timeline."""
+    if timestamp is None or not offsets:
+        return timestamp
+    i = max(0, bisect_right([offset[0] for offset in offsets], timestamp) - 1)
+    compacted_start, original_start, duration = offsets[i]
+    return original_start + min(max(timestamp - compacted_start, 0), duration)
@@ -0,0 +1,176 @@
+from configparser import ConfigParser
+import logging
+import threading
+import time
+
+import numpy as np
+import psutil
+
+from constants import whisper_sample_rate
+
+#Candidate settings tried by autotune. Whisper sees 30 seconds at a time, so shorter chunks pad out each window and
+#make the model do more work per second of audio, and chunks without stride cut words at their boundaries.
+candidate_batch_sizes = [1, 2, 4, 8, 16, 32]
+candidate_chunk_settings = [(30, 5), (25, 4), (20, 3)]
+#Fraction of the device's memory the tuned settings may use when no budget is given
+default_memory_fraction = 0.8
+#Section of the config file tuned settings are saved in, followed by the model and device
+config_section_prefix = "autotune"
+
+class _PeakMemory:
+    """Tracks the peak memory used while the enclosed block runs: allocated cuda memory on cuda, and the resident memory
+        of the process, sampled every interval_s seconds, otherwise."""
+    def __init__(self, device, interval_s=0.02):
+        self.device = str(device)
+        self.interval_s = interval_s
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, process.memory_info().rss)
+            self._stop.wait(self.interval_s)
+
+    def __enter__(self):
+        if self.device.startswith("cuda"):
+            import torch
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.device.startswith("cuda"):
+            import torch
+            torch.cuda.synchronize(self.device)
+            self.peak_bytes = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+
+def memory_budget(device, fraction=default_memory_fraction):
+    """Returns fraction of the memory available to the model on device, in bytes. On cpu this counts memory the
+        process already uses, such as the loaded model, together with the memory still available."""
+    if str(device).startswith("cuda"):
+        import torch
+        _, total = torch.cuda.mem_get_info(torch.device(device))
+        return int(total*fraction)
+    return int((psutil.virtual_memory().available + psutil.Process().memory_info().rss)*fraction)
+
+def _is_out_of_memory(e):
+    return isinstance(e, MemoryError) or "out of memory" in str(e).lower()
+
+def measure_setting(pipe, audio, device, batch_size, chunk_length_s, stride_length_s, generate_kwargs=None):
+    """Runs audio through pipe once with the given settings. Returns a dict with the settings, the throughput in seconds
+        of audio per second and the peak memory in bytes."""
+    start = time.perf_counter()
+    with _PeakMemory(device) as memory:
+        pipe(audio, batch_size=batch_size, chunk_length_s=chunk_length_s, stride_length_s=stride_length_s,
+             return_timestamps=True, generate_kwargs=generate_kwargs or {"task": "translate"})
+    seconds = time.perf_counter() - start
+    return {
+        "batch_size": batch_size,
+        "chunk_length_s": chunk_length_s,
+        "stride_length_s": stride_length_s,
+        "throughput": len(audio)/whisper_sample_rate/seconds,
+        "peak_memory": memory.peak_bytes,
+    }
+
+def autotune(pipe, audio, device, budget_bytes=None, batch_sizes=None, chunk_settings=None, generate_kwargs=None):
+    """
+    Measures throughput and peak memory of pipe on audio for every combination of batch size and (chunk_length_s,
+    stride_length_s), and returns (best, results): the settings with the highest throughput that stayed within
+    budget_bytes of memory, and the measurements of every setting tried. audio should be long enough to fill the
+    largest batch, and is repeated if it isn't. Batch sizes are tried in increasing order, and larger batches are not
+    tried for a chunk setting once it has run out of memory or exceeded the budget.
+    """
+    batch_sizes = sorted(batch_sizes or candidate_batch_sizes)
+    chunk_settings = chunk_settings or candidate_chunk_settings
+    if budget_bytes is None:
+        budget_bytes = memory_budget(device)
+
+    longest_s = max(batch_sizes)*max(chunk for chunk, _ in chunk_settings)
+    if len(audio) < longest_s*whisper_sample_rate:
+        audio = np.tile(audio, int(np.ceil(longest_s*whisper_sample_rate/max(len(audio), 1))))[:int(longest_s*whisper_sample_rate)]
+
+    #The first call pays for one-off costs such as allocator warm-up and kernel selection, so it isn't measured
+    pipe(audio[:whisper_sample_rate*30], batch_size=1, return_timestamps=True, generate_kwargs=generate_kwargs or {"task": "translate"})
+
+    #Batch sizes are the outer loop, so memory use only grows as the search goes on. On cpu the process keeps memory it
+    #has freed, so a small batch measured after a large one would look as if it used as much as the large one.
+    results = []
+    remaining = list(chunk_settings)
+    for batch_size in batch_sizes:
+        for chunk_length_s, stride_length_s in list(remaining):
+            #Just enough audio to fill the batch once, so every setting does a comparable amount of work
+            window_s = chunk_length_s - 2*stride_length_s
+            samples = int((batch_size*window_s + 2*stride_length_s)*whisper_sample_rate)
+            try:
+                result = measure_setting(pipe, audio[:samples], device, batch_size, chunk_length_s, stride_length_s, generate_kwargs)
+            except (RuntimeError, MemoryError) as e:
+                if not _is_out_of_memory(e):
+                    raise
+                logging.info("batch_size=%d, chunk_length_s=%s: out of memory", batch_size, chunk_length_s)
+                _release_memory(device)
+                remaining.remove((chunk_length_s, stride_length_s))
+                continue
+            result["within_budget"] = result["peak_memory"] <= budget_bytes
+            results.append(result)
+            logging.info("batch_size=%d, chunk_length_s=%s, stride_length_s=%s: %.1fx real time, peak memory %.2fGB",
+                         batch_size, chunk_length_s, stride_length_s, result["throughput"], result["peak_memory"]/1024**3)
+            if not result["within_budget"]:
+                remaining.remove((chunk_length_s, stride_length_s))
+        if not remaining:
+            break
+
+    feasible = [result for result in results if result["within_budget"]]
+    if not feasible:
+        raise RuntimeError(f"No setting tried stays within the memory budget of {budget_bytes/1024**3:.2f}GB")
+    return max(feasible, key=lambda result: result["throughput"]), results
+
+def _release_memory(device):
+    if str(device).startswith("cuda"):
+        import torch
+        torch.cuda.empty_cache()
+
+def config_section(model_id, device):
+    return f"{config_section_prefix} {model_id} {device}"
+
+def save_tuned(model_id, device, settings, config_path="config.ini"):
+    """Saves the settings found by autotune for (model_id, device) to the config file, keeping everything else in it."""
+    config = ConfigParser()
+    config.read(config_path)
+    section = config_section(model_id, device)
+    if not config.has_section(section):
+        config.add_section(section)
+    for key in ("batch_size", "chunk_length_s", "stride_length_s", "throughput", "peak_memory"):
+        config.set(section, key, str(settings[key]))
+    with open(config_path, 'w') as f:
+        config.write(f)
+
+def load_tuned(model_id, device, config_path="config.ini"):
+    """Returns the settings saved by save_tuned for (model_id, device), or None if it hasn't been tuned."""
+    config = ConfigParser()
+    config.read(config_path)
+    section = config_section(model_id, device)
+    if not config.has_section(section):
+        return None
+    return {
+        "batch_size": config.getint(section, "batch_size"),
+        "chunk_length_s": config.getfloat(section, "chunk_length_s"),
+        "stride_length_s": config.getfloat(section, "stride_length_s"),
+    }
+
+def apply_tuned(parameters, model_id, device, config_path="config.ini", keep=()):
+    """Sets batch_size, chunk_length_s and stride_length_s of parameters to the tuned settings for (model_id, device), if
+        there are any, except for the names in keep. Returns True if tuned settings were found."""
+    tuned = load_tuned(model_id, device, config_path)
+    if tuned is None:
+        return False
+    for key, value in tuned.items():
+        if key not in keep:
+            setattr(parameters, key, value)
+    return True
@@ -0,0 +1,88 @@
+import time
+
+from audio_processing import pipeline_windows
+
+class BatchScheduler:
+    """
+    Collects VideoSubbing objects from several files and runs the ones sharing the same (language, task)
+    through the whisper pipeline together, so that chunks from short files can fill a batch.
+    A group is run as soon as it holds enough audio to fill batch_size windows of chunk_length_s seconds,
+    and any remaining groups are run by flush(). Each result is written to the subtitle file of the file it came from.
+    """
+    def __init__(self, pipe, batch_size=8, chunk_length_s=30, stride_length_s=None, metrics=None):
+        self.pipe = pipe
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.chunk_length_s = chunk_length_s
+        self.stride_length_s = stride_length_s
+        self._pending = {}
+
+    def submit(self, subbing):
+        """Queues subbing, running its group if it is now full. Returns a list of (subbing, exception) for any files that failed."""
+        #Cached transcriptions, and audio with no speech left after voice activity detection, don't need the model
+        if subbing.cached is not None or subbing.audio_seconds() == 0:
+            return self._run_single(subbing)
+        key = subbing.batch_key()
+        group = self._pending.setdefault(key, [])
+        group.append(subbing)
+
+        queued_seconds = 0
+        for queued in group:
+            seconds = queued.audio_seconds()
+            #Audio only available as a file can't be measured without decoding it, so it is run straight away
+            if seconds is None:
+                return self.flush(key)
+            queued_seconds += seconds
+        if queued_seconds >= self.batch_size*self.chunk_length_s:
+            return self.flush(key)
+        return []
+
+    def flush(self, key=None):
+        """Runs the queued group for key, or all queued groups if key is None. Returns a list of (subbing, exception) for any files that failed."""
+        keys = list(self._pending) if key is None else [key]
+        failures = []
+        for batch_key in keys:
+            group = self._pending.pop(batch_key, [])
+            if group:
+                failures.extend(self._run_group(group))
+        return failures
+
+    def _run_group(self, group):
+        start = time.perf_counter()
+        generate_kwargs = group[0].generate_kwargs()
+        try:
+            results = self.pipe([subbing.audio_input for subbing in group], batch_size=self.batch_size,
+                        chunk_length_s=self.chunk_length_s, stride_length_s=self.stride_length_s, return_timestamps=True,
+                        generate_kwargs=generate_kwargs)
+        except Exception as e:
+            if len(group) == 1:
+                return [(group[0], e)]
+            #Run the files one at a time instead, so a single bad file doesn't fail the whole group
+            failures = []
+            for subbing in group:
+                failures.extend(self._run_single(subbing))
+            return failures
+
+        #The batch is shared between its files in proportion to their audio
+        if self.metrics is not None:
+            seconds = time.perf_counter() - start
+            total_audio = sum(subbing.audio_seconds() for subbing in group)
+            for subbing in group:
+                self.metrics.add_time(subbing.file, "whisper", seconds*subbing.audio_seconds()/total_audio)
+
+        #Windows are numbered across the whole group, in the order the pipeline generates them
+        windows = pipeline_windows([subbing.audio_length() for subbing in group], self.chunk_length_s, self.stride_length_s)
+        failures = []
+        for subbing, result, subbing_windows in zip(group, results, windows):
+            try:
+                subbing.save_subs(subbing.finish_chunks(result["chunks"], generate_kwargs, subbing_windows))
+            except Exception as e:
+                failures.append((subbing, e))
+        return failures
+
+    def _run_single(self, subbing):
+        try:
+            subbing.create_subs()
+        except Exception as e:
+            return [(subbing, e)]
+        return []
@@ -0,0 +1,124 @@
+"""Compares assisted generation, with a draft model proposing tokens for the main model to check, against plain greedy generation.
+
+Usage: python benchmarks/assisted_decoding.py [clip1.mp4 ...] [--model WhisperLargeV3] [--assistant WhisperLargeV3-Turbo] [--json results.json]
+       python benchmarks/assisted_decoding.py --backend tiny [--duration 120] [--json results.json]
+
+Every 30 second window of the clips is decoded one at a time, with and without the assistant. For each the benchmark reports
+tokens per second, the number of forward passes of the main model's decoder, and whether the generated tokens are identical,
+which assisted generation should guarantee. With --backend tiny, a tiny randomly initialized whisper model with 4 decoder
+layers is assisted by a copy of itself cut down to 1 decoder layer, on synthetic audio. This runs offline, but needs the
+openai/whisper-tiny processor files in the Hugging Face cache.
+"""
+import argparse
+import json
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from constants import whisper_sample_rate
+from utils import find_model
+
+class DecoderStepCounter:
+    """Counts the forward passes of a model's decoder, each of which is one full decoder step."""
+    def __init__(self, model):
+        self.steps = 0
+        self._handle = model.get_decoder().register_forward_hook(self._count)
+
+    def _count(self, module, inputs, output):
+        self.steps += 1
+
+    def remove(self):
+        self._handle.remove()
+
+def windows_of(clips, window_s=30):
+    window = int(window_s*whisper_sample_rate)
+    return [clip[start:start+window] for clip in clips for start in range(0, len(clip), window)]
+
+def generate_all(model, feature_extractor, windows, generate_kwargs):
+    """Generates each window one at a time. Returns ([token ids, ...], wall_seconds, main decoder steps)."""
+    import torch
+
+    counter = DecoderStepCounter(model)
+    sequences = []
+    start = time.perf_counter()
+    try:
+        for window in windows:
+            features = feature_extractor(window, sampling_rate=whisper_sample_rate, return_tensors="pt").input_features
+            with torch.no_grad():
+                output = model.generate(features.to(model.device, dtype=model.dtype), **generate_kwargs)
+            sequences.append(output[0].tolist())
+    finally:
+        counter.remove()
+    return sequences, time.perf_counter() - start, counter.steps
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("clips", nargs="*", type=Path)
+    parser.add_argument("--backend", choices=["real", "tiny"], default="real")
+    parser.add_argument("--model", default="WhisperLargeV3")
+    parser.add_argument("--assistant", default="WhisperLargeV3-Turbo")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--duration", type=float, default=120, help="Seconds of synthetic audio for --backend tiny.")
+    parser.add_argument("--task", default="transcribe", choices=["transcribe", "translate"])
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--json", type=Path, help="Write the results to this file as json.")
+    args = parser.parse_args(argv)
+
+    import torch
+
+    if args.backend == "tiny":
+        from transformers import AutoFeatureExtractor
+        from synthetic import synthetic_audio, tiny_random_model, truncated_decoder_model
+
+        model = tiny_random_model(decoder_layers=4)
+        assistant = truncated_decoder_model(model, 1)
+        feature_extractor = AutoFeatureExtractor.from_pretrained("openai/whisper-tiny", local_files_only=True)
+        clips = [synthetic_audio(args.duration)]
+        model_id, assistant_id = "tiny-random (4 decoder layers)", "tiny-random (1 decoder layer)"
+    else:
+        if not args.clips:
+            parser.error("clips are needed unless --backend tiny is used")
+        from transformers import AutoFeatureExtractor
+        from audio_processing import load_audio
+        from models import get_pipeline, get_assistant_model
+
+        model_id, assistant_id = find_model(args.model), find_model(args.assistant)
+        dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+        model = get_pipeline(model_id, args.device, dtype).model
+        assistant = get_assistant_model(assistant_id, model.device, model.dtype)
+        feature_extractor = AutoFeatureExtractor.from_pretrained(model_id)
+        clips = [load_audio(path) for path in args.clips]
+    model.to(args.device)
+    assistant.to(args.device)
+
+    windows = windows_of(clips)
+    audio_seconds = sum(len(window) for window in windows)/whisper_sample_rate
+    generate_kwargs = {"task": args.task, "max_new_tokens": args.max_new_tokens}
+    #The first call includes one-off costs, so it is not measured
+    generate_all(model, feature_extractor, windows[:1], generate_kwargs)
+
+    results = {}
+    for name, kwargs in (("plain", generate_kwargs), ("assisted", dict(generate_kwargs, assistant_model=assistant))):
+        sequences, seconds, steps = generate_all(model, feature_extractor, windows, kwargs)
+        tokens = sum(len(sequence) for sequence in sequences)
+        results[name] = {"sequences": sequences, "wall_seconds": seconds, "tokens": tokens,
+                         "tokens_per_second": tokens/seconds, "main_decoder_steps": steps,
+                         "real_time_factor": audio_seconds/seconds}
+        print(f"{name:8}  {tokens/seconds:8.1f} tokens/s  {steps:6d} main decoder steps  {audio_seconds/seconds:7.2f}x real time")
+
+    identical = sum(a == b for a, b in zip(results["plain"]["sequences"], results["assisted"]["sequences"]))
+    print(f"Identical output for {identical} of {len(windows)} windows, "
+          f"{results['plain']['main_decoder_steps']/max(1, results['assisted']['main_decoder_steps']):.2f}x fewer main decoder steps, "
+          f"{results['plain']['wall_seconds']/results['assisted']['wall_seconds']:.2f}x speedup")
+
+    if args.json:
+        for result in results.values():
+            del result["sequences"]
+        args.json.write_text(json.dumps({"model_id": model_id, "assistant_id": assistant_id, "audio_seconds": audio_seconds,
+                                         "windows": len(windows), "identical_windows": identical, "results": results}, indent=2))
+    return 0 if identical == len(windows) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
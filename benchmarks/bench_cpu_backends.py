@@ -0,0 +1,84 @@
+"""Compares the speed and accuracy of the cpu backends against the float32 model on a fixed set of audio clips.
+
+Usage: python benchmarks/bench_cpu_backends.py clip1.mp4 clip2.wav ... [--model WhisperLargeV3-Turbo] [--json results.json]
+
+Each backend transcribes every clip. Speed is reported as the real-time factor (audio seconds per wall second), and
+accuracy as the word error rate of each backend's transcript against the float32 transcript of the same clip.
+"""
+import argparse
+import json
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from audio_processing import load_audio
+from constants import whisper_sample_rate
+from utils import find_model
+
+def word_error_rate(reference, hypothesis):
+    """Returns the word level edit distance between reference and hypothesis, divided by the number of reference words."""
+    reference = reference.lower().split()
+    hypothesis = hypothesis.lower().split()
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, start=1):
+        current = [i]
+        for j, hyp_word in enumerate(hypothesis, start=1):
+            current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ref_word != hyp_word)))
+        previous = current
+    return previous[-1]/max(1, len(reference))
+
+def transcribe_clips(pipe, clips, task):
+    """Returns ([text, ...], wall_seconds) for transcribing every clip with pipe."""
+    texts = []
+    start = time.perf_counter()
+    for audio in clips:
+        result = pipe(audio, batch_size=8, chunk_length_s=30, return_timestamps=True, generate_kwargs={"task": task})
+        texts.append(result["text"])
+    return texts, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("clips", nargs="+", type=Path)
+    parser.add_argument("--model", default="WhisperLargeV3-Turbo")
+    parser.add_argument("--task", default="transcribe", choices=["transcribe", "translate"])
+    parser.add_argument("--backends", nargs="+", default=["default", "int8", "bf16"])
+    parser.add_argument("--compile", action="store_true", help="Also run each backend with torch.compile.")
+    parser.add_argument("--json", type=Path, help="Write the results to this file as json.")
+    args = parser.parse_args(argv)
+
+    import models
+
+    model_id = find_model(args.model)
+    clips = [load_audio(path) for path in args.clips]
+    audio_seconds = sum(len(clip) for clip in clips)/whisper_sample_rate
+
+    configurations = [(backend, False) for backend in args.backends]
+    if args.compile:
+        configurations += [(backend, True) for backend in args.backends]
+    #The float32 model is the reference, so it always runs first
+    if ("default", False) in configurations:
+        configurations.remove(("default", False))
+    configurations.insert(0, ("default", False))
+
+    results = []
+    reference = None
+    for backend, compile in configurations:
+        pipe = models.get_pipeline(model_id, "cpu", "float32", backend, compile)
+        #The first call includes one-off costs such as compilation, so it is not timed
+        pipe(clips[0][:whisper_sample_rate*5], return_timestamps=True, generate_kwargs={"task": args.task})
+        texts, seconds = transcribe_clips(pipe, clips, args.task)
+        if reference is None:
+            reference = texts
+        wer = sum(word_error_rate(ref, text) for ref, text in zip(reference, texts))/len(texts)
+        results.append({"backend": backend, "compile": compile, "wall_seconds": seconds,
+                        "real_time_factor": audio_seconds/seconds, "wer_vs_fp32": wer})
+        print(f"{backend:8} compile={str(compile):5}  {audio_seconds/seconds:7.2f}x real time  WER vs fp32 {wer:.3f}")
+        models.evict_model(model_id)
+
+    if args.json:
+        args.json.write_text(json.dumps({"model_id": model_id, "audio_seconds": audio_seconds, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Compares decoding a long file in one ffmpeg process against decoding it in ranges with several processes in parallel.
+
+Usage: python benchmarks/parallel_decode.py recording.mp4 [--ranges 2 4 8] [--json results.json]
+       python benchmarks/parallel_decode.py --synthetic 3600 [--ranges 2 4 8] [--json results.json]
+
+For each number of ranges it reports the wall time to decode the whole file, the time until the first window of the
+segmented path is available, and the largest difference from the serial decode, both overall and within 10ms of each
+join. With --synthetic, that many seconds of synthetic audio are encoded to AAC in a temporary .m4a file first, which
+needs ffmpeg built with its AAC encoder.
+"""
+import argparse
+import json
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from audio_processing import load_audio, load_audio_ranges, split_timeline, stream_windows
+from constants import whisper_sample_rate
+
+def encode_synthetic(duration_s, path):
+    """Writes duration_s seconds of synthetic audio to path as AAC."""
+    from synthetic import synthetic_audio
+
+    audio = synthetic_audio(duration_s)
+    subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+                    "-f", "f32le", "-ar", str(whisper_sample_rate), "-ac", "1", "-i", "-", "-c:a", "aac", str(path)],
+                   input=audio.tobytes(), check=True)
+
+def time_to_first_window(path, ranges, window_s=600, overlap_s=10):
+    start = time.perf_counter()
+    windows = stream_windows(path, window_s, overlap_s, ranges)
+    next(windows)
+    seconds = time.perf_counter() - start
+    windows.close()
+    return seconds
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", nargs="?", type=Path)
+    parser.add_argument("--synthetic", type=float, help="Seconds of synthetic audio to decode instead of a file.")
+    parser.add_argument("--ranges", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--json", type=Path, help="Write the results to this file as json.")
+    args = parser.parse_args(argv)
+    if (args.file is None) == (args.synthetic is None):
+        parser.error("give either a file or --synthetic")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.file
+        if path is None:
+            path = Path(workdir) / "synthetic.m4a"
+            encode_synthetic(args.synthetic, path)
+
+        start = time.perf_counter()
+        reference = load_audio(path)
+        serial_s = time.perf_counter() - start
+        audio_seconds = len(reference)/whisper_sample_rate
+        results = {"serial": {"wall_seconds": serial_s, "first_window_seconds": time_to_first_window(path, 1)}}
+        print(f"serial     {serial_s:7.2f}s  {audio_seconds/serial_s:8.0f}x real time  first window after {results['serial']['first_window_seconds']:.2f}s")
+
+        for ranges in args.ranges:
+            start = time.perf_counter()
+            #min_range_s=0 so the requested number of ranges is used whatever the length of the file
+            audio = load_audio_ranges(path, ranges, min_range_s=0)
+            seconds = time.perf_counter() - start
+            length = min(len(audio), len(reference))
+            difference = np.abs(audio[:length] - reference[:length])
+            near = int(0.01*whisper_sample_rate)
+            joins = [begin for begin, _ in split_timeline(len(reference), ranges)[1:]]
+            join_difference = max((float(difference[max(0, j - near):j + near].max()) for j in joins if j < length), default=0.0)
+            results[f"{ranges} ranges"] = {"wall_seconds": seconds, "first_window_seconds": time_to_first_window(path, ranges),
+                                           "length_difference": len(audio) - len(reference),
+                                           "max_difference": float(difference.max()) if length else 0.0,
+                                           "max_difference_at_joins": join_difference}
+            result = results[f"{ranges} ranges"]
+            print(f"{ranges:2d} ranges  {seconds:7.2f}s  {audio_seconds/seconds:8.0f}x real time  first window after "
+                  f"{result['first_window_seconds']:.2f}s  {serial_s/seconds:.2f}x speedup  length difference "
+                  f"{result['length_difference']}  max difference {result['max_difference']:.2e} ({join_difference:.2e} at joins)")
+
+    if args.json:
+        args.json.write_text(json.dumps({"file": str(args.file), "audio_seconds": audio_seconds, "results": results}, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
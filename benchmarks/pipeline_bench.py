@@ -0,0 +1,145 @@
+"""Benchmarks the stages of the subtitle pipeline on synthetic videos, offline and without a GPU.
+
+Usage: python benchmarks/pipeline_bench.py [--file-counts 1 4] [--durations 30 300] [--backend stub|tiny] [--json results.json]
+
+For every combination of file count and duration, synthetic videos are generated and the real extract_audio, load_audio,
+determine_lang, VideoSubbing.create_subs, write_subs and subtitle_files paths are run on them. Inference goes through
+either a deterministic stub pipeline or a tiny randomly initialized whisper model. Throughput is reported in audio seconds
+per wall second for each stage, together with the peak resident memory of the process and of its largest child, such as
+ffmpeg, while that case ran. Memory is sampled every 20ms, so very short spikes can be missed.
+"""
+import argparse
+import dataclasses
+import json
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from audio_processing import extract_audio, load_audio
+from constants import whisper_sample_rate
+from subtitling import SubbingParameters, VideoSubbing, subtitle_files
+from utils import determine_lang, write_subs
+from synthetic import synthetic_audio, make_video, StubPipeline, tiny_random_pipeline
+
+class PeakRss:
+    """Samples the resident memory of this process and of its largest child process every interval_s seconds while the
+        enclosed block runs, keeping the peaks in MB. Unlike getrusage's ru_maxrss, which is the peak over the whole life
+        of the process, this gives the peak of each case on its own."""
+    def __init__(self, interval_s=0.02):
+        self.interval_s = interval_s
+        self.rss_mb = 0.0
+        self.child_rss_mb = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            self.rss_mb = max(self.rss_mb, process.memory_info().rss/2**20)
+            for child in process.children(recursive=True):
+                try:
+                    self.child_rss_mb = max(self.child_rss_mb, child.memory_info().rss/2**20)
+                except psutil.Error:
+                    #Children can exit between being listed and being sampled
+                    continue
+            self._stop.wait(self.interval_s)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+def time_stage(name, audio_seconds, function, items):
+    """Runs function on every item, and returns the wall time and throughput of the stage."""
+    start = time.perf_counter()
+    results = [function(item) for item in items]
+    wall = time.perf_counter() - start
+    return {"stage": name, "wall_s": wall, "audio_s": audio_seconds,
+            "audio_s_per_wall_s": audio_seconds/wall if wall > 0 else None}, results
+
+def run_case(workdir: Path, file_count, duration_s, pipe, lang_detection):
+    """Benchmarks every stage on file_count synthetic videos of duration_s seconds each."""
+    #Every file gets different audio, so nothing is shared between files
+    videos = [make_video(workdir / f"video_{file_count}_{duration_s}_{i}.mp4", synthetic_audio(duration_s, seed=i)) for i in range(file_count)]
+    audio_seconds = file_count*duration_s
+    parameters = SubbingParameters(replace=True, multi_lang=False, replace_lang=True, use_cache=False, lang_detection=lang_detection)
+    stages = []
+
+    stage, wav_paths = time_stage("extract_audio (wav)", audio_seconds, extract_audio, videos)
+    stages.append(stage)
+    for wav_path in wav_paths:
+        wav_path.unlink()
+
+    stage, audios = time_stage("load_audio (memory)", audio_seconds, load_audio, videos)
+    stages.append(stage)
+
+    stage, _ = time_stage("determine_lang", audio_seconds,
+                          lambda item: determine_lang(item[1], item[0], pipe, replace_lang=True, method=lang_detection), list(zip(videos, audios)))
+    stages.append(stage)
+
+    parameters_with_lang = dataclasses.replace(parameters, provide_lang=True, provided_lang="english")
+    stage, _ = time_stage("VideoSubbing.create_subs", audio_seconds,
+                          lambda item: VideoSubbing(item[0], pipe, parameters=parameters_with_lang, audio=item[1]).create_subs(), list(zip(videos, audios)))
+    stages.append(stage)
+
+    chunks = [pipe(audio, chunk_length_s=parameters.chunk_length_s)["chunks"] for audio in audios]
+    stage, _ = time_stage("write_subs", audio_seconds, lambda item: write_subs(item[0].with_suffix(".srt"), item[1]), list(zip(videos, chunks)))
+    stages.append(stage)
+
+    del audios
+    stage, _ = time_stage("subtitle_files (end to end)", audio_seconds, lambda files: subtitle_files(files, pipe, parameters), [videos])
+    stages.append(stage)
+
+    for video in videos:
+        for path in (video, video.with_suffix(".srt")):
+            if path.exists():
+                path.unlink()
+
+    return {"file_count": file_count, "duration_s": duration_s, "stages": stages}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file-counts", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--durations", nargs="+", type=float, default=[30, 300])
+    parser.add_argument("--backend", choices=["stub", "tiny"], default="stub",
+                        help="Deterministic stub pipeline, or a tiny randomly initialized whisper model.")
+    parser.add_argument("--stub-cost", type=float, default=0.0,
+                        help="Seconds the stub pipeline sleeps per second of audio, to simulate a model.")
+    parser.add_argument("--json", type=Path, help="Write the results to this file as json, for comparing runs.")
+    parser.add_argument("--workdir", type=Path, help="Where to create the synthetic videos. Defaults to a temporary folder.")
+    args = parser.parse_args(argv)
+
+    if args.backend == "stub":
+        pipe = StubPipeline(args.stub_cost)
+        #The stub has no encoder, so language detection goes through the pipeline
+        lang_detection = "full"
+    else:
+        pipe = tiny_random_pipeline()
+        lang_detection = "encoder"
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for duration_s in args.durations:
+            for file_count in args.file_counts:
+                with PeakRss() as memory:
+                    case = run_case(Path(workdir), file_count, duration_s, pipe, lang_detection)
+                case.update(peak_rss_mb=memory.rss_mb, peak_child_rss_mb=memory.child_rss_mb)
+                results.append(case)
+                print(f"{file_count} file(s) x {duration_s:g}s  peak rss {case['peak_rss_mb']:.0f}MB (ffmpeg {case['peak_child_rss_mb']:.0f}MB)")
+                for stage in case["stages"]:
+                    print(f"    {stage['stage']:30} {stage['wall_s']:8.3f}s  {stage['audio_s_per_wall_s'] or 0:10.1f} audio s/s")
+
+    if args.json:
+        args.json.write_text(json.dumps({"backend": args.backend, "sample_rate": whisper_sample_rate, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Measures how long the GUI takes to start, to catch heavy imports creeping back onto the startup path.
+
+Usage: python benchmarks/startup_time.py [--repeats 3] [--max-import-seconds 1.5] [--max-window-seconds 3] [--json results.json]
+
+Each measurement runs in a fresh interpreter, so nothing is already imported or cached in memory: the time to import appui,
+and the time from starting to import appui until the window has been drawn. It also checks that none of the heavy libraries
+(torch, transformers, huggingface_hub, CTkMessagebox) have been imported by then, as they should only be loaded in the
+background afterwards. The exit status is nonzero if a heavy library was imported or a limit was exceeded. Drawing the
+window needs a display, without one only the import time is measured.
+"""
+import argparse
+import json
+from pathlib import Path
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+repo_root = Path(__file__).resolve().parent.parent
+heavy_modules = ["torch", "transformers", "huggingface_hub", "CTkMessagebox"]
+
+#Runs in a fresh interpreter, printing its measurements as json
+probe = """
+import json, sys, time
+start = time.perf_counter()
+import appui
+imported = time.perf_counter()
+result = {"import_s": imported - start, "heavy_at_import": [m for m in HEAVY if m in sys.modules]}
+if WINDOW:
+    try:
+        ui = appui.appUI(start_mainloop=False)
+        ui.root.update()
+        result["window_s"] = time.perf_counter() - start
+        result["heavy_at_window"] = [m for m in HEAVY if m in sys.modules]
+        ui.root.destroy()
+    except Exception as e:
+        result["window_error"] = repr(e)
+print(json.dumps(result))
+"""
+
+def measure(window):
+    """Starts a fresh interpreter and returns its measurements."""
+    code = probe.replace("HEAVY", repr(heavy_modules)).replace("WINDOW", repr(window))
+    env = dict(os.environ, PYTHONPATH=str(repo_root))
+    #appui reads and writes config.ini in the working directory, so it runs somewhere it can't touch the real one
+    with tempfile.TemporaryDirectory() as workdir:
+        process = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-import-seconds", type=float, default=1.5)
+    parser.add_argument("--max-window-seconds", type=float, default=3)
+    parser.add_argument("--no-window", action="store_true", help="Only measure the import time.")
+    parser.add_argument("--json", type=Path, help="Write the results to this file as json.")
+    args = parser.parse_args(argv)
+
+    runs = [measure(not args.no_window) for _ in range(args.repeats)]
+    import_s = statistics.median(run["import_s"] for run in runs)
+    window_runs = [run for run in runs if "window_s" in run]
+    window_s = statistics.median(run["window_s"] for run in window_runs) if window_runs else None
+    heavy = sorted({module for run in runs for module in run["heavy_at_import"] + run.get("heavy_at_window", [])})
+
+    print(f"import appui: {import_s:.3f}s (median of {len(runs)})")
+    if window_s is not None:
+        print(f"first window: {window_s:.3f}s (median of {len(window_runs)})")
+    elif not args.no_window:
+        print(f"first window: not measured, {runs[0].get('window_error')}")
+    if heavy:
+        print(f"heavy libraries imported before the window appeared: {', '.join(heavy)}")
+
+    failed = bool(heavy) or import_s > args.max_import_seconds or (window_s is not None and window_s > args.max_window_seconds)
+    if args.json:
+        args.json.write_text(json.dumps({"import_s": import_s, "window_s": window_s, "heavy_imported": heavy,
+                                         "runs": runs, "failed": failed}, indent=2))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
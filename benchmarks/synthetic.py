@@ -0,0 +1,123 @@
+"""Synthetic inputs and model backends for running the subtitle pipeline offline, without real media or model weights."""
+from pathlib import Path
+import subprocess
+import time
+import wave
+
+import numpy as np
+
+from constants import whisper_sample_rate
+
+def synthetic_audio(duration_s, seed=0, speech_fraction=0.6):
+    """Returns duration_s seconds of mono 16kHz float32 audio made of speech-like bursts of modulated tones,
+        separated by near-silence, with roughly speech_fraction of the time taken up by bursts."""
+    rng = np.random.default_rng(seed)
+    audio = rng.normal(0, 1e-4, int(duration_s*whisper_sample_rate)).astype(np.float32)
+    position = 0
+    while position < len(audio):
+        burst = int(rng.uniform(0.5, 4)*whisper_sample_rate)
+        gap = int(burst*(1 - speech_fraction)/speech_fraction)
+        t = np.arange(min(burst, len(audio) - position))/whisper_sample_rate
+        pitch = rng.uniform(100, 250)
+        envelope = 0.5*(1 + np.sin(2*np.pi*rng.uniform(3, 6)*t))
+        tone = sum(np.sin(2*np.pi*pitch*k*t)/k for k in range(1, 5))
+        audio[position:position+len(t)] += (0.2*envelope*tone).astype(np.float32)
+        position += burst + gap
+    return np.clip(audio, -1, 1)
+
+def write_wav(path: Path, audio):
+    """Writes mono 16kHz float32 audio to path as a 16 bit wav file."""
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(whisper_sample_rate)
+        f.writeframes((np.clip(audio, -1, 1)*32767).astype(np.int16).tobytes())
+
+def read_wav(path):
+    """Reads a 16 bit wav file written by write_wav back into float32 audio."""
+    with wave.open(str(path), "rb") as f:
+        return np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16).astype(np.float32)/32767
+
+def make_video(path: Path, audio):
+    """Creates a tiny video container at path, with a 64x64 black video track and audio as its sound track."""
+    wav_path = path.with_name(path.stem + "_source.wav")
+    write_wav(wav_path, audio)
+    duration = len(audio)/whisper_sample_rate
+    try:
+        subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+                        "-f", "lavfi", "-i", f"color=c=black:s=64x64:r=5:d={duration}",
+                        "-i", str(wav_path), "-shortest",
+                        "-c:v", "mpeg4", "-c:a", "aac", "-ac", "2", "-ar", "44100", str(path)],
+                       check=True, capture_output=True)
+    finally:
+        wav_path.unlink()
+    return path
+
+class StubPipeline:
+    """
+    Deterministic stand-in for the whisper pipeline. It returns one chunk per chunk_length_s window with text derived
+    from the audio, and can sleep for seconds_per_audio_second of each input to simulate the cost of a model.
+    It accepts the same call signature as the real pipeline, for a single input or a list of inputs.
+    """
+    model = None
+
+    def __init__(self, seconds_per_audio_second=0.0, language="english"):
+        self.seconds_per_audio_second = seconds_per_audio_second
+        self.language = language
+
+    def __call__(self, inputs, batch_size=1, chunk_length_s=30, return_timestamps=True, return_language=False, generate_kwargs=None, **kwargs):
+        if isinstance(inputs, list):
+            return [self._transcribe(audio, chunk_length_s or 30) for audio in inputs]
+        return self._transcribe(inputs, chunk_length_s or 30)
+
+    def _transcribe(self, audio, chunk_length_s):
+        if isinstance(audio, str):
+            audio = read_wav(audio)
+        duration = len(audio)/whisper_sample_rate
+        time.sleep(duration*self.seconds_per_audio_second)
+        chunks = []
+        window = int(chunk_length_s*whisper_sample_rate)
+        for start in range(0, len(audio), window):
+            level = float(np.sqrt(np.mean(np.square(audio[start:start+window], dtype=np.float64))))
+            end = min(len(audio), start + window)
+            chunks.append({"timestamp": (start/whisper_sample_rate, end/whisper_sample_rate),
+                           "text": f" Segment {len(chunks) + 1} at level {level:.3f}.", "language": self.language})
+        return {"text": "".join(chunk["text"] for chunk in chunks), "chunks": chunks}
+
+def tiny_random_model(processor_id="openai/whisper-tiny", seed=0, decoder_layers=2):
+    """Returns a tiny randomly initialized whisper model, with the generation config of processor_id, which must already
+        be in the Hugging Face cache."""
+    import torch
+    from transformers import GenerationConfig, WhisperConfig, WhisperForConditionalGeneration
+
+    torch.manual_seed(seed)
+    generation_config = GenerationConfig.from_pretrained(processor_id, local_files_only=True)
+    config = WhisperConfig(vocab_size=51865, d_model=64, encoder_layers=2, decoder_layers=decoder_layers,
+                           encoder_attention_heads=2, decoder_attention_heads=2,
+                           encoder_ffn_dim=128, decoder_ffn_dim=128,
+                           decoder_start_token_id=generation_config.decoder_start_token_id,
+                           eos_token_id=generation_config.eos_token_id, pad_token_id=generation_config.pad_token_id)
+    model = WhisperForConditionalGeneration(config)
+    model.generation_config = generation_config
+    model.eval()
+    return model
+
+def truncated_decoder_model(model, decoder_layers):
+    """Returns a copy of model keeping only its first decoder_layers decoder layers, the way WhisperLargeV3-Turbo is
+        derived from WhisperLargeV3. Everything else, including the encoder, keeps model's weights."""
+    import copy
+
+    draft = copy.deepcopy(model)
+    draft.model.decoder.layers = draft.model.decoder.layers[:decoder_layers]
+    draft.config.decoder_layers = decoder_layers
+    return draft
+
+def tiny_random_pipeline(device="cpu", processor_id="openai/whisper-tiny", seed=0):
+    """Returns a real whisper pipeline around a tiny randomly initialized model. Its output is meaningless, but it
+        exercises the real pipeline, generation and language detection code. The tokenizer, feature extractor and
+        generation config are loaded from processor_id, which must already be in the Hugging Face cache."""
+    import torch
+
+    from models import wrap_pipeline
+
+    return wrap_pipeline(tiny_random_model(processor_id, seed), processor_id, device, torch.float32)
@@ -0,0 +1,69 @@
+import torch
+from transformers.models.whisper.tokenization_whisper import TO_LANGUAGE_CODE
+
+from audio_processing import pipeline_windows
+from constants import whisper_sample_rate
+
+#Whisper's encoder takes 30 seconds of audio, longer windows would be cut off
+max_window_s = 30
+
+def language_code(language):
+    """Returns the two letter code for a whisper language name such as "french", or language itself if it is already a code."""
+    return TO_LANGUAGE_CODE.get(language.lower(), language.lower())
+
+def _sequences_to_chunks(sequences, tokenizer, windows):
+    """Converts generated token sequences with timestamp tokens into chunks of the form pipe(...)["chunks"], offsetting
+        each window's timestamps by its start and keeping only the chunks that start in the part of it outside its strides."""
+    chunks = []
+    for ids, (_, start_s, keep_start_s, keep_end_s) in zip(sequences, windows):
+        decoded = tokenizer.decode(ids, skip_special_tokens=True, output_offsets=True)
+        for offset in decoded["offsets"]:
+            begin, end = offset["timestamp"]
+            if keep_start_s <= start_s + begin < keep_end_s:
+                chunks.append({"timestamp": (start_s + begin, None if end is None else start_s + end), "text": offset["text"]})
+    return chunks
+
+def bilingual_windows(length, chunk_length_s=30, stride_length_s=None):
+    """Returns the windows transcribe_bilingual cuts length samples into, as given by audio_processing.pipeline_windows.
+        Windows are at most 30 seconds, the most whisper's encoder takes."""
+    chunk_length_s = min(chunk_length_s or max_window_s, max_window_s)
+    return pipeline_windows([length], chunk_length_s, stride_length_s)[0]
+
+def transcribe_bilingual(audio, pipe, language, batch_size=8, chunk_length_s=30, stride_length_s=None, max_new_tokens=128,
+                         task_generate_kwargs=None):
+    """
+    Transcribes audio in language and translates it to English from a single encoder pass. The audio is cut into
+    overlapping windows the way the chunked pipeline cuts it (see bilingual_windows), batch_size windows are encoded at a
+    time, and the same encoder states are decoded twice, once for each task. As in the pipeline, each window only
+    contributes the segments that start outside its strides, so speech cut at a window edge is taken from the window
+    where it is whole; unlike the pipeline, overlapping windows are merged at segment rather than token level. Each
+    window is decoded to at most max_new_tokens tokens, the same limit as the pipeline, so text beyond it in very dense
+    speech is lost. Returns (transcript_chunks, translation_chunks), both of the form pipe(...)["chunks"]. For English
+    audio the transcript is also returned as the translation, without decoding twice.
+    task_generate_kwargs can hold extra generate kwargs for each task, such as a logits_processor, keyed by task.
+    """
+    model = pipe.model
+    chunk_length_s = min(chunk_length_s or max_window_s, max_window_s)
+    windows = bilingual_windows(len(audio), chunk_length_s, stride_length_s)
+    window = int(round(chunk_length_s*whisper_sample_rate))
+    tasks = ["transcribe"] if language_code(language) == "en" else ["transcribe", "translate"]
+    results = {task: [] for task in tasks}
+
+    for i in range(0, len(windows), batch_size):
+        batch = windows[i:i+batch_size]
+        starts = [int(round(start_s*whisper_sample_rate)) for _, start_s, _, _ in batch]
+        inputs = [audio[start:start+window] for start in starts]
+        features = pipe.feature_extractor(inputs, sampling_rate=whisper_sample_rate, return_tensors="pt").input_features
+        features = features.to(model.device, dtype=model.dtype)
+        with torch.no_grad():
+            encoder_outputs = model.get_encoder()(features)
+            for task in tasks:
+                sequences = model.generate(encoder_outputs=encoder_outputs, language=language, task=task,
+                                           return_timestamps=True, max_new_tokens=max_new_tokens,
+                                           **(task_generate_kwargs or {}).get(task, {}))
+                if not isinstance(sequences, torch.Tensor):
+                    sequences = sequences["sequences"]
+                results[task].extend(_sequences_to_chunks(sequences.cpu(), pipe.tokenizer, batch))
+
+    transcript = results["transcribe"]
+    return transcript, results.get("translate", transcript)
@@ -0,0 +1,366 @@
+import argparse
+import logging
+from pathlib import Path
+
+from constants import supported_models, supported_languages, valid_video_file_types, config_defaults
+from utils import find_model, get_list_of_videos
+
+#Headless command line interface. Only lightweight modules are imported at startup, torch and transformers are
+#loaded once there are files to process, and customtkinter is never imported.
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="whispersubs", description="Generate .srt subtitles for video files using Whisper.")
+    parser.add_argument("paths", nargs="*", type=Path, help="Video files and/or folders to process.")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Include all subfolders of any folders given.")
+    parser.add_argument("--scan-index", type=Path,
+                        help="Persist folder listings here, so later scans skip folders that haven't changed.")
+    parser.add_argument("-m", "--model", default=config_defaults['model_name'],
+                        help=f"Model to use, one of {', '.join(supported_models)} or a Hugging Face model id.")
+    parser.add_argument("--assistant-model",
+                        help="Draft model for assisted generation, e.g. WhisperLargeV3-Turbo to speed up WhisperLargeV3. "
+                             "The output is the same as without it, processing one window at a time.")
+    parser.add_argument("--lang-mode", choices=["single", "multi"], default="single",
+                        help="Auto-detect a single language for each file, or let the model detect it for every chunk.")
+    parser.add_argument("--language", help="Use this language rather than detecting it, e.g. French.")
+    parser.add_argument("--task", choices=["translate", "transcribe"], default="translate",
+                        help="Translate to English, or transcribe in the original language.")
+    parser.add_argument("--bilingual", action="store_true",
+                        help="Write both video_name.<language>.srt in the language spoken and video_name.en.srt translated to English.")
+    parser.add_argument("--replace", action="store_true", help="Overwrite any existing subtitle files.")
+    parser.add_argument("--replace-stale", action="store_true",
+                        help="Regenerate subtitle files older than their video. They are only reported otherwise, as they may have been edited by hand.")
+    parser.add_argument("--replace-lang", action="store_true", help="Replace any previously generated language detections.")
+    parser.add_argument("--keep-intermediary-files", action="store_true", help="Keep language detection files.")
+    parser.add_argument("--device", help="Torch device to run on, e.g. cuda:0 or cpu. Defaults to cuda if available.")
+    parser.add_argument("--dtype", choices=["float16", "bfloat16", "float32"],
+                        help="Model dtype. Defaults to float16 on cuda and float32 on cpu.")
+    parser.add_argument("--batch-size", type=int,
+                        help="Number of windows per model call. Defaults to the autotuned value for the model and device, or 8.")
+    parser.add_argument("--chunk-length", type=float,
+                        help="Length in seconds of the windows fed to the model. Defaults to the autotuned value, or 30.")
+    parser.add_argument("--stride-length", type=float,
+                        help="Seconds of overlap on each side of a window. Defaults to the autotuned value, or a sixth of the window.")
+    parser.add_argument("--autotune", action="store_true",
+                        help="Measure throughput and memory of batch and window sizes on the first video given, save the best "
+                             "settings for the model and device to config.ini, and exit.")
+    parser.add_argument("--memory-budget", type=float,
+                        help="Memory in GB the autotuned settings may use. Defaults to 80%% of the device's memory.")
+    parser.add_argument("--workers", type=int, default=2, help="Number of background audio decoding workers.")
+    parser.add_argument("--no-repetition-guard", action="store_true",
+                        help="Let every window run to the token limit, instead of stopping windows that degenerate into repetition.")
+    parser.add_argument("--drop-repetitions", action="store_true",
+                        help="Leave the text of windows stopped by the repetition guard out of the subtitles.")
+    parser.add_argument("--guard-low-confidence", action="store_true",
+                        help="Also stop windows whose average token log-probability falls below -1 or whose text compresses "
+                             "more than 2.4 times. This can cut off real speech whisper is unsure of.")
+    parser.add_argument("--decode-ranges", type=int, default=4,
+                        help="Decode long files in up to this many ranges in parallel, one ffmpeg process each. 1 decodes each file in one go.")
+    parser.add_argument("--cpu-backend", choices=["default", "int8", "bf16"], default="default",
+                        help="cpu inference backend: dynamic int8 quantization, or bfloat16 on cpus that support it.")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile.")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of worker processes for cpu inference, each pinned to its own slice of cores.")
+    parser.add_argument("--threads-per-process", type=int, default=0,
+                        help="Torch threads per worker process. Defaults to the number of cores in its slice.")
+    parser.add_argument("--segment-over", type=float, default=7200,
+                        help="Process files longer than this many seconds in segments with bounded memory. 0 disables segmenting.")
+    parser.add_argument("--segment-length", type=float, default=600, help="Length in seconds of the segments long files are processed in.")
+    parser.add_argument("--vad", action="store_true", help="Skip silence using voice activity detection.")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the transcription cache.")
+    parser.add_argument("--manifest", type=Path,
+                        help="Job manifest to record progress in. Defaults to whispersubs_manifest.sqlite in the first folder given.")
+    parser.add_argument("--no-manifest", action="store_true", help="Don't record progress in a job manifest.")
+    parser.add_argument("--resume", action="store_true", help="Skip files the manifest records as done or failed.")
+    parser.add_argument("--retry-failed", action="store_true", help="Only process the files the manifest records as failed.")
+    parser.add_argument("--plan", action="store_true", help="Print which files would be processed, skipped or redone as stale, and exit.")
+    parser.add_argument("--report", action="store_true", help="Print the progress recorded in the manifest and exit.")
+    parser.add_argument("--metrics-log", type=Path, help="Append per-file stage timings and a run summary to this json lines file.")
+    parser.add_argument("--metrics-prometheus", type=Path, help="Keep this file updated with run metrics in the Prometheus text format.")
+    parser.add_argument("--metrics-port", type=int, help="Serve run metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running, and subtitle new video files as they appear in the folders given.")
+    parser.add_argument("--watch-interval", type=float, default=30,
+                        help="Seconds between folder scans in watch mode, when inotify isn't available.")
+    parser.add_argument("--settle-seconds", type=float, default=30,
+                        help="In watch mode, wait until a new file hasn't changed for this many seconds before processing it.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of files processed at once in watch mode.")
+    parser.add_argument("--control-port", type=int,
+                        help="In watch mode, serve status and pause/resume/rescan/stop controls at http://127.0.0.1:PORT.")
+    parser.add_argument("--queue", type=Path,
+                        help="Share the work with other hosts through a job queue at this path on a shared drive: an SQLite "
+                             "database for a .sqlite or .db path, or a folder of lease files otherwise. Place it above the videos on the share, "
+                             "as they are recorded relative to its folder.")
+    parser.add_argument("--worker-id", help="Name of this worker in the job queue. Defaults to the host name and process id.")
+    parser.add_argument("--lease-seconds", type=float, default=600,
+                        help="How long a claimed file stays reserved for a worker without a heartbeat before others may take it over.")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="Run a transcription service at http://127.0.0.1:PORT, sharing one loaded model between clients.")
+    parser.add_argument("--max-requests", type=int, default=32,
+                        help="Requests the service accepts at once, further requests are answered with 503.")
+    parser.add_argument("--batch-wait", type=float, default=0.05,
+                        help="Seconds the service waits for more requests to batch together with the first one.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log progress information.")
+    return parser
+
+def parameters_from_args(args):
+    """Creates a SubbingParameters object corresponding to the command line arguments."""
+    from subtitling import SubbingParameters
+
+    parameters = SubbingParameters(
+        replace=args.replace,
+        replace_stale=args.replace_stale,
+        multi_lang=args.lang_mode == "multi",
+        replace_lang=args.replace_lang,
+        preserve_intermediary_files=args.keep_intermediary_files,
+        task=args.task,
+        bilingual=args.bilingual,
+        assistant_model=find_model(args.assistant_model) if args.assistant_model else None,
+        decode_workers=args.workers,
+        decode_ranges=args.decode_ranges,
+        repetition_guard=not args.no_repetition_guard,
+        drop_repetitions=args.drop_repetitions,
+        guard_low_confidence=args.guard_low_confidence,
+        vad=args.vad,
+        use_cache=not args.no_cache,
+        resume=args.resume,
+        processes=args.processes,
+        threads_per_process=args.threads_per_process,
+        cpu_backend=args.cpu_backend,
+        compile_model=args.compile,
+        segment_min_duration_s=args.segment_over,
+        segment_length_s=args.segment_length,
+    )
+    for name, value in (("batch_size", args.batch_size), ("chunk_length_s", args.chunk_length), ("stride_length_s", args.stride_length)):
+        if value is not None:
+            setattr(parameters, name, value)
+    if args.language:
+        parameters.multi_lang = False
+        parameters.provide_lang = True
+        parameters.provided_lang = args.language
+    return parameters
+
+def collect_videos(paths, recursive, index_path=None):
+    """Expands the given files and folders into a list of video files. Returns (videos, missing_paths)."""
+    videos = []
+    missing = []
+    for path in paths:
+        if path.is_dir():
+            videos.extend(get_list_of_videos(path, recursive, index_path))
+        elif path.is_file() and path.suffix.lower() in valid_video_file_types:
+            videos.append(path)
+        else:
+            missing.append(path)
+    return videos, missing
+
+def apply_tuning(args, parameters, model_id):
+    """Applies the autotuned settings for the model and device to parameters, except where given on the command line."""
+    from models import default_device
+    from autotune import apply_tuned
+
+    explicit = [name for name, value in (("batch_size", args.batch_size), ("chunk_length_s", args.chunk_length),
+                                         ("stride_length_s", args.stride_length)) if value is not None]
+    device = args.device or default_device()[0]
+    if apply_tuned(parameters, model_id, device, keep=explicit):
+        logging.info("Using autotuned settings for %s on %s: batch_size=%d, chunk_length_s=%s, stride_length_s=%s",
+                     model_id, device, parameters.batch_size, parameters.chunk_length_s, parameters.stride_length_s)
+
+def run_autotune(args, videos):
+    """Autotunes the model on the first of videos and saves the result to config.ini."""
+    from audio_processing import load_audio
+    from autotune import autotune, save_tuned
+    from models import get_pipeline, default_device
+    from constants import whisper_sample_rate
+
+    model_id = find_model(args.model)
+    device = args.device or default_device()[0]
+    parameters = parameters_from_args(args)
+    pipe = get_pipeline(model_id, device, args.dtype, parameters.cpu_backend, parameters.compile_model)
+    #Ten minutes is plenty to fill the largest batch tried
+    audio = load_audio(videos[0])[:600*whisper_sample_rate]
+    generate_kwargs = {"task": parameters.task}
+    if parameters.provide_lang:
+        generate_kwargs["language"] = parameters.provided_lang
+    budget = None if args.memory_budget is None else int(args.memory_budget*1024**3)
+    best, _ = autotune(pipe, audio, device, budget, generate_kwargs=generate_kwargs)
+    save_tuned(model_id, device, best)
+    print(f"Saved for {model_id} on {device}: batch_size={best['batch_size']}, chunk_length_s={best['chunk_length_s']}, "
+          f"stride_length_s={best['stride_length_s']} ({best['throughput']:.1f}x real time, peak memory {best['peak_memory']/1024**3:.2f}GB)")
+    return 0
+
+def run_queue_worker(args, videos):
+    """Adds videos to the shared job queue and works through it together with the workers on other hosts."""
+    from job_queue import open_queue, run_worker
+    from models import get_pipeline
+    from metrics import RunMetrics
+
+    queue = open_queue(args.queue)
+    queue.add(videos)
+    parameters = parameters_from_args(args)
+    apply_tuning(args, parameters, find_model(args.model))
+    metrics = RunMetrics(args.metrics_log, args.metrics_prometheus)
+    pipe = get_pipeline(find_model(args.model), args.device, args.dtype, parameters.cpu_backend, parameters.compile_model)
+    #A heartbeat every tenth of the lease leaves plenty of margin for a slow share
+    heartbeat_s = max(1, args.lease_seconds/10)
+    try:
+        failed = run_worker(queue, pipe, parameters, args.worker_id, args.lease_seconds, heartbeat_s, poll_s=heartbeat_s, metrics=metrics)
+    finally:
+        queue.close()
+        metrics.write_summary()
+        metrics.close()
+    for file in failed:
+        logging.error("Failed: %s", file)
+    return 1 if failed else 0
+
+def open_manifest(args, create=True):
+    """Returns the JobManifest selected by the command line arguments, or None if manifests are disabled. Without create,
+        a manifest that doesn't exist yet isn't created and None is returned instead."""
+    from manifest import JobManifest, manifest_filename
+
+    if args.no_manifest:
+        return None
+    if args.manifest is not None:
+        path = args.manifest
+    else:
+        first = args.paths[0]
+        path = first if first.is_dir() else first.parent
+    if not create and not (path / manifest_filename if path.is_dir() else path).exists():
+        return None
+    return JobManifest(path)
+
+def main(argv=None):
+    """Runs the command line interface. Returns the exit status, which is nonzero if any file failed."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(levelname)s: %(message)s")
+
+    if args.language and args.language not in supported_languages:
+        logging.warning("%s is not in the list of supported languages, passing it to the model as is.", args.language)
+
+    if args.serve is not None:
+        return serve(args)
+    if not args.paths:
+        parser.error("no video files or folders given")
+
+    #--plan only reads an existing manifest, to leave out what --resume would skip, as a dry run mustn't create one
+    manifest = open_manifest(args, create=not args.plan)
+    if args.watch:
+        return watch(args, parser, manifest)
+    if args.report:
+        if manifest is None:
+            parser.error("--report needs a manifest")
+        print(manifest.report())
+        return 0
+
+    if args.retry_failed:
+        if manifest is None:
+            parser.error("--retry-failed needs a manifest")
+        videos = [path for path, _ in manifest.failed_files()]
+        missing = []
+    else:
+        videos, missing = collect_videos(args.paths, args.recursive, args.scan_index)
+    for path in missing:
+        logging.error("Not a video file or folder: %s", path)
+    if not videos:
+        logging.info("No video files found.")
+        return 1 if missing else 0
+
+    if args.autotune:
+        return run_autotune(args, videos)
+
+    if args.queue is not None:
+        return run_queue_worker(args, videos)
+
+    if args.plan:
+        from planning import plan_files
+
+        plan = plan_files(videos, parameters_from_args(args), manifest, record=False)
+        print(plan.report())
+        for file in plan.todo:
+            print(f"todo: {file}")
+        for file in plan.stale:
+            print(f"stale: {file}" if file in plan.redo else f"stale, kept: {file}")
+        return 0
+
+    #Heavy imports happen from here on, now that there is work to do
+    from subtitling import subtitle_videos
+    from metrics import RunMetrics
+
+    parameters = parameters_from_args(args)
+    apply_tuning(args, parameters, find_model(args.model))
+    metrics = RunMetrics(args.metrics_log, args.metrics_prometheus)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    try:
+        failed = subtitle_videos(videos, find_model(args.model), parameters, args.device, args.dtype, manifest, metrics)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        summary = metrics.write_summary()
+        metrics.close()
+    logging.info("%d files, %.0fs of audio in %.0fs, %.1fx real time", summary["files"], summary["audio_s"], summary["wall_s"], summary["real_time_factor"] or 0)
+
+    for file in failed:
+        logging.error("Failed: %s", file)
+    return 1 if failed or missing else 0
+
+def watch(args, parser, manifest):
+    """Runs in watch mode until stopped from the control interface or with ctrl-c."""
+    folders = [path for path in args.paths if path.is_dir()]
+    if len(folders) != len(args.paths):
+        parser.error("--watch needs folders to watch")
+
+    from models import get_pipeline
+    from watcher import WatchService
+    from metrics import RunMetrics
+
+    parameters = parameters_from_args(args)
+    apply_tuning(args, parameters, find_model(args.model))
+    metrics = RunMetrics(args.metrics_log, args.metrics_prometheus)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    #The pipeline stays loaded for the lifetime of the service
+    pipe = get_pipeline(find_model(args.model), args.device, args.dtype, parameters.cpu_backend, parameters.compile_model)
+    service = WatchService(folders, pipe, parameters, args.recursive, args.concurrency, args.watch_interval,
+                           args.settle_seconds, manifest, metrics)
+    if args.control_port is not None:
+        service.serve_control(args.control_port)
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        service.stop()
+    finally:
+        if manifest is not None:
+            manifest.close()
+        metrics.write_summary()
+        metrics.close()
+    return 0
+
+def serve(args):
+    """Runs the transcription service until interrupted with ctrl-c."""
+    import time
+
+    from models import get_pipeline
+    from service import TranscriptionService
+    from metrics import RunMetrics
+
+    #--language, --lang-mode and --task give the defaults for requests that don't choose their own
+    parameters = parameters_from_args(args)
+    apply_tuning(args, parameters, find_model(args.model))
+    metrics = RunMetrics(args.metrics_log, args.metrics_prometheus)
+    pipe = get_pipeline(find_model(args.model), args.device, args.dtype, parameters.cpu_backend, parameters.compile_model)
+    service = TranscriptionService(pipe, parameters, max_batch=parameters.batch_size, max_wait_s=args.batch_wait,
+                                   max_requests=args.max_requests, metrics=metrics)
+    service.serve(args.serve)
+    logging.info("Serving on http://127.0.0.1:%d", args.serve)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        metrics.close()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
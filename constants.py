@@ -1,6 +1,12 @@
 from pathlib import Path
 #List of video file suffices that are compatible with ffmpeg
 valid_video_file_types = {".mp4", ".mov", ".webm", ".flv", ".ogv", ".ogg", ".avi", ".m4v", ".m4a"}
+#Sample rate expected by the whisper feature extractor
+whisper_sample_rate = 16000
+#Default location of the transcription cache
+default_cache_dir = str(Path.home() / ".cache" / "whispersubs" / "transcriptions")
+#Default location of models prepared for cpu backends, e.g. quantized models
+default_prepared_model_dir = str(Path.home() / ".cache" / "whispersubs" / "prepared")
 supported_models = ["WhisperLargeV3", "WhisperLargeV3-Turbo"]
 supported_languages = ["Afrikaans", "Arabic", "Armenian", "Azerbaijani", "Belarusian", "Bosnian", "Bulgarian", "Catalan", "Chinese", "Croatian", "Czech", "Danish", "Dutch", "English", "Estonian", "Finnish", "French", "Galician", "German", "Greek", "Hebrew", "Hindi", "Hungarian", "Icelandic", "Indonesian", "Italian", "Japanese", "Kannada", "Kazakh", "Korean", "Latvian", "Lithuanian", "Macedonian", "Malay", "Marathi", "Maori", "Nepali", "Norwegian", "Persian", "Polish", "Portuguese", "Romanian", "Russian", "Serbian", "Slovak", "Slovenian", "Spanish", "Swahili", "Swedish", "Tagalog", "Tamil", "Thai", "Turkish", "Ukrainian", "Urdu", "Vietnamese", "Welsh"]
 config_defaults = {
@@ -11,4 +17,11 @@ config_defaults = {
     'replace_lang': "False",
     'selected_lang': "",
     'replace_subs': "False",
+    'processes': "1",
+    'cpu_backend': "default",
+    'assistant_model': "",
+    'job_queue': "",
+    'decode_ranges': "4",
+    'drop_repetitions': "False",
+    'guard_low_confidence': "False",
 }
@@ -0,0 +1,109 @@
+from pathlib import Path
+import logging
+import re
+
+from constants import default_prepared_model_dir
+
+#Backends available for cpu inference. "default" runs the model as loaded, "int8" applies dynamic int8 quantization
+#to the linear layers and "bf16" runs in bfloat16 on cpus with native support for it.
+supported_cpu_backends = ["default", "int8", "bf16"]
+
+def cpu_supports_bf16():
+    """Returns True if the cpu has native bfloat16 instructions (avx512_bf16 or amx_bf16). Only detected on Linux."""
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def resolve_backend(backend, device, torch_dtype):
+    """Returns the (backend, torch_dtype) actually used for backend on device. cpu backends fall back to "default"
+        on other devices, and "bf16" falls back to "default" on cpus without native bfloat16 support."""
+    import torch
+
+    if backend == "default":
+        return backend, torch_dtype
+    if backend not in supported_cpu_backends:
+        raise ValueError(f"Unknown cpu backend {backend}, expected one of {', '.join(supported_cpu_backends)}")
+    if str(device) != "cpu":
+        logging.warning("The %s backend is only used on cpu, running the default backend on %s", backend, device)
+        return "default", torch_dtype
+    if backend == "int8":
+        #Dynamic quantization starts from the float32 weights
+        return backend, torch.float32
+    if not cpu_supports_bf16():
+        logging.warning("This cpu has no native bfloat16 support, running the default backend instead")
+        return "default", torch_dtype
+    return backend, torch.bfloat16
+
+def quantize_int8(model):
+    """Applies dynamic int8 quantization to the linear layers of model. Weights are stored as int8 and activations are
+        quantized on the fly, which speeds up the matrix multiplications that dominate whisper on cpu."""
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def int8_skeleton(build_model):
+    """Returns the model build_model() returns, as quantize_int8 would leave it but without any weights: its linear layers
+        are empty dynamic int8 ones and everything else is on the meta device, to be filled in by load_state_dict(assign=True)."""
+    import torch
+
+    with torch.device("meta"):
+        model = build_model()
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            #quantize_dynamic only replaces modules whose type is exactly torch.nn.Linear
+            if type(child) is torch.nn.Linear:
+                setattr(module, name, torch.ao.nn.quantized.dynamic.Linear(child.in_features, child.out_features,
+                                                                            bias_=child.bias is not None, dtype=torch.qint8))
+    return model
+
+def prepared_model_path(model_id, backend, directory=default_prepared_model_dir):
+    """Returns where the weights of the prepared model for (model_id, backend) are cached. The torch and transformers
+        versions are part of the name, since the layout of quantized weights can change between versions."""
+    import torch
+    import transformers
+
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", f"{model_id}-{backend}-torch{torch.__version__}-transformers{transformers.__version__}")
+    return Path(directory) / f"{name}.state.pt"
+
+def load_prepared_model(model_id, backend, load_model, build_model, directory=default_prepared_model_dir):
+    """Returns the model for model_id prepared for backend, loading it from the on-disk cache if it has been prepared
+        before. Otherwise load_model() is called to get the original model, which is prepared and its state dict saved to
+        the cache. Only weights are cached, and loaded with weights_only=True, so nothing in the cache is ever unpickled as
+        code: the prepared model is rebuilt from build_model(), which returns the model's architecture, and filled in."""
+    import torch
+
+    path = prepared_model_path(model_id, backend, directory)
+    if path.exists():
+        try:
+            if backend == "int8":
+                model = int8_skeleton(build_model)
+            else:
+                with torch.device("meta"):
+                    model = build_model()
+            model.load_state_dict(torch.load(path, weights_only=True), assign=True)
+            if any(tensor.is_meta for tensor in (*model.parameters(), *model.buffers())):
+                raise ValueError("the cached weights don't cover the whole model")
+            return model
+        except Exception as e:
+            logging.warning("Could not load prepared model %s, preparing it again: %s", path, e)
+
+    model = load_model()
+    if backend == "int8":
+        model = quantize_int8(model)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + ".tmp")
+    torch.save(model.state_dict(), temp_path)
+    temp_path.replace(path)
+    return model
+
+def compile_model(model):
+    """Compiles the forward pass of model with torch.compile. Compilation happens lazily on the first call,
+        and compiled kernels are cached on disk by torch itself."""
+    import torch
+
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
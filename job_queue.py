@@ -0,0 +1,430 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+#Leases are compared against each host's own clock, so the hosts sharing a queue need their clocks kept in sync (e.g. by NTP),
+#to well within lease_s.
+
+#Seconds after which a FileJobQueue lease file that still can't be read is treated as expired
+unreadable_lease_grace_s = 60
+
+def default_worker_id():
+    """Returns a name for this worker that is unique across the hosts sharing a queue."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class JobQueue(ABC):
+    """
+    Queue of files shared between workers, possibly on different hosts. A worker claims a file with a lease of
+    lease_s seconds, renews it with heartbeat() while working on it, and finishes with complete() or fail().
+    A lease that isn't renewed in time expires, and the file can then be claimed by another worker.
+
+    Files are stored resolved, and relative to root if they are inside it, so that every spelling of a file is the
+    same job, and hosts that mount the share at different paths still agree on it. Queues kept on a share use the
+    folder holding the queue as root, so the queue should be placed at the top of the shared folder, above the videos.
+    Files outside root are stored as absolute paths, which then have to be the same on every host.
+    """
+    root = None
+
+    def _entry(self, file):
+        """Returns how file is stored in the queue."""
+        path = Path(file).resolve()
+        if self.root is not None:
+            try:
+                return path.relative_to(self.root).as_posix()
+            except ValueError:
+                pass
+        return str(path)
+
+    def _path(self, entry):
+        """Returns the path on this host of a file stored in the queue as entry."""
+        path = Path(entry)
+        return path if path.is_absolute() or self.root is None else self.root / path
+
+    @abstractmethod
+    def add(self, files):
+        """Adds files not already in the queue as pending."""
+
+    @abstractmethod
+    def claim(self, worker_id, lease_s):
+        """Claims a pending file, or a file whose lease has expired, for worker_id. Returns its path, or None if there is none."""
+
+    @abstractmethod
+    def heartbeat(self, worker_id, file, lease_s):
+        """Extends worker_id's lease on file to lease_s seconds from now. Returns False if the lease has been lost."""
+
+    @abstractmethod
+    def complete(self, worker_id, file):
+        """Records file as done. Returns False if worker_id no longer held the lease."""
+
+    @abstractmethod
+    def fail(self, worker_id, file, error):
+        """Records file as failed with error. Returns False if worker_id no longer held the lease."""
+
+    @abstractmethod
+    def counts(self):
+        """Returns the number of files in each state: pending (including expired leases), leased, done and failed."""
+
+    def close(self):
+        pass
+
+class InMemoryJobQueue(JobQueue):
+    """JobQueue held in memory, for workers that are threads of a single process, and as a stand-in for a shared queue."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        #path -> {"state", "worker", "expires", "error"}
+        self._jobs = {}
+
+    def add(self, files):
+        with self._lock:
+            for file in files:
+                self._jobs.setdefault(self._entry(file), {"state": "pending", "worker": None, "expires": None, "error": None})
+
+    def claim(self, worker_id, lease_s):
+        now = time.time()
+        with self._lock:
+            for path, job in self._jobs.items():
+                if job["state"] == "pending" or (job["state"] == "leased" and job["expires"] < now):
+                    job.update(state="leased", worker=worker_id, expires=now + lease_s)
+                    return self._path(path)
+        return None
+
+    def _holds(self, worker_id, file):
+        job = self._jobs.get(self._entry(file))
+        return job is not None and job["state"] == "leased" and job["worker"] == worker_id
+
+    def heartbeat(self, worker_id, file, lease_s):
+        with self._lock:
+            if not self._holds(worker_id, file):
+                return False
+            self._jobs[self._entry(file)]["expires"] = time.time() + lease_s
+            return True
+
+    def complete(self, worker_id, file):
+        with self._lock:
+            if not self._holds(worker_id, file):
+                return False
+            self._jobs[self._entry(file)].update(state="done", expires=None)
+            return True
+
+    def fail(self, worker_id, file, error):
+        with self._lock:
+            if not self._holds(worker_id, file):
+                return False
+            self._jobs[self._entry(file)].update(state="failed", expires=None, error=str(error))
+            return True
+
+    def counts(self):
+        now = time.time()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        with self._lock:
+            for job in self._jobs.values():
+                expired = job["state"] == "leased" and job["expires"] < now
+                counts["pending" if expired else job["state"]] += 1
+        return counts
+
+class SQLiteJobQueue(JobQueue):
+    """
+    JobQueue kept in an SQLite database, which can be on a share mounted by every host. Claims happen inside an
+    immediate transaction, so two workers can never claim the same file. SQLite's locking relies on the share
+    supporting file locks, which most SMB and NFSv4 mounts do. Otherwise use FileJobQueue.
+    """
+    def __init__(self, path: Path, timeout_s=60):
+        self.path = Path(path)
+        self.root = self.path.resolve().parent
+        self._lock = threading.Lock()
+        #Transactions are managed explicitly, so claims can take the write lock before reading
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False, timeout=timeout_s, isolation_level=None)
+        with self._lock:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS queue (
+                path TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL)""")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _transaction(self, statements):
+        """Runs statements, a function of the cursor, in an immediate transaction and returns its result."""
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(cursor)
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            return result
+
+    def add(self, files):
+        now = time.time()
+        self._transaction(lambda cursor: cursor.executemany(
+            "INSERT OR IGNORE INTO queue (path, state, updated) VALUES (?, 'pending', ?)", [(self._entry(f), now) for f in files]))
+
+    def claim(self, worker_id, lease_s):
+        def statements(cursor):
+            now = time.time()
+            row = cursor.execute("""SELECT path FROM queue WHERE state='pending' OR (state='leased' AND lease_expires < ?)
+                                    ORDER BY attempts, path LIMIT 1""", (now,)).fetchone()
+            if row is None:
+                return None
+            cursor.execute("""UPDATE queue SET state='leased', worker=?, lease_expires=?, attempts=attempts+1, updated=?
+                              WHERE path=?""", (worker_id, now + lease_s, now, row[0]))
+            return self._path(row[0])
+        return self._transaction(statements)
+
+    def _update_held(self, worker_id, file, assignments, args):
+        now = time.time()
+        def statements(cursor):
+            cursor.execute(f"UPDATE queue SET {assignments}, updated=? WHERE path=? AND worker=? AND state='leased'",
+                           (*args, now, self._entry(file), worker_id))
+            return cursor.rowcount == 1
+        return self._transaction(statements)
+
+    def heartbeat(self, worker_id, file, lease_s):
+        return self._update_held(worker_id, file, "lease_expires=?", (time.time() + lease_s,))
+
+    def complete(self, worker_id, file):
+        return self._update_held(worker_id, file, "state='done', lease_expires=NULL, error=NULL", ())
+
+    def fail(self, worker_id, file, error):
+        return self._update_held(worker_id, file, "state='failed', lease_expires=NULL, error=?", (str(error),))
+
+    def counts(self):
+        def statements(cursor):
+            return cursor.execute("""SELECT CASE WHEN state='leased' AND lease_expires < ? THEN 'pending' ELSE state END, COUNT(*)
+                                     FROM queue GROUP BY 1""", (time.time(),)).fetchall()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(dict(self._transaction(statements)))
+        return counts
+
+class FileJobQueue(JobQueue):
+    """
+    JobQueue kept as plain files in a directory on a share, for shares without reliable file locking. It relies only
+    on exclusive file creation being atomic, which holds on NFSv3 and later and on SMB. For each file there is
+    <key>.job holding its path, numbered lease files <key>.lease.<n>, and <key>.done or <key>.failed once finished.
+    A worker holds the lease while its lease file has the highest number and hasn't expired. An expired lease is
+    taken over by exclusively creating the next numbered lease file, so only one worker can win it.
+    """
+    def __init__(self, directory: Path):
+        self.directory = Path(directory).absolute()
+        self.root = self.directory.resolve().parent
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _key(self, file):
+        return hashlib.sha1(self._entry(file).encode("utf-8")).hexdigest()
+
+    def _create_exclusive(self, path, content):
+        """Creates path with content, returning False if it already exists."""
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        return True
+
+    def _leases(self, key, names):
+        """Returns the lease numbers of key among the directory entries names, highest first."""
+        prefix = f"{key}.lease."
+        return sorted((int(name[len(prefix):]) for name in names if name.startswith(prefix) and name[len(prefix):].isdigit()), reverse=True)
+
+    def _read_lease(self, key, number):
+        try:
+            with open(self.directory / f"{key}.lease.{number}", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            #Being written right now, or already cleaned up
+            return None
+
+    def _lease_expired(self, key, number, now):
+        lease = self._read_lease(key, number)
+        if lease is not None:
+            return lease["expires"] < now
+        #An unreadable lease is normally one being written right now. If it stays unreadable, its worker died while writing it.
+        try:
+            return now - (self.directory / f"{key}.lease.{number}").stat().st_mtime > unreadable_lease_grace_s
+        except OSError:
+            return False
+
+    def _write_lease(self, key, number, worker_id, lease_s):
+        lease = json.dumps({"worker": worker_id, "expires": time.time() + lease_s})
+        return self._create_exclusive(self.directory / f"{key}.lease.{number}", lease)
+
+    def add(self, files):
+        for file in files:
+            self._create_exclusive(self.directory / f"{self._key(file)}.job", self._entry(file))
+
+    def _finished(self, key, names):
+        return f"{key}.done" in names or f"{key}.failed" in names
+
+    def claim(self, worker_id, lease_s):
+        names = set(os.listdir(self.directory))
+        now = time.time()
+        for name in sorted(names):
+            if not name.endswith(".job"):
+                continue
+            key = name[:-len(".job")]
+            if self._finished(key, names):
+                continue
+            leases = self._leases(key, names)
+            if leases and not self._lease_expired(key, leases[0], now):
+                continue
+            number = leases[0] + 1 if leases else 0
+            if self._write_lease(key, number, worker_id, lease_s):
+                #The listing may be stale: a worker finishing the file writes .done before removing its lease files,
+                #after which the same lease number can be created again
+                if self._finished(key, os.listdir(self.directory)):
+                    (self.directory / f"{key}.lease.{number}").unlink(missing_ok=True)
+                    continue
+                with open(self.directory / name, encoding="utf-8") as f:
+                    return self._path(f.read())
+        return None
+
+    def _held_lease(self, worker_id, file):
+        """Returns (key, lease number) if worker_id holds the lease on file, otherwise None."""
+        key = self._key(file)
+        names = set(os.listdir(self.directory))
+        leases = self._leases(key, names)
+        if not leases or self._finished(key, names):
+            return None
+        lease = self._read_lease(key, leases[0])
+        if lease is None or lease["worker"] != worker_id:
+            return None
+        return key, leases[0]
+
+    def heartbeat(self, worker_id, file, lease_s):
+        held = self._held_lease(worker_id, file)
+        if held is None:
+            return False
+        key, number = held
+        #Only the holder ever rewrites its own lease file, so replacing it can't clobber anyone else's lease
+        temp_path = self.directory / f"{key}.lease.{number}.{worker_id}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"worker": worker_id, "expires": time.time() + lease_s}, f)
+        os.replace(temp_path, self.directory / f"{key}.lease.{number}")
+        return True
+
+    def _finish(self, worker_id, file, suffix, content):
+        held = self._held_lease(worker_id, file)
+        if held is None:
+            return False
+        key, _ = held
+        self._create_exclusive(self.directory / f"{key}.{suffix}", content)
+        for number in self._leases(key, os.listdir(self.directory)):
+            try:
+                (self.directory / f"{key}.lease.{number}").unlink()
+            except FileNotFoundError:
+                pass
+        return True
+
+    def complete(self, worker_id, file):
+        return self._finish(worker_id, file, "done", worker_id)
+
+    def fail(self, worker_id, file, error):
+        return self._finish(worker_id, file, "failed", str(error))
+
+    def counts(self):
+        names = set(os.listdir(self.directory))
+        now = time.time()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        for name in names:
+            if not name.endswith(".job"):
+                continue
+            key = name[:-len(".job")]
+            if f"{key}.done" in names:
+                counts["done"] += 1
+            elif f"{key}.failed" in names:
+                counts["failed"] += 1
+            else:
+                leases = self._leases(key, names)
+                counts["leased" if leases and not self._lease_expired(key, leases[0], now) else "pending"] += 1
+        return counts
+
+def open_queue(path: Path):
+    """Opens the shared queue at path: an SQLiteJobQueue for a .sqlite or .db file, and a FileJobQueue for anything else."""
+    path = Path(path)
+    if path.suffix in (".sqlite", ".db"):
+        return SQLiteJobQueue(path)
+    return FileJobQueue(path)
+
+class _Heartbeat:
+    """Renews worker_id's lease on file every interval_s seconds on a background thread while the enclosed block runs."""
+    def __init__(self, queue, worker_id, file, lease_s, interval_s):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.file = file
+        self.lease_s = lease_s
+        self.interval_s = interval_s
+        self.lost = False
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                if not self.queue.heartbeat(self.worker_id, self.file, self.lease_s):
+                    self.lost = True
+                    return
+            except Exception as e:
+                #A transient error on the share, the lease stays valid until it expires
+                logging.warning("Heartbeat for %s failed: %s", self.file, e)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+def run_worker(queue: JobQueue, pipe, parameters, worker_id=None, lease_s=600, heartbeat_s=60, poll_s=30, metrics=None):
+    """
+    Claims files from queue and subtitles them one at a time, until every file in the queue is done or failed.
+    While other workers hold leases, it keeps polling every poll_s seconds so that it can take over any that expire.
+    Intermediary files are named after worker_id, so workers on different hosts never share them. Returns the list of
+    files that failed in this worker.
+    """
+    from subtitling import subtitle_files
+
+    worker_id = worker_id or default_worker_id()
+    parameters = dataclasses.replace(parameters, worker_id=worker_id)
+    failed = []
+    while True:
+        file = queue.claim(worker_id, lease_s)
+        if file is None:
+            counts = queue.counts()
+            if counts["pending"] == 0 and counts["leased"] == 0:
+                return failed
+            time.sleep(poll_s)
+            continue
+
+        logging.info("%s claimed %s", worker_id, file)
+        error = None
+        with _Heartbeat(queue, worker_id, file, lease_s, heartbeat_s) as heartbeat:
+            try:
+                if subtitle_files([file], pipe, parameters, metrics=metrics):
+                    error = "failed, see the worker's log"
+            except Exception as e:
+                logging.error('Error at %s', file, exc_info=e)
+                error = repr(e)
+        if heartbeat.lost:
+            logging.warning("%s lost its lease on %s while working on it", worker_id, file)
+        if error is None:
+            queue.complete(worker_id, file)
+        else:
+            queue.fail(worker_id, file, error)
+            failed.append(file)
@@ -0,0 +1,59 @@
+import math
+
+import numpy as np
+import torch
+from transformers.models.whisper.tokenization_whisper import LANGUAGES
+
+from constants import whisper_sample_rate
+
+#Windows quieter than this RMS level are assumed to contain no speech, and are only used if every window is this quiet
+silence_rms = 1e-3
+
+def sample_windows(audio, num_windows, window_s=30):
+    """Returns up to num_windows (start_s, window) pairs of window_s seconds, spread evenly across audio."""
+    window = int(window_s*whisper_sample_rate)
+    if len(audio) <= window:
+        return [(0.0, audio)]
+    num_windows = max(1, min(num_windows, math.ceil(len(audio)/window)))
+    starts = np.linspace(0, len(audio) - window, num_windows).astype(int)
+    windows = [(start/whisper_sample_rate, audio[start:start+window]) for start in starts]
+
+    voiced = [(start, w) for start, w in windows if np.sqrt(np.mean(np.square(w, dtype=np.float64))) >= silence_rms]
+    return voiced if voiced else windows
+
+def language_probabilities(windows, pipe):
+    """Runs only the whisper encoder and a single decoder step on each window, and returns (language_names, probabilities),
+        where probabilities is a tensor of shape (len(windows), len(language_names)) with the language token distribution of each window."""
+    model = pipe.model
+    generation_config = model.generation_config
+    lang_to_id = generation_config.lang_to_id
+    language_names = [LANGUAGES[token[2:-2]] for token in lang_to_id]
+    lang_ids = torch.tensor(list(lang_to_id.values()), device=model.device)
+
+    features = pipe.feature_extractor(windows, sampling_rate=whisper_sample_rate, return_tensors="pt").input_features
+    features = features.to(model.device, dtype=model.dtype)
+    decoder_input_ids = torch.full((len(windows), 1), generation_config.decoder_start_token_id, device=model.device)
+
+    with torch.no_grad():
+        encoder_outputs = model.get_encoder()(features)
+        logits = model(encoder_outputs=encoder_outputs, decoder_input_ids=decoder_input_ids).logits[:, -1]
+    probabilities = logits[:, lang_ids].float().softmax(dim=-1).cpu()
+    return language_names, probabilities
+
+def detect_language(audio, pipe, num_windows=8, confidence=0.9, batch_size=4):
+    """Detects the single language spoken in audio from the language token alone, without transcribing anything.
+        Up to num_windows 30 second windows spread across the audio are examined batch_size at a time, stopping early once the
+        averaged probability of the most likely language reaches confidence. Returns (language, [(start_s, window_language), ...])."""
+    windows = sample_windows(audio, num_windows)
+    total = None
+    window_langs = []
+    for i in range(0, len(windows), batch_size):
+        batch = windows[i:i+batch_size]
+        language_names, probabilities = language_probabilities([w for _, w in batch], pipe)
+        total = probabilities.sum(dim=0) if total is None else total + probabilities.sum(dim=0)
+        window_langs.extend((start, language_names[p.argmax()]) for (start, _), p in zip(batch, probabilities))
+
+        mean = total/len(window_langs)
+        if mean.max() >= confidence:
+            break
+    return language_names[mean.argmax()], window_langs
@@ -1,10 +1,10 @@
-import argparse
-from pathlib import Path
-
-from subtitling import create_subtitles, SubbingParameters
-from utils import find_model
-from appui import appUI
+import sys
 
 if __name__ == "__main__":
+    #With any command line arguments run headless, without importing the GUI at all
+    if len(sys.argv) > 1:
+        from cli import main
+        sys.exit(main())
+
+    from appui import appUI
     UI = appUI()
-    
\ No newline at end of file
@@ -0,0 +1,107 @@
+from pathlib import Path
+import hashlib
+import sqlite3
+import threading
+import time
+
+manifest_filename = "whispersubs_manifest.sqlite"
+
+def file_checksum(path: Path):
+    """Returns the sha256 hex digest of the file at path."""
+    digest = hashlib.sha256()
+    with path.open(mode="rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class JobManifest:
+    """
+    Records the state of every file in a run in an SQLite database, by default whispersubs_manifest.sqlite in the
+    target folder, so that an interrupted run can be resumed, failures retried and progress reported.
+    Each file is pending, running, done or failed, together with its timing, last error and the checksum of its subtitle file.
+    """
+    def __init__(self, path: Path):
+        path = Path(path)
+        self.path = path / manifest_filename if path.is_dir() else path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                path TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                started REAL,
+                finished REAL,
+                duration REAL,
+                error TEXT,
+                output TEXT,
+                checksum TEXT)""")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, sql, args=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, args).fetchall()
+
+    def add(self, files):
+        """Adds files not already in the manifest as pending."""
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO jobs (path, state) VALUES (?, 'pending')", [(str(f),) for f in files])
+
+    def mark_running(self, file, started=None):
+        """Records file as running, having started at time started, or now if started is None."""
+        started = time.time() if started is None else started
+        self._execute("""INSERT INTO jobs (path, state, attempts, started) VALUES (?, 'running', 1, ?)
+                         ON CONFLICT(path) DO UPDATE SET state='running', attempts=attempts+1, started=excluded.started,
+                         finished=NULL, duration=NULL, error=NULL""", (str(file), started))
+
+    def mark_done(self, file, output: Path):
+        finished = time.time()
+        self._execute("""UPDATE jobs SET state='done', finished=?, duration=?-started, error=NULL, output=?, checksum=?
+                         WHERE path=?""", (finished, finished, str(output), file_checksum(output), str(file)))
+
+    def mark_failed(self, file, error):
+        finished = time.time()
+        self._execute("""UPDATE jobs SET state='failed', finished=?, duration=?-started, error=? WHERE path=?""",
+                      (finished, finished, error if isinstance(error, str) else repr(error), str(file)))
+
+    def state(self, file):
+        """Returns the recorded state of file, or None if it isn't in the manifest."""
+        rows = self._execute("SELECT state FROM jobs WHERE path=?", (str(file),))
+        return rows[0][0] if rows else None
+
+    def is_done(self, file):
+        """Returns True if file is recorded as done and its subtitle file still matches the recorded checksum."""
+        rows = self._execute("SELECT output, checksum FROM jobs WHERE path=? AND state='done'", (str(file),))
+        if not rows:
+            return False
+        output, checksum = rows[0]
+        try:
+            return file_checksum(Path(output)) == checksum
+        except OSError:
+            return False
+
+    def failed_files(self):
+        """Returns (path, error) for every file recorded as failed."""
+        return [(Path(path), error) for path, error in self._execute("SELECT path, error FROM jobs WHERE state='failed' ORDER BY path")]
+
+    def summary(self):
+        """Returns a dict with the number of files in each state, and the total processing time of finished files."""
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        for state, count in self._execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            counts[state] = count
+        counts["seconds"] = self._execute("SELECT COALESCE(SUM(duration), 0) FROM jobs WHERE state IN ('done', 'failed')")[0][0]
+        return counts
+
+    def report(self):
+        """Returns a human readable progress report."""
+        summary = self.summary()
+        total = summary["pending"] + summary["running"] + summary["done"] + summary["failed"]
+        lines = [f"{self.path}",
+                 f"{summary['done']}/{total} done, {summary['failed']} failed, {summary['running']} running/interrupted, {summary['pending']} pending",
+                 f"Processing time: {summary['seconds']:.0f}s"]
+        for path, error in self.failed_files():
+            lines.append(f"Failed: {path}: {error}")
+        return "\n".join(lines)
@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+from pathlib import Path
+import json
+import os
+import time
+
+from constants import valid_video_file_types
+
+#Folder mtimes only have the resolution of the filesystem clock, so a folder changed within this long of being listed
+#could have the same mtime before and after the change. Such listings aren't trusted, as with git's racily clean entries.
+mtime_resolution_ns = 2*10**9
+
+@dataclass
+class ScannedVideo:
+    path: Path
+    size: int
+    mtime_ns: int
+    srt_mtime_ns: int = None
+
+    @property
+    def has_srt(self):
+        return self.srt_mtime_ns is not None
+
+def _scan_directory(directory):
+    """Lists directory once, returning its index entry: the videos in it with their size and mtime, the mtime of each
+        .srt file, and its subdirectories."""
+    videos = []
+    srts = {}
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                if not entry.is_file():
+                    continue
+                suffix = os.path.splitext(entry.name)[1].lower()
+                if suffix in valid_video_file_types:
+                    stat = entry.stat()
+                    videos.append([entry.name, stat.st_size, stat.st_mtime_ns])
+                elif suffix == ".srt":
+                    srts[entry.name] = entry.stat().st_mtime_ns
+            except OSError:
+                #Entries can disappear or be unreadable while scanning, they are simply left out
+                continue
+    return {"videos": sorted(videos), "srts": srts, "subdirs": sorted(subdirs)}
+
+def scan_videos(path: Path, include_subfolders, index_path=None, index=None, subtitle_suffix=".srt"):
+    """Finds all video files in path, and all of its subfolders if include_subfolders, in a single os.scandir pass per folder.
+        Suffixes are matched case-insensitively, and whether each video already has subtitles, video_name + subtitle_suffix
+        such as .srt or .en.srt, is found in the same pass.
+        If index_path is given, the listing of every folder is persisted there together with the folder's mtime, and folders
+        whose mtime hasn't changed since the last scan are taken from the index without being listed again. Alternatively an
+        in-memory index dict can be given as index, which is updated in place. Returns a list of ScannedVideo."""
+    if index is None:
+        index = load_index(index_path) if index_path is not None else {}
+    new_index = {}
+    scanned = []
+    pending = [Path(path)]
+    while pending:
+        directory = pending.pop()
+        try:
+            mtime_ns = directory.stat().st_mtime_ns
+        except OSError:
+            continue
+        entry = index.get(str(directory))
+        if (entry is None or entry["mtime_ns"] != mtime_ns
+                or entry.get("scanned_ns", 0) - mtime_ns < mtime_resolution_ns):
+            scanned_ns = time.time_ns()
+            try:
+                entry = _scan_directory(directory)
+            except OSError:
+                continue
+            entry["mtime_ns"] = mtime_ns
+            entry["scanned_ns"] = scanned_ns
+        new_index[str(directory)] = entry
+
+        for name, size, video_mtime_ns in entry["videos"]:
+            srt_name = os.path.splitext(name)[0] + subtitle_suffix
+            scanned.append(ScannedVideo(directory / name, size, video_mtime_ns, entry["srts"].get(srt_name)))
+        if include_subfolders:
+            pending.extend(directory / name for name in reversed(entry["subdirs"]))
+
+    #Entries for folders outside this scan are kept, so one index can serve several roots
+    index.update(new_index)
+    if index_path is not None:
+        save_index(index_path, index)
+    return scanned
+
+def load_index(index_path):
+    """Loads a scan index written by save_index, returning an empty index if it is missing or unreadable."""
+    try:
+        with open(index_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_index(index_path, index):
+    """Writes the scan index to index_path, replacing any previous one atomically."""
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(temp_path, index_path)
@@ -0,0 +1,285 @@
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+    #Unix only, and gives the true peak where psutil only has the current resident memory
+    import resource
+except ImportError:
+    resource = None
+
+#Stages recorded for each file, in the order they happen
+stages = ["decode", "vad", "cache_lookup", "language_detection", "whisper", "write_subs"]
+
+def _cuda_torch():
+    """Returns torch if cuda is in use, otherwise None. torch is only looked at if it has been imported already, importing
+        it just for this would defeat lazy loading."""
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch
+    return None
+
+def _rss_bytes():
+    """Returns the current resident memory of the process in bytes."""
+    import psutil
+    return psutil.Process().memory_info().rss
+
+def peak_memory():
+    """Returns a dict with the peak resident memory of the process since it started, and the peak cuda memory allocated by
+        torch if cuda is in use, in bytes. Used for the run as a whole, each file's own peak is tracked by RunMetrics."""
+    if resource is not None:
+        #ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 1 if platform.system() == "Darwin" else 1024
+        memory = {"peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale}
+    else:
+        import psutil
+        #On Windows the peak working set is the equivalent of the peak resident memory
+        info = psutil.Process().memory_info()
+        memory = {"peak_rss_bytes": getattr(info, "peak_wset", info.rss)}
+    torch = _cuda_torch()
+    if torch is not None:
+        memory["peak_cuda_bytes"] = torch.cuda.max_memory_allocated()
+    return memory
+
+def measure(metrics, file, stage):
+    """Context manager timing stage of file in metrics, doing nothing if metrics is None."""
+    if metrics is None:
+        return nullcontext()
+    return metrics.stage(file, stage)
+
+class RunMetrics:
+    """
+    Records the wall time of each processing stage for every file of a run, together with its audio duration,
+    real-time factor, number of tokens generated and peak memory. Each finished file is appended as a json line to
+    log_path if given, and summary() aggregates the whole run. Metrics can also be exported in the Prometheus text format,
+    either written to a file for the node exporter's textfile collector or served over http.
+
+    The peak memory of a file is the highest resident memory of the process seen while the file was being processed,
+    sampled every memory_interval_s seconds by a background thread that runs while any file is, and on cuda the highest
+    memory allocated by torch in that time. Files processed at the same time share their peaks.
+    """
+    def __init__(self, log_path=None, prometheus_path=None, memory_interval_s=0.05):
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.memory_interval_s = memory_interval_s
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._records = {}
+        self._finished = []
+        self._server = None
+        self._sampler = None
+
+    def _record(self, file):
+        """Returns the record of file, opening it if needed. Called with the lock held."""
+        file = str(file)
+        if file not in self._records:
+            self._start_memory()
+            self._records[file] = {"file": file, "started": time.time(), "stages": {}, "audio_s": None, "tokens": None}
+        return self._records[file]
+
+    def _start_memory(self):
+        """Starts tracking peak memory for a file about to be opened. Called with the lock held."""
+        torch = _cuda_torch()
+        if torch is not None:
+            #The files already open keep the peak so far, before it is reset for the new one
+            peak = torch.cuda.max_memory_allocated()
+            for record in self._records.values():
+                record["peak_cuda_bytes"] = max(record.get("peak_cuda_bytes", 0), peak)
+            torch.cuda.reset_peak_memory_stats()
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_memory, daemon=True)
+            self._sampler.start()
+
+    def _sample_memory(self):
+        """Raises the peak resident memory of every open file to the current one every memory_interval_s seconds, until
+            no file is open."""
+        while True:
+            rss = _rss_bytes()
+            with self._lock:
+                if not self._records:
+                    self._sampler = None
+                    return
+                for record in self._records.values():
+                    record["peak_rss_bytes"] = max(record.get("peak_rss_bytes", 0), rss)
+            time.sleep(self.memory_interval_s)
+
+    @contextmanager
+    def stage(self, file, stage):
+        """Times the enclosed block as stage of file. Time spent in the same stage more than once is added up."""
+        with self._lock:
+            self._record(file)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(file, stage, time.perf_counter() - start)
+
+    def add_time(self, file, stage, seconds):
+        with self._lock:
+            record_stages = self._record(file)["stages"]
+            record_stages[stage] = record_stages.get(stage, 0.0) + seconds
+
+    def set(self, file, **values):
+        """Sets values such as audio_s or tokens for file."""
+        with self._lock:
+            self._record(file).update(values)
+
+    def add(self, file, **values):
+        """Adds values such as decoder_steps_saved to those already recorded for file."""
+        with self._lock:
+            record = self._record(file)
+            for key, value in values.items():
+                record[key] = (record.get(key) or 0) + value
+
+    def finish_file(self, file, status="done"):
+        """Marks file as finished, computing its totals and appending it to the json lines log."""
+        rss = _rss_bytes()
+        with self._lock:
+            record = self._records.pop(str(file), None)
+            if record is None:
+                record = {"file": str(file), "started": time.time(), "stages": {}, "audio_s": None, "tokens": None}
+            record["status"] = status
+            record["wall_s"] = time.time() - record["started"]
+            processing_s = sum(record["stages"].values())
+            record["real_time_factor"] = record["audio_s"]/processing_s if record["audio_s"] and processing_s else None
+            record["peak_rss_bytes"] = max(record.get("peak_rss_bytes", 0), rss)
+            torch = _cuda_torch()
+            if torch is not None:
+                record["peak_cuda_bytes"] = max(record.get("peak_cuda_bytes", 0), torch.cuda.max_memory_allocated())
+        self.add_finished([record])
+
+    def add_finished(self, records):
+        """Adds records of finished files to the run and appends them to the json lines log. Used by finish_file, and to
+            gather the records of files finished in worker processes, see take_finished."""
+        with self._lock:
+            self._finished.extend(records)
+            if self.log_path is not None:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    for record in records:
+                        f.write(json.dumps(record) + "\n")
+        if self.prometheus_path is not None:
+            self.write_prometheus()
+
+    def take_finished(self):
+        """Returns the records of the files finished so far, and removes them from this RunMetrics."""
+        with self._lock:
+            records, self._finished = self._finished, []
+        return records
+
+    def summary(self):
+        """Returns a dict aggregating every finished file of the run."""
+        with self._lock:
+            finished = list(self._finished)
+        stage_totals = {}
+        for record in finished:
+            for stage, seconds in record["stages"].items():
+                stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+        audio_s = sum(record["audio_s"] or 0 for record in finished)
+        processing_s = sum(stage_totals.values())
+        return {
+            "files": len(finished),
+            "done": sum(record["status"] == "done" for record in finished),
+            "skipped": sum(record["status"] == "skipped" for record in finished),
+            "failed": sum(record["status"] == "failed" for record in finished),
+            "wall_s": time.time() - self.started,
+            "audio_s": audio_s,
+            "tokens": sum(record["tokens"] or 0 for record in finished),
+            "decoder_steps_saved": sum(record.get("decoder_steps_saved") or 0 for record in finished),
+            "guard_stops": sum(record.get("guard_stops") or 0 for record in finished),
+            "stage_s": stage_totals,
+            "real_time_factor": audio_s/processing_s if processing_s else None,
+            **peak_memory(),
+        }
+
+    def write_summary(self):
+        """Appends the run summary to the json lines log, and returns it."""
+        summary = self.summary()
+        if self.log_path is not None:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"summary": summary}) + "\n")
+        if self.prometheus_path is not None:
+            self.write_prometheus()
+        return summary
+
+    def prometheus_text(self):
+        """Returns the run metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = [
+            "# HELP whispersubs_files_total Files finished in this run.",
+            "# TYPE whispersubs_files_total counter",
+            f'whispersubs_files_total{{status="done"}} {summary["done"]}',
+            f'whispersubs_files_total{{status="skipped"}} {summary["skipped"]}',
+            f'whispersubs_files_total{{status="failed"}} {summary["failed"]}',
+            "# HELP whispersubs_audio_seconds_total Seconds of audio processed in this run.",
+            "# TYPE whispersubs_audio_seconds_total counter",
+            f"whispersubs_audio_seconds_total {summary['audio_s']}",
+            "# HELP whispersubs_tokens_total Tokens generated in this run.",
+            "# TYPE whispersubs_tokens_total counter",
+            f"whispersubs_tokens_total {summary['tokens']}",
+            "# HELP whispersubs_decoder_steps_saved_total Decoder steps saved by stopping windows that degenerated into repetition.",
+            "# TYPE whispersubs_decoder_steps_saved_total counter",
+            f"whispersubs_decoder_steps_saved_total {summary['decoder_steps_saved']}",
+            "# HELP whispersubs_guard_stops_total Windows stopped early because they degenerated into repetition.",
+            "# TYPE whispersubs_guard_stops_total counter",
+            f"whispersubs_guard_stops_total {summary['guard_stops']}",
+            "# HELP whispersubs_stage_seconds_total Wall time spent in each processing stage.",
+            "# TYPE whispersubs_stage_seconds_total counter",
+        ]
+        for stage, seconds in summary["stage_s"].items():
+            lines.append(f'whispersubs_stage_seconds_total{{stage="{stage}"}} {seconds}')
+        lines += [
+            "# HELP whispersubs_real_time_factor Seconds of audio processed per second of processing.",
+            "# TYPE whispersubs_real_time_factor gauge",
+            f"whispersubs_real_time_factor {summary['real_time_factor'] or 0}",
+            "# HELP whispersubs_peak_rss_bytes Peak resident memory of the process.",
+            "# TYPE whispersubs_peak_rss_bytes gauge",
+            f"whispersubs_peak_rss_bytes {summary['peak_rss_bytes']}",
+        ]
+        if "peak_cuda_bytes" in summary:
+            lines += [
+                "# HELP whispersubs_peak_cuda_bytes Peak cuda memory allocated by torch.",
+                "# TYPE whispersubs_peak_cuda_bytes gauge",
+                f"whispersubs_peak_cuda_bytes {summary['peak_cuda_bytes']}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """Writes prometheus_text() to prometheus_path, replacing the file atomically so it is never read half written."""
+        temp_path = f"{self.prometheus_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, self.prometheus_path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves prometheus_text() at http://host:port/metrics on a background thread."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
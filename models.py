@@ -0,0 +1,173 @@
+from collections import OrderedDict
+import gc
+import threading
+
+import psutil
+
+from cpu_backends import resolve_backend, load_prepared_model, compile_model
+
+#torch and transformers are imported inside the functions that need them, so that importing this module stays fast
+#and nothing heavy is loaded until a model is actually requested.
+
+#Number of pipelines kept resident at once. Loading another model beyond this evicts the least recently used one,
+#so switching models in the UI frees the previous one.
+max_loaded_models = 1
+#Minimum amount of free memory (in bytes) on the target device before a new model is loaded.
+#Resident pipelines are evicted, least recently used first, until this much is free.
+min_free_memory = 2*1024**3
+#Most tokens generated for each window of audio
+max_new_tokens = 128
+
+_loaded_pipelines = OrderedDict()
+#Draft models for assisted generation, keyed by (model_id, device, torch_dtype). They are small next to the models they
+#assist, and are only dropped by evict_model.
+_assistant_models = {}
+_registry_lock = threading.RLock()
+
+def default_device():
+    """Returns the (device, torch_dtype) pair used when none is specified: cuda in float16 if available, otherwise cpu in float32."""
+    import torch
+    if torch.cuda.is_available():
+        return "cuda:0", torch.float16
+    return "cpu", torch.float32
+
+def default_dtype(device):
+    """Returns the torch_dtype used on device when none is specified: float16 on cuda and float32 anywhere else."""
+    import torch
+    return torch.float16 if str(device).startswith("cuda") else torch.float32
+
+def _free_memory(device):
+    """Returns free memory in bytes on device."""
+    import torch
+    if str(device).startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    return psutil.virtual_memory().available
+
+def _build_pipeline(model_id, device, torch_dtype, backend="default", compile=False):
+    """Loads model and processor for model_id and wraps them in an automatic-speech-recognition pipeline.
+        Models for cpu backends other than "default" are prepared once and then loaded from an on-disk cache."""
+    from transformers import AutoModelForSpeechSeq2Seq
+
+    def load_model():
+        return AutoModelForSpeechSeq2Seq.from_pretrained(
+            model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
+        )
+
+    def build_model():
+        from transformers import AutoConfig, GenerationConfig
+
+        model = AutoModelForSpeechSeq2Seq.from_config(AutoConfig.from_pretrained(model_id), torch_dtype=torch_dtype)
+        #from_config leaves out the generation config, which holds whisper's language and task tokens
+        model.generation_config = GenerationConfig.from_pretrained(model_id)
+        return model
+
+    if backend == "int8":
+        model = load_prepared_model(model_id, backend, load_model, build_model)
+    else:
+        model = load_model()
+    model.to(device)
+    model.eval()
+
+    if compile:
+        model = compile_model(model)
+
+    return wrap_pipeline(model, model_id, device, torch_dtype)
+
+def wrap_pipeline(model, model_id, device, torch_dtype):
+    """Wraps an already loaded model in an automatic-speech-recognition pipeline, using the processor for model_id."""
+    from transformers import pipeline
+    from transformers import AutoProcessor
+
+    processor = AutoProcessor.from_pretrained(model_id)
+
+    return pipeline(
+        "automatic-speech-recognition",
+        model=model,
+        tokenizer=processor.tokenizer,
+        feature_extractor=processor.feature_extractor,
+        max_new_tokens=max_new_tokens,
+        chunk_length_s=10,
+        #stride_length_s=2,
+        batch_size=1,
+        return_timestamps=True,
+        torch_dtype=torch_dtype,
+        device=device,
+    )
+
+def resolve_dtype(torch_dtype):
+    """Converts a dtype name such as "float16" to the corresponding torch dtype. torch dtypes and None are returned unchanged."""
+    if isinstance(torch_dtype, str):
+        import torch
+        return getattr(torch, torch_dtype)
+    return torch_dtype
+
+def get_pipeline(model_id, device=None, torch_dtype=None, backend="default", compile=False):
+    """Returns the whisper pipeline for (model_id, device, torch_dtype, backend, compile), building it on first use and keeping it
+        resident for later calls. Other resident pipelines are evicted as needed to respect max_loaded_models and min_free_memory.
+        torch_dtype can also be given by name, e.g. "float16". backend selects a cpu backend from cpu_backends.supported_cpu_backends,
+        and compile=True compiles the model with torch.compile."""
+    torch_dtype = resolve_dtype(torch_dtype)
+    if device is None:
+        device = default_device()[0]
+    if torch_dtype is None:
+        torch_dtype = default_dtype(device)
+    backend, torch_dtype = resolve_backend(backend, device, torch_dtype)
+    key = (model_id, str(device), torch_dtype, backend, compile)
+
+    with _registry_lock:
+        if key in _loaded_pipelines:
+            _loaded_pipelines.move_to_end(key)
+            return _loaded_pipelines[key]
+
+        while len(_loaded_pipelines) >= max_loaded_models:
+            _evict_oldest()
+        while _loaded_pipelines and _free_memory(device) < min_free_memory:
+            _evict_oldest()
+
+        pipe = _build_pipeline(model_id, device, torch_dtype, backend, compile)
+        _loaded_pipelines[key] = pipe
+        return pipe
+
+def get_assistant_model(model_id, device, torch_dtype):
+    """Returns the draft model model_id for assisted generation, loaded on device in torch_dtype to match the model it
+        assists, building it on first use and keeping it resident for later calls. The draft has to share its tokenizer
+        with the main model, as WhisperLargeV3-Turbo and the distil-whisper checkpoints do with WhisperLargeV3."""
+    from transformers import AutoModelForSpeechSeq2Seq
+
+    key = (model_id, str(device), torch_dtype)
+    with _registry_lock:
+        if key not in _assistant_models:
+            model = AutoModelForSpeechSeq2Seq.from_pretrained(
+                model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
+            )
+            model.to(device)
+            model.eval()
+            _assistant_models[key] = model
+        return _assistant_models[key]
+
+def _evict_oldest():
+    _loaded_pipelines.popitem(last=False)
+    _release_memory()
+
+def evict_model(model_id=None):
+    """Removes resident pipelines and draft models for model_id, or all of them if model_id is None."""
+    with _registry_lock:
+        for key in list(_loaded_pipelines):
+            if model_id is None or key[0] == model_id:
+                del _loaded_pipelines[key]
+        for key in list(_assistant_models):
+            if model_id is None or key[0] == model_id:
+                del _assistant_models[key]
+        _release_memory()
+
+def loaded_models():
+    """Returns the (model_id, device, torch_dtype, backend, compile) keys of the currently resident pipelines, least recently used first."""
+    with _registry_lock:
+        return list(_loaded_pipelines)
+
+def _release_memory():
+    import torch
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,91 @@
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+from constants import valid_video_file_types
+
+@dataclass
+class SubtitlePlan:
+    """
+    Which of a list of video files need work, worked out from cheap filesystem checks before any audio is decoded.
+    todo files have no subtitles yet (or are being replaced), stale files have subtitles older than the video, and skip
+    files are left alone. Stale subtitles are only regenerated if the plan was made with parameters.replace_stale, as they
+    may have been edited by hand, and are also in skip otherwise. needs_lang lists the files to process that will need a
+    language detection pass because no usable language file exists.
+    """
+    todo: list = field(default_factory=list)
+    stale: list = field(default_factory=list)
+    skip: list = field(default_factory=list)
+    needs_lang: list = field(default_factory=list)
+    #Stale files to be regenerated, as a set since it is looked up for every file
+    redo: set = field(default_factory=set)
+
+    def files(self):
+        """Returns the files that need processing, in order."""
+        return self.todo + [file for file in self.stale if file in self.redo]
+
+    def parameters_for(self, file, parameters):
+        """Returns the parameters to process file with. Stale subtitles being regenerated have to be replaced even if
+            parameters.replace is False."""
+        if file in self.redo and not parameters.replace:
+            return replace(parameters, replace=True)
+        return parameters
+
+    def report(self):
+        stale = f"{len(self.stale)} stale ({len(self.redo)} to redo)" if self.redo else f"{len(self.stale)} stale (kept, see --replace-stale)"
+        return (f"Plan: {len(self.todo)} to do, {stale}, {len(self.skip)} skipped, "
+                f"{len(self.needs_lang)} needing language detection")
+
+def subtitle_suffix(parameters):
+    """Returns the suffix of the subtitle file whose presence means a video is finished: .srt, or .en.srt in bilingual mode,
+        where it is written alongside video_name.<language>.srt."""
+    if parameters is not None and parameters.bilingual:
+        return ".en.srt"
+    return ".srt"
+
+def subtitle_path(file: Path, parameters):
+    """Returns the subtitle file whose presence means file is finished, see subtitle_suffix."""
+    return file.with_suffix(subtitle_suffix(parameters))
+
+def _mtime_ns(path: Path):
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+def plan_files(files, parameters, manifest=None, record=True):
+    """Works out which outputs are needed for each of files from filesystem metadata alone. Files that aren't videos are
+        left out with a warning. With a JobManifest, all videos are added to it unless record is False, and with
+        parameters.resume files it records as done or failed are skipped. Returns a SubtitlePlan."""
+    plan = SubtitlePlan()
+    videos = []
+    for file in files:
+        if file.suffix.lower() in valid_video_file_types:
+            videos.append(file)
+        else:
+            print("Warning: Input file format not recognized")
+
+    if manifest is not None and record:
+        manifest.add(videos)
+
+    needs_detection = not parameters.multi_lang and not parameters.provide_lang
+    for file in videos:
+        if manifest is not None and parameters.resume and (manifest.state(file) == "failed" or manifest.is_done(file)):
+            plan.skip.append(file)
+            continue
+
+        srt_mtime_ns = _mtime_ns(subtitle_path(file, parameters))
+        if srt_mtime_ns is None or parameters.replace:
+            plan.todo.append(file)
+        elif srt_mtime_ns < (_mtime_ns(file) or 0):
+            plan.stale.append(file)
+            if not parameters.replace_stale:
+                plan.skip.append(file)
+                continue
+            plan.redo.add(file)
+        else:
+            plan.skip.append(file)
+            continue
+
+        if needs_detection and (parameters.replace_lang or not file.with_name(file.stem+"lang.txt").exists()):
+            plan.needs_lang.append(file)
+    return plan
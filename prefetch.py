@@ -0,0 +1,72 @@
+import threading
+
+from constants import whisper_sample_rate
+
+class AudioPrefetcher:
+    """
+    Decodes audio for a list of files on a small pool of background threads, so that the next files are
+    already decoded while the model works on the current one. Iterating yields (file, audio, error) in the
+    original order, where error is the exception raised while decoding (and audio is None) if decoding failed.
+    At most roughly max_buffered_s seconds of decoded audio are held at once, not counting the file currently
+    being consumed and the files currently being decoded.
+    """
+    def __init__(self, files, decode, workers=2, max_buffered_s=7200):
+        self.files = list(files)
+        self._decode = decode
+        self._max_buffered_samples = int(max_buffered_s*whisper_sample_rate)
+        self._buffered_samples = 0
+        self._results = {}
+        self._next_to_claim = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                #Wait for room in the buffer before claiming more work. Files are claimed in order, so the file the
+                #consumer is waiting on has always been claimed already and can never be blocked by this.
+                while not self._closed and self._buffered_samples >= self._max_buffered_samples:
+                    self._condition.wait()
+                if self._closed or self._next_to_claim >= len(self.files):
+                    return
+                index = self._next_to_claim
+                self._next_to_claim += 1
+
+            try:
+                result = (self._decode(self.files[index]), None)
+            except Exception as e:
+                result = (None, e)
+
+            with self._condition:
+                if result[0] is not None:
+                    self._buffered_samples += len(result[0])
+                self._results[index] = result
+                self._condition.notify_all()
+
+    def __iter__(self):
+        try:
+            for index, file in enumerate(self.files):
+                with self._condition:
+                    while index not in self._results:
+                        self._condition.wait()
+                    audio, error = self._results.pop(index)
+                yield file, audio, error
+                #The consumer has finished with this file, so its audio no longer counts against the buffer
+                if audio is not None:
+                    with self._condition:
+                        self._buffered_samples -= len(audio)
+                        self._condition.notify_all()
+                del audio
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the background decoders from claiming any further files."""
+        with self._condition:
+            self._closed = True
+            self._results.clear()
+            self._condition.notify_all()
@@ -0,0 +1,166 @@
+import zlib
+
+import torch
+from transformers import LogitsProcessor
+
+#Defaults follow whisper's own thresholds for rejecting a decoded window
+default_compression_ratio_threshold = 2.4
+default_logprob_threshold = -1.0
+#Seconds between consecutive whisper timestamp tokens
+timestamp_resolution_s = 0.02
+
+class RepetitionGuard(LogitsProcessor):
+    """
+    Logits processor that ends the generation of a window early once its text has degenerated, which whisper is prone to
+    on music, silence and noise. A window is stopped by forcing the end of text token once its last text tokens are the
+    same n-gram repeated. With check_confidence, it is also stopped once the average log-probability of its text tokens
+    falls below logprob_threshold, or once its text compresses by more than compression_ratio_threshold. These are whisper's
+    own thresholds, which it only uses to retry a window at a higher temperature, so they also cut off real speech that
+    whisper is unsure of, such as accented or noisy speech, and are off by default. They are only checked once min_tokens
+    text tokens have been generated, and the compression ratio every check_every steps.
+
+    Every stop is recorded in stopped, with the index of the stopped sequence among all sequences generated so far,
+    the time into its window at which the degenerate text began, and the decoder steps saved, which is counted as the
+    max_new_tokens the window could still have used. For repetition, the text began degenerating at the segment holding
+    the first repeat, and otherwise the whole window is suspect. It is meant to be passed in a fresh LogitsProcessorList
+    for each pipeline call, as generate_kwargs["logits_processor"], and doesn't support assisted generation.
+    """
+    def __init__(self, tokenizer, max_new_tokens=128, repeat_count=4, min_repeat_tokens=12, max_ngram=16,
+                 logprob_threshold=default_logprob_threshold, compression_ratio_threshold=default_compression_ratio_threshold,
+                 min_tokens=24, check_every=8, check_confidence=False):
+        self.tokenizer = tokenizer
+        #Token ids from the end of text token on are special tokens and timestamps, text tokens are the ones below it
+        self.eos_token_id = tokenizer.eos_token_id
+        timestamp_begin = tokenizer.convert_tokens_to_ids("<|0.00|>") if hasattr(tokenizer, "convert_tokens_to_ids") else None
+        self.timestamp_begin = timestamp_begin if isinstance(timestamp_begin, int) and timestamp_begin > self.eos_token_id else None
+        self.max_new_tokens = max_new_tokens
+        self.repeat_count = repeat_count
+        self.min_repeat_tokens = min_repeat_tokens
+        self.max_ngram = max_ngram
+        self.logprob_threshold = logprob_threshold
+        self.compression_ratio_threshold = compression_ratio_threshold
+        self.min_tokens = min_tokens
+        self.check_every = check_every
+        self.check_confidence = check_confidence
+        self.stopped = []
+        self._sequences = 0
+        self._last_length = None
+
+    def _start(self, input_ids):
+        """Resets the per window state at the first step of a generate call."""
+        batch = input_ids.shape[0]
+        self._first_sequence = self._sequences
+        self._sequences += batch
+        self._prompt_length = input_ids.shape[1]
+        self._text = [[] for _ in range(batch)]
+        #(number of text tokens before it, seconds) for each timestamp token of each window
+        self._timestamps = [[] for _ in range(batch)]
+        self._logprob_sum = [0.0]*batch
+        self._done = [False]*batch
+        self._logprobs = None
+
+    def _repetition_start(self, text):
+        """Returns the index in text at which it starts repeating an n-gram enough times in a row to end it, or None."""
+        for n in range(1, min(self.max_ngram, len(text)//self.repeat_count) + 1):
+            span = n*max(self.repeat_count, -(-self.min_repeat_tokens//n))
+            #Runs every step for every window, so most n are ruled out by the last token alone
+            if span > len(text) or text[-1] != text[-1 - n]:
+                continue
+            start = len(text) - span
+            if all(text[i] == text[i - n] for i in range(start + n, len(text))):
+                #The repeats can have begun before the ones that triggered the stop
+                while start > 0 and text[start - 1] == text[start - 1 + n]:
+                    start -= 1
+                return start
+        return None
+
+    def _compression_ratio(self, text):
+        data = self.tokenizer.decode(text).encode("utf-8")
+        return len(data)/len(zlib.compress(data)) if data else 0.0
+
+    def _check(self, row, step):
+        """Returns (reason, text index at which the degenerate text began) if row should be stopped, otherwise None."""
+        text = self._text[row]
+        if len(text) >= self.repeat_count:
+            start = self._repetition_start(text)
+            if start is not None:
+                return "repetition", start
+        if not self.check_confidence or len(text) < self.min_tokens:
+            return None
+        if self._logprob_sum[row]/len(text) < self.logprob_threshold:
+            return "low_logprob", 0
+        if step % self.check_every == 0 and self._compression_ratio(text) > self.compression_ratio_threshold:
+            return "compression_ratio", 0
+        return None
+
+    def _time_of(self, row, text_index):
+        """Returns the seconds into the window of the last timestamp before text_index text tokens, i.e. the start of the
+            segment holding that text token, or 0 if there is none."""
+        times = [seconds for count, seconds in self._timestamps[row] if count <= text_index]
+        return times[-1] if times and text_index > 0 else 0.0
+
+    def __call__(self, input_ids, scores):
+        #Each generate call starts from the decoder prompt, anything else is the next step of the same call
+        if self._last_length is None or input_ids.shape[1] != self._last_length + 1 or input_ids.shape[0] != len(self._done):
+            self._start(input_ids)
+        self._last_length = input_ids.shape[1]
+        step = input_ids.shape[1] - self._prompt_length
+
+        if step > 0:
+            last_tokens = input_ids[:, -1].tolist()
+            #Log-probabilities are only needed, and only computed, for the confidence checks
+            chosen_logprobs = self._logprobs.gather(1, input_ids[:, -1:]).squeeze(1).tolist() if self.check_confidence else [0.0]*len(last_tokens)
+            for row, token in enumerate(last_tokens):
+                if self._done[row]:
+                    continue
+                if token == self.eos_token_id:
+                    self._done[row] = True
+                elif token < self.eos_token_id:
+                    self._text[row].append(token)
+                    self._logprob_sum[row] += chosen_logprobs[row]
+                elif self.timestamp_begin is not None and token >= self.timestamp_begin:
+                    self._timestamps[row].append((len(self._text[row]), (token - self.timestamp_begin)*timestamp_resolution_s))
+
+        stop = []
+        for row in range(len(self._done)):
+            if self._done[row]:
+                continue
+            check = self._check(row, step)
+            if check is not None:
+                reason, start = check
+                stop.append(row)
+                self._done[row] = True
+                self.stopped.append({"sequence": self._first_sequence + row, "from_s": self._time_of(row, start), "reason": reason,
+                                     "text": self.tokenizer.decode(self._text[row][start:]),
+                                     "steps_saved": max(0, self.max_new_tokens - step)})
+
+        if self.check_confidence:
+            self._logprobs = torch.log_softmax(scores.float(), dim=-1)
+        if stop:
+            scores = scores.clone()
+            scores[stop] = -float("inf")
+            scores[stop, self.eos_token_id] = 0
+        return scores
+
+    def filter_chunks(self, chunks, windows=None, drop=False):
+        """Filters chunks, of the form pipe(...)["chunks"], of one input by the windows stopped while generating them.
+            windows are the windows of that input as given by audio_processing.pipeline_windows. Returns (chunks,
+            steps_saved, stops): chunks without those starting in the degenerate part of a stopped window if drop is True,
+            and the decoder steps saved and the number of windows stopped for this input. If windows is None, the
+            input's windows aren't known, nothing is dropped, and the stops not counted for an earlier input are counted."""
+        if windows is None:
+            stops = [stop for stop in self.stopped if not stop.get("counted")]
+            for stop in stops:
+                stop["counted"] = True
+            return chunks, sum(stop["steps_saved"] for stop in stops), len(stops)
+        by_sequence = {window[0]: window for window in windows}
+        stops = [stop for stop in self.stopped if stop["sequence"] in by_sequence]
+        if drop and stops:
+            #Each window only contributes the chunks starting between keep_start_s and keep_end_s to the merged result
+            spans = []
+            for stop in stops:
+                _, start_s, keep_start_s, keep_end_s = by_sequence[stop["sequence"]]
+                spans.append((max(keep_start_s, start_s + stop["from_s"]), keep_end_s))
+            chunks = [chunk for chunk in chunks
+                      if chunk["timestamp"][0] is None or not any(begin <= chunk["timestamp"][0] < end for begin, end in spans)]
+        return chunks, sum(stop["steps_saved"] for stop in stops), len(stops)
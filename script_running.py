@@ -4,35 +4,62 @@ import logging
 import threading
 
 import customtkinter as ctk
-import torch
-from CTkMessagebox import CTkMessagebox
-from transformers import pipeline
-from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
-from huggingface_hub import try_to_load_from_cache as hf_try_to_load_from_cache
 
-import subtitling
 from constants import valid_video_file_types
 from utils import get_list_of_videos, find_model
 
+#torch, transformers, huggingface_hub, CTkMessagebox and the processing modules are only imported inside the functions
+#that need them, so that the window can appear without waiting for them. ModelPreloader imports them in the background.
+
+class ModelPreloader:
+    """
+    Imports the heavy libraries and loads the pipeline for the model and cpu backend configured in config.ini on a
+    background thread, while the user is choosing what to process. The pipeline is kept resident in the model registry,
+    so the run started by "Create Subtitles" picks it up, or waits for it if it is still loading. The model is only
+    loaded if it has been downloaded already, so nothing is downloaded without the user asking for it.
+    """
+    def __init__(self, config):
+        self.model_id = find_model(config.get('main', 'model_name'))
+        self.cpu_backend = config.get('main', 'cpu_backend')
+        self.error = None
+        self._thread = threading.Thread(target=self._preload, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _preload(self):
+        try:
+            from huggingface_hub import try_to_load_from_cache as hf_try_to_load_from_cache
+            from models import get_pipeline, default_device
+            import subtitling
+
+            if hf_try_to_load_from_cache(self.model_id, "model.safetensors"):
+                device, torch_dtype = default_device()
+                get_pipeline(self.model_id, device, torch_dtype, self.cpu_backend)
+        except Exception as e:
+            #The run loads the model itself, and reports any error then
+            logging.warning("Preloading %s failed", self.model_id, exc_info=e)
+            self.error = e
+
+    def wait(self):
+        """Waits for preloading to finish, if it has been started."""
+        if self._thread.is_alive():
+            self._thread.join()
+
 def subtitle_complete_pop_up(appUI):
+    from CTkMessagebox import CTkMessagebox
+
     #Create pop-up window announcing completion
     completed_text = f"Finshed creating subtitles for {appUI.path.get()}"
     CTkMessagebox(title="Processing Completed", message = completed_text)
 
 def init_model(appUI):
-        """Attempts to initialize selected model, used to insure files are present and download as needed."""
-        model_id = find_model(appUI.model_name.get())
-
-        device = "cuda:0"  if torch.cuda.is_available() else "cpu"
-    
-        torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+        """Attempts to initialize selected model, used to insure files are present and download as needed.
+            The loaded pipeline is kept resident in the model registry, so the following run reuses it."""
+        from models import get_pipeline
 
-        model = AutoModelForSpeechSeq2Seq.from_pretrained(
-            model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
-        )
-        model.to(device)
-
-        processor = AutoProcessor.from_pretrained(model_id)
+        model_id = find_model(appUI.model_name.get())
+        get_pipeline(model_id)
 
 def run_process_in_thread(appUI, process, process_complete, running_text):
     """Spins up new thread to handle process. While running disables confirm button and overwrites text with running_text. Runs process_complete after process finishes."""
@@ -51,33 +78,30 @@ def run_process_in_thread(appUI, process, process_complete, running_text):
 
 def run_process(appUI):
     """Initializes model, and then proceeds to create subtitles based on information from UI."""
+    import subtitling
+    from models import get_pipeline, default_device
+    from manifest import JobManifest
+    from metrics import RunMetrics
+    from autotune import apply_tuned
+
+    #Any model being preloaded is picked up from the model registry by subtitle_videos
+    appUI.preloader.wait()
     model_id = find_model(appUI.model_name.get())
     parameters = set_parameters(appUI.lang_selection.get(), appUI.replace_lang.get(), appUI.selected_lang.get(), appUI.replace_subs.get())
 
-    device = "cuda:0"  if torch.cuda.is_available() else "cpu"
+    #These have no control in the UI and are only set in config.ini, see the matching command line options
+    parameters.processes = appUI.config.getint('main', 'processes')
+    parameters.cpu_backend = appUI.config.get('main', 'cpu_backend')
+    parameters.decode_ranges = appUI.config.getint('main', 'decode_ranges')
+    parameters.drop_repetitions = appUI.config.getboolean('main', 'drop_repetitions')
+    parameters.guard_low_confidence = appUI.config.getboolean('main', 'guard_low_confidence')
+    #Draft model for assisted generation, e.g. WhisperLargeV3-Turbo to speed up WhisperLargeV3
+    parameters.assistant_model = find_model(appUI.config.get('main', 'assistant_model')) or None
+
+    device, torch_dtype = default_device()
     print(device)
-    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-
-    model = AutoModelForSpeechSeq2Seq.from_pretrained(
-        model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
-    )
-    model.to(device)
-
-    processor = AutoProcessor.from_pretrained(model_id)
-
-    pipe = pipeline(
-        "automatic-speech-recognition",
-        model=model,
-        tokenizer=processor.tokenizer,
-        feature_extractor=processor.feature_extractor,
-        max_new_tokens=128,
-        chunk_length_s=10,
-        #stride_length_s=2,
-        batch_size=1,
-        return_timestamps=True,
-        torch_dtype=torch_dtype,
-        device=device,
-    )
+    #Batch size and window lengths found by autotuning this model on this device, if it has been tuned
+    apply_tuned(parameters, model_id, device)
 
     #Create a list of videos that should be processed
     path = Path(appUI.path.get())
@@ -89,15 +113,34 @@ def run_process(appUI):
         raise RuntimeError("Invalid input mode")
 
     #Run on all videos in list, logging and continuing through the list on exception.
-    while list_of_videos:
-        video_path = list_of_videos.pop()
+    #Audio for upcoming videos is decoded in the background while the current one is transcribed,
+    #or with multiple processes configured on cpu, videos are shared out between worker processes.
+    #Progress is recorded in a job manifest in the target folder.
+    #With job_queue set in config.ini, the videos are shared out with other hosts through a queue on a shared drive instead.
+    metrics = RunMetrics()
+    queue_path = appUI.config.get('main', 'job_queue')
+    if queue_path:
+        from job_queue import open_queue, run_worker
+
+        queue = open_queue(queue_path)
+        queue.add(list_of_videos)
         try:
-            subtitling.subtitle_file(path = video_path, pipe = pipe, parameters=parameters)
-        except Exception as e:
-            logging.error('Error at %s', 'division', exc_info=e)
+            run_worker(queue, get_pipeline(model_id, device, torch_dtype, parameters.cpu_backend), parameters, metrics=metrics)
+        finally:
+            queue.close()
+    else:
+        manifest = JobManifest(path if path.is_dir() else path.parent)
+        try:
+            subtitling.subtitle_videos(list_of_videos, model_id, parameters, device, torch_dtype, manifest, metrics)
+        finally:
+            manifest.close()
+    summary = metrics.summary()
+    print(f"{summary['files']} files, {summary['audio_s']:.0f}s of audio in {summary['wall_s']:.0f}s, stage times: {summary['stage_s']}")
 
 def run_on_button_press(appUI):
     """Main logic to run when confirm button is pressed"""
+    from huggingface_hub import try_to_load_from_cache as hf_try_to_load_from_cache
+
     #Save config
     save_config(appUI)
     if not(cuda_check(appUI)):
@@ -121,8 +164,11 @@ def running_process(appUI):
 
 def cuda_check(appUI):
     """Checks if attepting to run full model without cuda, and prompts user to go back with a pop-up if so."""
+    import torch
+    from CTkMessagebox import CTkMessagebox
+
     def cuda_warning():
-        warning_text = "Warning: Cuda is not detected and you are attempting to run the full model. This will work but will likely be extremely slow. It is strongly recommended to only use Turbo model when running on cpu."
+        warning_text = "Warning: Cuda is not detected and you are attempting to run the full model. This will work but will likely be extremely slow. It is strongly recommended to only use Turbo model when running on cpu, optionally with cpu_backend = int8 set in config.ini, or to set assistant_model = WhisperLargeV3-Turbo in config.ini to speed up the full model."
         warning_box = CTkMessagebox(title="Processing Completed", message = warning_text, option_1="Cancel", option_2="Continue")
 
         if warning_box.get() == "Continue":
@@ -150,6 +196,8 @@ def save_config(appUI):
 
 def set_parameters(lang_selection, replace_lang, selected_lang, replace_subs):
     """Creates a SubbingParameters object corresponding to parameters entered in ui."""
+    import subtitling
+
     parameters = subtitling.SubbingParameters()
     if lang_selection == "Auto-Detect Single Language":
         parameters.multi_lang = False
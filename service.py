@@ -0,0 +1,327 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+import json
+import logging
+import queue
+import tempfile
+import threading
+import time
+
+from audio_processing import load_audio
+from batching import BatchScheduler
+from metrics import measure
+from subtitling import SubbingParameters, VideoSubbing, assisted_parameters
+from utils import format_subs
+
+class ServiceBusy(Exception):
+    """Raised when the service already has as many requests as it accepts at once."""
+
+class ServiceSubbing(VideoSubbing):
+    """VideoSubbing for a service request, keeping the transcription to send back instead of writing it to an .srt file."""
+    subs = None
+
+    def subs_needed(self):
+        return True
+
+    def save_subs(self, subs):
+        self.subs = subs
+        if self.metrics is not None:
+            self.metrics.finish_file(self.file)
+
+def _copy_upload(source, destination, length, block_size=1024*1024):
+    """Copies length bytes from the file object source to destination a block at a time, so uploads aren't held in memory."""
+    remaining = length
+    while remaining > 0:
+        block = source.read(min(block_size, remaining))
+        if not block:
+            raise ValueError(f"upload ended after {length - remaining} of {length} bytes")
+        destination.write(block)
+        remaining -= len(block)
+
+class _Request:
+    def __init__(self, file, audio, parameters):
+        self.file = file
+        self.audio = audio
+        self.parameters = parameters
+        self.future = Future()
+
+class TranscriptionService:
+    """
+    Shares one resident whisper pipeline between many clients. Requests are queued, and a single model thread
+    gathers the requests arriving within max_wait_s of each other, up to max_batch of them, and runs them through
+    a BatchScheduler so that their windows share model calls. At most max_requests requests are accepted at once,
+    counting those being decoded, queued and transcribed, beyond which further requests raise ServiceBusy.
+    """
+    def __init__(self, pipe, parameters: SubbingParameters = None, max_batch=8, max_wait_s=0.05, max_requests=32, metrics=None):
+        self.pipe = pipe
+        self.parameters = assisted_parameters(SubbingParameters(replace=True, multi_lang=False) if parameters is None else parameters)
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_s
+        self.max_requests = max_requests
+        self.metrics = metrics
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._counts = {"ok": 0, "failed": 0, "rejected": 0}
+        self._batches = 0
+        self._batched_requests = 0
+        self._latency_s = 0.0
+        self._server = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request_parameters(self, language=None, task=None):
+        """Returns the service parameters with a request's language and task applied. language="auto" detects the language
+            of every chunk separately, and None detects a single language for the whole request."""
+        parameters = self.parameters
+        if task is not None:
+            if task not in ("transcribe", "translate"):
+                raise ValueError(f"Unknown task {task}")
+            parameters = replace(parameters, task=task)
+        if language == "auto":
+            parameters = replace(parameters, multi_lang=True)
+        elif language is not None:
+            parameters = replace(parameters, multi_lang=False, provide_lang=True, provided_lang=language)
+        return parameters
+
+    @contextmanager
+    def _slot(self):
+        """Holds one of the max_requests request slots for the enclosed block, raising ServiceBusy if none are free."""
+        with self._lock:
+            if self._active >= self.max_requests:
+                self._counts["rejected"] += 1
+                raise ServiceBusy(f"{self._active} requests already in progress")
+            self._active += 1
+        started = time.perf_counter()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._counts[status] += 1
+                self._latency_s += time.perf_counter() - started
+
+    def _transcribe(self, file, audio, parameters):
+        if audio is None:
+            with measure(self.metrics, file, "decode"):
+                audio = load_audio(file, (parameters or self.parameters).decode_ranges)
+        request = _Request(file, audio, parameters or self.parameters)
+        self._queue.put(request)
+        return request.future.result()
+
+    def transcribe(self, file, audio=None, parameters=None):
+        """Transcribes file, or audio if it has already been decoded, and returns (language, chunks) where chunks are of the
+            form pipe(...)["chunks"]. Raises ServiceBusy if too many requests are in progress already."""
+        with self._slot():
+            return self._transcribe(file, audio, parameters)
+
+    def transcribe_upload(self, data, suffix="", parameters=None, length=None):
+        """Transcribes audio or video uploaded as the bytes data, or as the next length bytes of the file object data, in any
+            format ffmpeg can read. A request slot is taken before anything is read, so a busy service doesn't receive
+            uploads it would reject. See transcribe."""
+        with self._slot():
+            #ffmpeg needs a seekable input for many containers, so the upload is written to a temporary file to be decoded
+            with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+                file = Path(f.name)
+                try:
+                    if length is None:
+                        f.write(data)
+                    else:
+                        _copy_upload(data, f, length)
+                except BaseException:
+                    f.close()
+                    file.unlink()
+                    raise
+            try:
+                with measure(self.metrics, file, "decode"):
+                    audio = load_audio(file, (parameters or self.parameters).decode_ranges)
+            finally:
+                file.unlink()
+            return self._transcribe(file, audio, parameters)
+
+    def _next_batch(self):
+        """Waits for a request, then gathers any more arriving within max_wait_s. Returns None once the service is closed."""
+        request = self._queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                #Finish this batch first, then stop
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            with self._lock:
+                self._batches += 1
+                self._batched_requests += len(batch)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        scheduler = BatchScheduler(self.pipe, batch_size=self.parameters.batch_size, chunk_length_s=self.parameters.chunk_length_s,
+                                   stride_length_s=self.parameters.stride_length_s, metrics=self.metrics)
+        subbings = []
+        failures = {}
+        for request in batch:
+            try:
+                #Cache lookup, voice activity detection and language detection happen here, on the model thread
+                subbing = ServiceSubbing(request.file, self.pipe, parameters=request.parameters, audio=request.audio, metrics=self.metrics)
+                subbings.append((request, subbing))
+                failures.update((id(failed), e) for failed, e in scheduler.submit(subbing))
+            except Exception as e:
+                request.future.set_exception(e)
+        failures.update((id(failed), e) for failed, e in scheduler.flush())
+
+        for request, subbing in subbings:
+            e = failures.get(id(subbing))
+            if e is not None:
+                if self.metrics is not None:
+                    self.metrics.finish_file(request.file, status="failed")
+                request.future.set_exception(e)
+            else:
+                request.future.set_result((getattr(subbing, "lang", None), subbing.subs))
+
+    def health(self):
+        with self._lock:
+            return {
+                "status": "ok" if self._thread.is_alive() else "stopped",
+                "model": getattr(getattr(self.pipe, "model", None), "name_or_path", None),
+                "active_requests": self._active,
+                "queued_requests": self._queue.qsize(),
+                "max_requests": self.max_requests,
+            }
+
+    def prometheus_text(self):
+        """Returns the service metrics, followed by the per-file metrics if there is a RunMetrics, in the Prometheus text format."""
+        with self._lock:
+            lines = [
+                "# HELP whispersubs_service_requests_total Requests handled by the service.",
+                "# TYPE whispersubs_service_requests_total counter",
+            ]
+            lines += [f'whispersubs_service_requests_total{{status="{status}"}} {count}' for status, count in self._counts.items()]
+            lines += [
+                "# HELP whispersubs_service_request_seconds_total Total time from accepting a request to answering it.",
+                "# TYPE whispersubs_service_request_seconds_total counter",
+                f"whispersubs_service_request_seconds_total {self._latency_s}",
+                "# HELP whispersubs_service_batches_total Batches of requests run through the model.",
+                "# TYPE whispersubs_service_batches_total counter",
+                f"whispersubs_service_batches_total {self._batches}",
+                "# HELP whispersubs_service_batched_requests_total Requests run in those batches.",
+                "# TYPE whispersubs_service_batched_requests_total counter",
+                f"whispersubs_service_batched_requests_total {self._batched_requests}",
+                "# HELP whispersubs_service_active_requests Requests currently being decoded, queued or transcribed.",
+                "# TYPE whispersubs_service_active_requests gauge",
+                f"whispersubs_service_active_requests {self._active}",
+            ]
+        text = "\n".join(lines) + "\n"
+        if self.metrics is not None:
+            text += self.metrics.prometheus_text()
+        return text
+
+    def serve(self, port, host="127.0.0.1", max_upload_bytes=2*1024**3, max_json_bytes=1024**2):
+        """
+        Serves the service over http on a background thread:
+            POST /transcribe with a json body {"path": ..., "language": ..., "task": ..., "format": "srt" or "json"}
+                transcribes a local file.
+            POST /transcribe?language=...&task=...&format=...&suffix=... with any other body transcribes the uploaded audio.
+            GET /health and GET /metrics report the state of the service.
+        language and task are optional, see request_parameters. Requests beyond max_requests are answered with 503, before
+        their body is read. Uploads are streamed to a temporary file rather than read into memory.
+        """
+        service = self
+
+        class ServiceHandler(BaseHTTPRequestHandler):
+            def _reply(self, code, body, content_type="application/json", headers=()):
+                data = (json.dumps(body) if content_type == "application/json" else body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == "/health":
+                    self._reply(200, service.health())
+                elif path == "/metrics":
+                    self._reply(200, service.prometheus_text(), "text/plain; version=0.0.4")
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != "/transcribe":
+                    self._reply(404, {"error": "not found"})
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                is_json = self.headers.get("Content-Type", "").startswith("application/json")
+                limit = max_json_bytes if is_json else max_upload_bytes
+                if length > limit:
+                    self.close_connection = True
+                    self._reply(413, {"error": f"{'json bodies' if is_json else 'uploads'} are limited to {limit} bytes"})
+                    return
+
+                try:
+                    if is_json:
+                        options = json.loads(self.rfile.read(length))
+                        parameters = service.request_parameters(options.get("language"), options.get("task"))
+                        language, chunks = service.transcribe(Path(options["path"]), parameters=parameters)
+                    else:
+                        options = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                        parameters = service.request_parameters(options.get("language"), options.get("task"))
+                        language, chunks = service.transcribe_upload(self.rfile, options.get("suffix", ""), parameters, length)
+                except ServiceBusy as e:
+                    #The unread upload is left behind, so the connection can't be reused
+                    self.close_connection = True
+                    self._reply(503, {"error": str(e)}, headers=[("Retry-After", "1")])
+                    return
+                except (ValueError, KeyError, TypeError) as e:
+                    self._reply(400, {"error": str(e)})
+                    return
+                except Exception as e:
+                    logging.error("Error transcribing request", exc_info=e)
+                    self._reply(500, {"error": str(e)})
+                    return
+
+                if options.get("format") == "json":
+                    self._reply(200, {"language": language, "chunks": chunks})
+                else:
+                    self._reply(200, format_subs(chunks)[0], "application/x-subrip; charset=utf-8")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), ServiceHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def close(self):
+        """Stops the http server and, after any queued requests are finished, the model thread."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self._queue.put(None)
+        self._thread.join()
@@ -1,30 +1,118 @@
 from dataclasses import dataclass
+import dataclasses
 from pathlib import Path
+import logging
 
-import torch
-from transformers import pipeline
-from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
-
-from audio_processing import extract_audio
-from utils import determine_lang, write_subs
-from constants import valid_video_file_types
+from audio_processing import extract_audio, load_audio, detect_speech, compact_speech, to_original_time, probe_duration, stream_windows, pipeline_windows
+from utils import determine_lang, write_subs, get_list_of_videos, SubtitleWriter
+from constants import valid_video_file_types, whisper_sample_rate, default_cache_dir
+from models import get_pipeline, default_device, get_assistant_model, max_new_tokens
+from prefetch import AudioPrefetcher
+from batching import BatchScheduler
+from planning import plan_files, subtitle_path
+from transcription_cache import TranscriptionCache
+from metrics import measure
 
 @dataclass
 class SubbingParameters:
     replace: bool = True
+    replace_stale: bool = False
     multi_lang: bool = True
     replace_lang: bool = False
     preserve_intermediary_files: bool = False
     provide_lang: bool = False
     provided_lang: str = ""
+    in_memory_audio: bool = True
+    decode_workers: int = 2
+    decode_ranges: int = 4
+    max_prefetch_s: float = 7200
+    task: str = "translate"
+    batch_size: int = 8
+    chunk_length_s: float = 30
+    stride_length_s: float = None
+    lang_detection: str = "encoder"
+    lang_detect_windows: int = 8
+    lang_detect_confidence: float = 0.9
+    vad: bool = False
+    vad_threshold_db: float = -45
+    vad_min_silence_s: float = 1.0
+    vad_pad_s: float = 0.5
+    use_cache: bool = True
+    cache_dir: str = default_cache_dir
+    cache_max_bytes: int = 2*1024**3
+    resume: bool = False
+    processes: int = 1
+    threads_per_process: int = 0
+    cpu_backend: str = "default"
+    compile_model: bool = False
+    segment_min_duration_s: float = 7200
+    segment_length_s: float = 600
+    segment_overlap_s: float = 10
+    bilingual: bool = False
+    assistant_model: str = None
+    worker_id: str = None
+    repetition_guard: bool = True
+    drop_repetitions: bool = False
+    guard_low_confidence: bool = False
+
+def with_assistant(generate_kwargs, parameters, pipe):
+    """Adds the draft model parameters.assistant_model to generate_kwargs if it is set, loaded to match the model of pipe.
+        Generation is then assisted: the draft proposes several tokens at a time and the main model checks them all in
+        one step, which gives the same output as the main model alone in fewer of its decoder steps."""
+    if parameters.assistant_model:
+        generate_kwargs["assistant_model"] = get_assistant_model(parameters.assistant_model, pipe.model.device, pipe.model.dtype)
+    return generate_kwargs
+
+def with_guard(generate_kwargs, parameters, pipe):
+    """Adds a fresh RepetitionGuard to generate_kwargs if parameters.repetition_guard is set, which stops the generation of
+        any window whose text degenerates into repetition, or also into low confidence text if parameters.guard_low_confidence
+        is set, instead of letting it run to max_new_tokens.
+        It isn't added with assisted generation, which checks several tokens at once."""
+    if parameters.repetition_guard and not generate_kwargs.get("assistant_model") and getattr(pipe, "tokenizer", None) is not None:
+        #Imported here so that subtitling stays importable without torch
+        from transformers import LogitsProcessorList
+        from repetition_guard import RepetitionGuard
+        guard = RepetitionGuard(pipe.tokenizer, max_new_tokens, check_confidence=parameters.guard_low_confidence)
+        generate_kwargs["logits_processor"] = LogitsProcessorList([guard])
+    return generate_kwargs
+
+def _key_number(value):
+    """Returns value as it is written into cache keys: whole numbers as ints and others as floats, so 30 from the command
+        line and 30.0 from tuned settings in config.ini give the same key."""
+    if value is None:
+        return None
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+def guarded_chunks(chunks, generate_kwargs, parameters, file=None, metrics=None, windows=None):
+    """Returns chunks of one input, of the form pipe(...)["chunks"] and generated with generate_kwargs from with_guard,
+        without the degenerate part of the windows the guard stopped if parameters.drop_repetitions is set. windows are
+        the input's windows, as given by audio_processing.pipeline_windows. The decoder steps the guard saved and the
+        number of windows it stopped for the input are added to the metrics of file."""
+    guards = [processor for processor in generate_kwargs.get("logits_processor") or [] if hasattr(processor, "filter_chunks")]
+    if not guards:
+        return chunks
+    chunks, steps_saved, stops = guards[0].filter_chunks(chunks, windows, parameters.drop_repetitions)
+    if metrics is not None:
+        metrics.add(file, decoder_steps_saved=steps_saved, guard_stops=stops)
+    return chunks
+
+def assisted_parameters(parameters):
+    """Returns parameters with batch_size set to 1 if parameters.assistant_model is set, as assisted generation
+        works on one window at a time."""
+    if parameters.assistant_model and parameters.batch_size != 1:
+        return dataclasses.replace(parameters, batch_size=1)
+    return parameters
 
 class VideoSubbing:
     """
     Custom class for managing data involved in generating a subtitle track for a given video,
     assumed to be located in directory\video_name
     """
-    def __init__(self, file, pipe, *, parameters=None):
+    def __init__(self, file, pipe, *, parameters=None, audio=None, manifest=None, metrics=None):
         self.file = file
+        self.manifest = manifest
+        self.metrics = metrics
         
 
         if parameters is None:
@@ -34,28 +122,145 @@ class VideoSubbing:
         
         self.pipe = pipe
 
-        #Extract audio data from file
-        self.audio_input = str(extract_audio((self.file)))
+        #Extract audio data from file, either decoded straight into memory or via an intermediary .wav file.
+        #Audio that has already been decoded, e.g. by an AudioPrefetcher, is used as is.
+        with measure(self.metrics, self.file, "decode"):
+            if audio is not None:
+                self.audio_input = audio
+            elif self.parameters.in_memory_audio:
+                self.audio_input = load_audio(self.file, self.parameters.decode_ranges)
+            else:
+                self.audio_input = str(extract_audio(self.file, self.wav_path()))
+        if self.metrics is not None:
+            self.metrics.set(self.file, audio_s=self.audio_seconds())
+
+        #Look up any previous transcription of the same audio with the same settings
+        self.cache = None
+        self.cache_key = None
+        self.cached = None
+        if self.parameters.use_cache:
+            with measure(self.metrics, self.file, "cache_lookup"):
+                self.cache = TranscriptionCache(self.parameters.cache_dir, self.parameters.cache_max_bytes)
+                self.cache_key = TranscriptionCache.make_key(self.audio_input, **self.cache_settings())
+                self.cached = self.cache.get(self.cache_key)
+
+        #Only keep the regions containing speech, remembering where they came from so timestamps can be mapped back
+        self.speech_offsets = None
+        if self.parameters.vad and not isinstance(self.audio_input, str):
+            with measure(self.metrics, self.file, "vad"):
+                regions = detect_speech(self.audio_input, threshold_db=self.parameters.vad_threshold_db,
+                            min_silence_s=self.parameters.vad_min_silence_s, pad_s=self.parameters.vad_pad_s)
+                self.audio_input, self.speech_offsets = compact_speech(self.audio_input, regions)
 
         #Determine which language should be used if only processing from one language
         if not self.parameters.multi_lang:
-            if self.parameters.provide_lang:
+            if self.cached is not None:
+                self.lang = self.cached["language"]
+            elif self.parameters.provide_lang:
                 self.lang = self.parameters.provided_lang
+            elif self.audio_seconds() == 0:
+                self.lang = None
             else:
-                self.lang = determine_lang(audio_input=self.audio_input, file=self.file, pipe=self.pipe, replace_lang=self.parameters.replace_lang, preserve_intermediary_files=self.parameters.preserve_intermediary_files)
+                with measure(self.metrics, self.file, "language_detection"):
+                    self.lang = determine_lang(audio_input=self.audio_input, file=self.file, pipe=self.pipe, replace_lang=self.parameters.replace_lang, preserve_intermediary_files=self.parameters.preserve_intermediary_files,
+                                    method=self.parameters.lang_detection, num_windows=self.parameters.lang_detect_windows, confidence=self.parameters.lang_detect_confidence)
+
+    def cache_settings(self):
+        """Returns the settings which, together with the audio, determine the transcription."""
+        if self.parameters.multi_lang:
+            language = None
+        elif self.parameters.provide_lang:
+            language = self.parameters.provided_lang
+        else:
+            #Auto-detected languages are stored in the cache entry, so the detection can be skipped on a cache hit
+            language = f"auto:{self.parameters.lang_detection}"
+            filelang = self.file.with_name(self.file.stem+"lang.txt")
+            if filelang.exists() and self.parameters.replace_lang is False:
+                with filelang.open(mode="r", encoding="utf-8") as f:
+                    language = f.readline().split(":")[-1].strip()
+        return {
+            "model_id": getattr(getattr(self.pipe, "model", None), "name_or_path", None),
+            "task": self.parameters.task,
+            "language": language,
+            "chunk_length_s": _key_number(self.parameters.chunk_length_s),
+            #Only part of the key when it differs from the pipeline's default of a sixth of the chunk, so entries cached
+            #before it existed, and with it set to the default, stay valid
+            **({"stride_length_s": _key_number(self.parameters.stride_length_s)} if self.parameters.stride_length_s is not None
+               and _key_number(self.parameters.stride_length_s) != _key_number((self.parameters.chunk_length_s or 0)/6) else {}),
+            "vad": [self.parameters.vad_threshold_db, self.parameters.vad_min_silence_s, self.parameters.vad_pad_s] if self.parameters.vad else None,
+            **({"repetition_guard": ("drop" if self.parameters.drop_repetitions else "stop")
+                + (":repetition+confidence" if self.parameters.guard_low_confidence else ":repetition")} if self.parameters.repetition_guard else {}),
+        }
+
+    def generate_kwargs(self):
+        """Returns the generate_kwargs passed to the pipeline, using auto language if multi_lang=True and self.lang otherwise,
+            the draft model if parameters.assistant_model is set, and a fresh RepetitionGuard if parameters.repetition_guard is set."""
+        if self.parameters.multi_lang:
+            generate_kwargs = {"task": self.parameters.task}
+        else:
+            generate_kwargs = {"language": self.lang, "task": self.parameters.task}
+        return with_guard(with_assistant(generate_kwargs, self.parameters, self.pipe), self.parameters, self.pipe)
+
+    def batch_key(self):
+        """Files with the same batch key can be run through the pipeline in the same batch."""
+        generate_kwargs = self.generate_kwargs()
+        return (generate_kwargs.get("language"), generate_kwargs["task"])
+
+    def audio_length(self):
+        """Returns the length of the decoded audio in samples, or None if the audio is only available as a file."""
+        if isinstance(self.audio_input, str):
+            return None
+        return len(self.audio_input)
+
+    def audio_seconds(self):
+        """Returns the length of the decoded audio in seconds, or None if the audio is only available as a file."""
+        if isinstance(self.audio_input, str):
+            return None
+        return len(self.audio_input)/whisper_sample_rate
 
     def apply_whisper(self):
         """
         Applies whisper model using auto language if multi_lang=True,
-        and otherwise using language as described in self.makelang
+        and otherwise using language as described in self.lang
         """
-        if self.parameters.multi_lang:
-            result = self.pipe(self.audio_input, return_timestamps=True,
-                 generate_kwargs={"task": "translate"})
-        else:
-            result = self.pipe(self.audio_input, batch_size = 8, return_timestamps=True,
-                 generate_kwargs={"language": self.lang, "task": "translate"})
-        return result["chunks"]
+        if self.cached is not None:
+            return self.cached["chunks"]
+        if self.audio_seconds() == 0:
+            return self.finish_chunks([])
+        generate_kwargs = self.generate_kwargs()
+        with measure(self.metrics, self.file, "whisper"):
+            result = self.pipe(self.audio_input, batch_size=self.parameters.batch_size, chunk_length_s=self.parameters.chunk_length_s,
+                     stride_length_s=self.parameters.stride_length_s, return_timestamps=True, generate_kwargs=generate_kwargs)
+        windows = pipeline_windows([self.audio_length()], self.parameters.chunk_length_s, self.parameters.stride_length_s)[0]
+        return self.finish_chunks(result["chunks"], generate_kwargs, windows)
+
+    def finish_chunks(self, chunks, generate_kwargs=None, windows=None):
+        """Drops the degenerate chunks of windows stopped by a RepetitionGuard in generate_kwargs if parameters.drop_repetitions
+            is set, windows being the windows the pipeline cut the audio into, maps the timestamps of chunks produced from
+            speech only audio back onto the timeline of the video, and stores the result in the transcription cache."""
+        if generate_kwargs is not None:
+            chunks = guarded_chunks(chunks, generate_kwargs, self.parameters, self.file, self.metrics, windows)
+        if self.speech_offsets is not None:
+            chunks = [dict(chunk, timestamp=tuple(to_original_time(t, self.speech_offsets) for t in chunk["timestamp"])) for chunk in chunks]
+        if self.cache is not None:
+            self.cache.put(self.cache_key, {"language": getattr(self, "lang", None), "chunks": chunks})
+        if self.metrics is not None:
+            self.metrics.set(self.file, tokens=self.count_tokens(chunks))
+        return chunks
+
+    def count_tokens(self, chunks):
+        """Returns the number of tokens in the text of chunks, or None if the pipeline has no tokenizer."""
+        tokenizer = getattr(self.pipe, "tokenizer", None)
+        if tokenizer is None:
+            return None
+        return sum(len(tokenizer(chunk["text"], add_special_tokens=False).input_ids) for chunk in chunks)
+
+    def wav_path(self):
+        """Returns where the intermediary .wav file is written: video_name.wav, or video_name.<worker_id>.wav if
+            parameters.worker_id is set, so that workers sharing a folder never write to the same file."""
+        if self.parameters.worker_id:
+            return self.file.with_name(f"{self.file.stem}.{self.parameters.worker_id}.wav")
+        return self.file.with_suffix(".wav")
 
     def cleanup_wav(self):
         """
@@ -63,7 +268,7 @@ class VideoSubbing:
         that is created during processing
         """
         try:
-            self.file.with_suffix(".wav").unlink()
+            self.wav_path().unlink()
         except OSError as e:
             print("Error: %s - %s." % (e.filename, e.strerror))
 
@@ -79,79 +284,288 @@ class VideoSubbing:
             print("Error: %s - %s." % (e.filename, e.strerror))
 
 
+    def subs_needed(self):
+        """Returns False if replace is False and the subtitle file already exists."""
+        return self.parameters.replace or not self.file.with_suffix(".srt").exists()
+
+    def save_subs(self, subs):
+        """Writes subs, of the form pipe(...)["chunks"], to video_name.srt, and records the file as done in the job manifest if there is one."""
+        filesub = self.file.with_suffix(".srt")
+        with measure(self.metrics, self.file, "write_subs"):
+            write_subs(filesub, subs)
+        if self.manifest is not None:
+            self.manifest.mark_done(self.file, filesub)
+        if self.metrics is not None:
+            self.metrics.finish_file(self.file)
+
     def create_subs(self):
         """
         Creates a subtitle file called video_name.srt.
         If replace is False, then will check if file exists already and do nothing if it does.
         """
-        filesub = self.file.with_suffix(".srt")
-        if self.parameters.replace is False and filesub.exists():
+        if not self.subs_needed():
             return
         subs = self.apply_whisper()
 
-        write_subs(filesub, subs)
+        self.save_subs(subs)
 
-def subtitle_file(path: Path, pipe, parameters: SubbingParameters = None):
-    """Produces subtitle file for a given video file"""
+def subtitle_file(path: Path, pipe, parameters: SubbingParameters = None, audio=None, manifest=None, metrics=None):
+    """Produces subtitle file for a given video file. audio can be given if it has already been decoded.
+        Nothing is decoded if the subtitle file already exists and parameters.replace is False."""
     if path.suffix.lower() in valid_video_file_types:
+        if parameters is not None and parameters.replace is False and subtitle_path(path, parameters).exists():
+            _record_skipped(path, manifest, metrics, parameters)
+            return
+        if parameters is not None and parameters.bilingual:
+            subtitle_file_bilingual(path, pipe, parameters, audio, manifest, metrics)
+            return
         subbing = VideoSubbing(
                 file = path,
                 pipe = pipe,
-                parameters = parameters
+                parameters = parameters,
+                audio = audio,
+                manifest = manifest,
+                metrics = metrics
             )
         if subbing.audio_input is str(None):
             return
-        subbing.create_subs()
-        if not parameters.preserve_intermediary_files:
+        if subbing.subs_needed():
+            subbing.create_subs()
+        else:
+            _record_skipped(path, manifest, metrics)
+        if not subbing.parameters.preserve_intermediary_files and not subbing.parameters.in_memory_audio:
             subbing.cleanup_wav()
     else:
         print("Warning: Input file format not recognized")
 
-def subtitle_folder(path: Path, pipe, parameters: SubbingParameters = None):
+def subtitle_file_segmented(path: Path, pipe, parameters: SubbingParameters = None, manifest=None, metrics=None):
+    """Produces subtitle file for a given video file with bounded memory, for very long recordings. The audio is decoded
+        and transcribed in windows of parameters.segment_length_s seconds, overlapping by parameters.segment_overlap_s,
+        and subtitles are streamed to the .srt as each window finishes. Where windows overlap, chunks starting in the first
+        half of the overlap are taken from the earlier window and the rest from the later one. In single language mode
+        the language is detected from the first window. Voice activity detection and the transcription cache are not used."""
+    if parameters is None:
+        parameters = SubbingParameters()
+    filesub = path.with_suffix(".srt")
+    if parameters.replace is False and filesub.exists():
+        _record_skipped(path, manifest, metrics)
+        return
+
+    lang = None
+    if not parameters.multi_lang and parameters.provide_lang:
+        lang = parameters.provided_lang
+    generate_kwargs = with_assistant({"task": parameters.task}, parameters, pipe)
+    held = []
+    with SubtitleWriter(filesub) as writer:
+        windows = stream_windows(path, parameters.segment_length_s, parameters.segment_overlap_s, parameters.decode_ranges)
+        while True:
+            with measure(metrics, path, "decode"):
+                window = next(windows, None)
+            if window is None:
+                break
+            start_s, audio = window
+
+            if not parameters.multi_lang and lang is None:
+                with measure(metrics, path, "language_detection"):
+                    lang = determine_lang(audio_input=audio, file=path, pipe=pipe, replace_lang=parameters.replace_lang, preserve_intermediary_files=parameters.preserve_intermediary_files,
+                                    method=parameters.lang_detection, num_windows=parameters.lang_detect_windows, confidence=parameters.lang_detect_confidence)
+                generate_kwargs["language"] = lang
+
+            #A fresh guard for each segment, as the pipeline windows it stops are numbered from the start of each call
+            window_kwargs = with_guard(dict(generate_kwargs), parameters, pipe)
+            with measure(metrics, path, "whisper"):
+                result = pipe(audio, batch_size=parameters.batch_size, chunk_length_s=parameters.chunk_length_s,
+                         stride_length_s=parameters.stride_length_s, return_timestamps=True, generate_kwargs=window_kwargs)
+            pipe_windows = pipeline_windows([len(audio)], parameters.chunk_length_s, parameters.stride_length_s)[0]
+            chunks = guarded_chunks(result["chunks"], window_kwargs, parameters, path, metrics, pipe_windows)
+            chunks = [dict(chunk, timestamp=tuple(None if t is None else t + start_s for t in chunk["timestamp"])) for chunk in chunks]
+
+            #Chunks in the second half of the overlap with the next window are held back, and only written if there is no next window
+            lower = start_s + parameters.segment_overlap_s/2 if start_s > 0 else float("-inf")
+            upper = start_s + len(audio)/whisper_sample_rate - parameters.segment_overlap_s/2
+            kept = [chunk for chunk in chunks if chunk["timestamp"][0] is None or lower <= chunk["timestamp"][0] < upper]
+            held = [chunk for chunk in chunks if chunk["timestamp"][0] is not None and chunk["timestamp"][0] >= upper]
+            with measure(metrics, path, "write_subs"):
+                writer.write(kept)
+            if metrics is not None:
+                metrics.set(path, audio_s=start_s + len(audio)/whisper_sample_rate)
+        writer.write(held)
+
+    if manifest is not None:
+        manifest.mark_done(path, filesub)
+    if metrics is not None:
+        metrics.finish_file(path)
+
+def subtitle_file_bilingual(path: Path, pipe, parameters: SubbingParameters, audio=None, manifest=None, metrics=None):
+    """Produces both video_name.<language>.srt, in the language spoken, and video_name.en.srt, translated to English, from a
+        single encoder pass over the audio (see bilingual.transcribe_bilingual). The language is parameters.provided_lang if
+        provided and is detected otherwise. Voice activity detection and the transcription cache are not used."""
+    #Imported here so that subtitling stays importable without torch
+    from bilingual import transcribe_bilingual, language_code, bilingual_windows
+
+    if audio is None:
+        with measure(metrics, path, "decode"):
+            audio = load_audio(path, parameters.decode_ranges)
+    if metrics is not None:
+        metrics.set(path, audio_s=len(audio)/whisper_sample_rate)
+
+    if parameters.provide_lang:
+        lang = parameters.provided_lang
+    else:
+        with measure(metrics, path, "language_detection"):
+            lang = determine_lang(audio_input=audio, file=path, pipe=pipe, replace_lang=parameters.replace_lang, preserve_intermediary_files=parameters.preserve_intermediary_files,
+                            method=parameters.lang_detection, num_windows=parameters.lang_detect_windows, confidence=parameters.lang_detect_confidence)
+
+    #A guard for each task, as each numbers the windows it generates from the start
+    task_kwargs = {task: with_guard({}, parameters, pipe) for task in ("transcribe", "translate")}
+    with measure(metrics, path, "whisper"):
+        transcript, translation = transcribe_bilingual(audio, pipe, lang, batch_size=parameters.batch_size, chunk_length_s=parameters.chunk_length_s,
+                                                       stride_length_s=parameters.stride_length_s, max_new_tokens=max_new_tokens,
+                                                       task_generate_kwargs=task_kwargs)
+    windows = bilingual_windows(len(audio), parameters.chunk_length_s, parameters.stride_length_s)
+    is_english = translation is transcript
+    transcript = guarded_chunks(transcript, task_kwargs["transcribe"], parameters, path, metrics, windows)
+    translation = transcript if is_english else guarded_chunks(translation, task_kwargs["translate"], parameters, path, metrics, windows)
+    filesub = subtitle_path(path, parameters)
+    with measure(metrics, path, "write_subs"):
+        if language_code(lang) != "en":
+            write_subs(path.with_suffix(f".{language_code(lang)}.srt"), transcript)
+        write_subs(filesub, translation)
+
+    if manifest is not None:
+        manifest.mark_done(path, filesub)
+    if metrics is not None:
+        metrics.finish_file(path)
+
+def _record_skipped(file, manifest, metrics, parameters=None):
+    """Records a file whose subtitles already exist as done in the manifest and skipped in the metrics."""
+    if manifest is not None:
+        manifest.mark_done(file, subtitle_path(file, parameters))
+    if metrics is not None:
+        metrics.finish_file(file, status="skipped")
+
+def needs_segments(file, parameters):
+    """Returns True if file is long enough to be processed in segments with subtitle_file_segmented, rather than decoded whole."""
+    return (parameters.in_memory_audio and parameters.segment_min_duration_s > 0 and not parameters.bilingual
+            and (probe_duration(file) or 0) > parameters.segment_min_duration_s)
+
+def subtitle_files(files, pipe, parameters: SubbingParameters = None, manifest=None, metrics=None):
+    """Produces subtitle files for a list of video files, logging and continuing through the list on exception.
+        When audio is decoded in memory, the audio of upcoming files is decoded in the background while the current
+        file is being transcribed. If a JobManifest is given, the state of each file is recorded in it, and with
+        parameters.resume files it records as done or failed are skipped. If a RunMetrics is given, the time spent in each
+        stage is recorded in it. Returns the list of files that failed."""
+    if parameters is None:
+        parameters = SubbingParameters()
+    parameters = assisted_parameters(parameters)
+    failed = []
+
+    #Work out what is needed from the filesystem alone, before any audio is decoded
+    plan = plan_files(files, parameters, manifest)
+    print(plan.report())
+    for file in plan.skip:
+        if manifest is not None and manifest.state(file) == "pending" and subtitle_path(file, parameters).exists():
+            manifest.mark_done(file, subtitle_path(file, parameters))
+        if metrics is not None:
+            metrics.finish_file(file, status="skipped")
+    videos = plan.files()
+
+    def record_failure(file, e):
+        logging.error('Error at %s', file, exc_info=e)
+        if manifest is not None:
+            manifest.mark_failed(file, e)
+        if metrics is not None:
+            metrics.finish_file(file, status="failed")
+        failed.append(file)
+
+    #Very long recordings are processed in segments, one at a time, so that they never have to be held in memory whole
+    if parameters.in_memory_audio and parameters.segment_min_duration_s > 0 and not parameters.bilingual:
+        long_videos = [file for file in videos if needs_segments(file, parameters)]
+        videos = [file for file in videos if file not in long_videos]
+        for file in long_videos:
+            print(file)
+            if manifest is not None:
+                manifest.mark_running(file)
+            try:
+                subtitle_file_segmented(file, pipe, plan.parameters_for(file, parameters), manifest, metrics)
+            except Exception as e:
+                record_failure(file, e)
+
+    if not parameters.in_memory_audio:
+        for file in videos:
+            print(file)
+            if manifest is not None:
+                manifest.mark_running(file)
+            try:
+                subtitle_file(file, pipe, plan.parameters_for(file, parameters), manifest=manifest, metrics=metrics)
+            except Exception as e:
+                record_failure(file, e)
+        return failed
+
+    #Files are queued in the scheduler until enough audio sharing the same language and task is available to fill a batch
+    scheduler = BatchScheduler(pipe, batch_size=parameters.batch_size, chunk_length_s=parameters.chunk_length_s,
+                               stride_length_s=parameters.stride_length_s, metrics=metrics)
+
+    def decode(file):
+        with measure(metrics, file, "decode"):
+            return load_audio(file, parameters.decode_ranges)
+
+    prefetcher = AudioPrefetcher(videos, decode, workers=parameters.decode_workers, max_buffered_s=parameters.max_prefetch_s)
+    for file, audio, error in prefetcher:
+        print(file)
+        if manifest is not None:
+            manifest.mark_running(file)
+        try:
+            if error is not None:
+                raise error
+            if parameters.bilingual:
+                subtitle_file_bilingual(file, pipe, plan.parameters_for(file, parameters), audio, manifest, metrics)
+                continue
+            subbing = VideoSubbing(file=file, pipe=pipe, parameters=plan.parameters_for(file, parameters), audio=audio, manifest=manifest, metrics=metrics)
+            if subbing.subs_needed():
+                for failed_subbing, e in scheduler.submit(subbing):
+                    record_failure(failed_subbing.file, e)
+            else:
+                _record_skipped(file, manifest, metrics)
+        except Exception as e:
+            record_failure(file, e)
+    for failed_subbing, e in scheduler.flush():
+        record_failure(failed_subbing.file, e)
+    return failed
+
+def subtitle_folder(path: Path, pipe, parameters: SubbingParameters = None, manifest=None):
     """Produces subtitle files for all video files in a folder"""
-    for filetype in valid_video_file_types:
-        allowed_filename = r"*"+filetype
-        for file in path.glob(allowed_filename):
-            if file.is_file():
-                print(file)
-                subtitle_file(file, pipe, parameters)
-
-def subtitle_folder_all(path: Path, pipe, parameters: SubbingParameters = None):
+    return subtitle_files(get_list_of_videos(path, include_subfolders=False), pipe, parameters, manifest)
+
+def subtitle_folder_all(path: Path, pipe, parameters: SubbingParameters = None, manifest=None):
     """Produces subtitle files for all video files in a folder, and all of it's subfolders"""
-    subtitle_folder(path, pipe, parameters)
-    folder_list = [f for f in path.glob('**/*') if f.is_dir()]
-    for folder in folder_list:
-        subtitle_folder(folder, pipe, parameters)
-
-def create_subtitles(path, input_mode, include_subfolders, parameters = None, model_id = "openai/whisper-large-v3"):
-    """Initializes model and creates subtitles for video file or all video files in folder depending on input mode. Uses subtitle_file function to create subs."""
-    device = "cuda:0"  if torch.cuda.is_available() else "cpu"
-    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-
-    model = AutoModelForSpeechSeq2Seq.from_pretrained(
-        model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
-    )
-    model.to(device)
-
-    processor = AutoProcessor.from_pretrained(model_id)
-
-    pipe = pipeline(
-        "automatic-speech-recognition",
-        model=model,
-        tokenizer=processor.tokenizer,
-        feature_extractor=processor.feature_extractor,
-        max_new_tokens=128,
-        chunk_length_s=10,
-        #stride_length_s=2,
-        batch_size=1,
-        return_timestamps=True,
-        torch_dtype=torch_dtype,
-        device=device,
-    )
+    return subtitle_files(get_list_of_videos(path, include_subfolders=True), pipe, parameters, manifest)
 
+def subtitle_videos(files, model_id, parameters: SubbingParameters = None, device = None, torch_dtype = None, manifest = None, metrics = None):
+    """Initializes model and produces subtitle files for a list of video files. With parameters.processes > 1 on cpu,
+        the files are shared out between that many worker processes. Returns the list of files that failed."""
+    if parameters is None:
+        parameters = SubbingParameters()
+    parameters = assisted_parameters(parameters)
+    if parameters.processes > 1:
+        if device is None:
+            device = default_device()[0]
+        if str(device) == "cpu":
+            from workers import subtitle_files_multiprocess
+            return subtitle_files_multiprocess(files, model_id, parameters, parameters.processes,
+                        parameters.threads_per_process, torch_dtype, manifest, metrics)
+        logging.warning("Worker processes are only used on cpu, running in a single process on %s", device)
+
+    pipe = get_pipeline(model_id, device, torch_dtype, parameters.cpu_backend, parameters.compile_model)
+    return subtitle_files(files, pipe, parameters, manifest, metrics)
+
+def create_subtitles(path, input_mode, include_subfolders, parameters = None, model_id = "openai/whisper-large-v3", device = None, torch_dtype = None, manifest = None):
+    """Initializes model and creates subtitles for video file or all video files in folder depending on input mode. Uses subtitle_videos function to create subs.
+        Returns the list of files that failed."""
     if input_mode == 'file':
-        subtitle_file(path, pipe, parameters)
-    elif input_mode == 'folder' and not include_subfolders:
-        subtitle_folder(path, pipe, parameters)
+        files = [path]
     elif input_mode == 'folder':
-        subtitle_folder_all(path, pipe, parameters)
\ No newline at end of file
+        files = get_list_of_videos(path, include_subfolders)
+    else:
+        raise RuntimeError("Invalid input mode")
+    return subtitle_videos(files, model_id, parameters, device, torch_dtype, manifest)
@@ -0,0 +1,109 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+class TranscriptionCache:
+    """
+    On-disk cache of transcriptions, keyed by a hash of the decoded audio together with the settings that affect
+    the output. Each entry is stored as a json file, and once the cache grows beyond max_bytes the least recently
+    used entries are removed until it is back under evict_to of max_bytes. The size of the cache is kept as a running
+    total, shared by every instance for the same directory in the process, so the cache is only listed once to start
+    the total and again when it needs evicting. Entries written by other processes are only counted at that point.
+    """
+    _lock = threading.Lock()
+    #Running size of each cache directory in bytes
+    _totals = {}
+
+    def __init__(self, directory, max_bytes=2*1024**3, evict_to=0.9):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to
+
+    @staticmethod
+    def make_key(audio_input, **settings):
+        """Returns the cache key for audio_input, which is either decoded audio or a path to an audio file, and the given settings."""
+        digest = hashlib.sha256()
+        if isinstance(audio_input, str):
+            with open(audio_input, "rb") as f:
+                for block in iter(lambda: f.read(1024*1024), b""):
+                    digest.update(block)
+        else:
+            digest.update(audio_input.tobytes())
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        """Returns the cached entry for key, or None if there isn't one."""
+        entry_path = self._entry_path(key)
+        try:
+            with entry_path.open(mode="r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        #Mark the entry as recently used
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        #json has no tuples, but the pipeline returns timestamps as tuples
+        for chunk in entry.get("chunks", []):
+            chunk["timestamp"] = tuple(chunk["timestamp"])
+        return entry
+
+    def put(self, key, entry):
+        """Stores entry, a json serializable dict, under key and evicts old entries if the cache is now too large."""
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = entry_path.with_name(f"{entry_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with temp_path.open(mode="w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        size = temp_path.stat().st_size
+        try:
+            replaced_size = entry_path.stat().st_size
+        except OSError:
+            replaced_size = 0
+        os.replace(temp_path, entry_path)
+        if self._grow(size - replaced_size) > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        """Lists the cache, returning (mtime, size, path) for every entry."""
+        entries = []
+        for entry_path in self.directory.glob("*/*.json"):
+            try:
+                stat = entry_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def _grow(self, change):
+        """Adds change bytes to the running size of the cache, listing the cache to start it the first time, and returns it."""
+        directory = str(self.directory.resolve())
+        with self._lock:
+            if directory in self._totals:
+                self._totals[directory] += change
+            else:
+                self._totals[directory] = sum(size for _, size, _ in self._entries())
+            return self._totals[directory]
+
+    def evict(self):
+        """Removes least recently used entries until the cache is no larger than evict_to of max_bytes."""
+        directory = str(self.directory.resolve())
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry_path in sorted(entries):
+                if total <= self.max_bytes*self.evict_to:
+                    break
+                try:
+                    entry_path.unlink()
+                    total -= size
+                except OSError:
+                    pass
+            self._totals[directory] = total
@@ -2,13 +2,17 @@ from pathlib import Path
 from statistics import mode
 import datetime
 import math
+import os
+import socket
 
-from constants import valid_video_file_types
+from media_scan import scan_videos
 
-def determine_lang(audio_input, file, pipe, replace_lang=False, preserve_intermediary_files=False):
+def determine_lang(audio_input, file, pipe, replace_lang=False, preserve_intermediary_files=False, method="encoder", num_windows=8, confidence=0.9):
     """Used to determine what language to use, in the case that only a single language is expected in the audio.
-        Divides audio up into 30 second chunks and runs through whisper pipeline "pipe",  then returns the most common 
-        language appearing in the output. A text file with all the detected languages, as well as the most common
+        With method="encoder" and audio decoded in memory, up to num_windows 30 second windows are sampled and only the
+        language token is predicted for each, stopping early once confidence is reached. With method="full" the audio is
+        divided up into 30 second chunks and run through whisper pipeline "pipe". Either way the most common
+        language is returned. A text file with all the detected languages, as well as the most common
         detected can be saved with "preserve_intermediary_files"=True. This file will also be checked for before
         doing any processing, and it's result used instead if it is found."""
     if audio_input is str(None):
@@ -18,11 +22,27 @@ def determine_lang(audio_input, file, pipe, replace_lang=False, preserve_interme
         with filelang.open(mode="r", encoding="utf-8") as f:
             first_line = f.readline()
             lang = first_line.split(":")[-1].strip()
+    elif method == "encoder" and not isinstance(audio_input, str):
+        lang = determine_lang_encoder(audio_input, filelang, pipe, preserve_intermediary_files, num_windows, confidence)
     else:
         lang = determine_lang_whisper(audio_input, filelang, pipe, preserve_intermediary_files)
 
     return lang
 
+def determine_lang_encoder(audio_input, filelang, pipe, preserve_intermediary_files=False, num_windows=8, confidence=0.9):
+    #Imported here so that utils stays importable without torch
+    from language_detection import detect_language
+
+    lang, window_langs = detect_language(audio_input, pipe, num_windows=num_windows, confidence=confidence)
+
+    #Save text file with details of language detection, if requested
+    if preserve_intermediary_files:
+        with filelang.open(mode="w+", encoding="utf-8") as f:
+            f.write(f"Language: {lang}\n\n")
+            for start, langi in window_langs:
+                f.write(f'{str(datetime.timedelta(seconds=math.floor(start)))}  {langi}\n')
+    return lang
+
 def determine_lang_whisper(audio_input, filelang, pipe, preserve_intermediary_files=False):
     if audio_input is str(None):
         return None
@@ -42,24 +62,73 @@ def determine_lang_whisper(audio_input, filelang, pipe, preserve_intermediary_fi
                     f.write(f'{str(datetime.timedelta(seconds=math.floor(result["chunks"][i]["timestamp"][0])))}  {langi}\n')
     return lang
 
+class SubtitleWriter:
+    """
+    Writes subtitles to an .srt file incrementally, so they can be streamed out as they are produced.
+    Everything is written to a temporary file, which only replaces "filesub" once close() is called, so an
+    interrupted run never leaves a truncated .srt behind. Can be used as a context manager, in which case the
+    temporary file is discarded if an exception is raised.
+    """
+    def __init__(self, filesub):
+        self.filesub = filesub
+        #The host name keeps the temporary files of processes on different hosts sharing a folder apart
+        self.tempsub = filesub.with_name(f"{filesub.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+        self.count = 0
+        self._file = self.tempsub.open(mode='w', encoding="utf-8")
+
+    def write(self, subs):
+        """Appends subs, which are of the form pipe(...)["chunks"], to the subtitle file."""
+        text, self.count = format_subs(subs, self.count)
+        self._file.write(text)
+        self._file.flush()
+
+    def close(self):
+        """Finishes the subtitle file, moving it into place."""
+        self._file.close()
+        os.replace(self.tempsub, self.filesub)
+
+    def discard(self):
+        """Abandons the subtitle file, leaving any existing "filesub" untouched."""
+        self._file.close()
+        if self.tempsub.exists():
+            self.tempsub.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+def format_subs(subs, count=0):
+    """Formats subs, which are of the form pipe(...)["chunks"], as .srt text, numbering them on from count.
+        Returns the text together with the last number used."""
+    text = []
+    for subsi in subs:
+        count += 1
+        sub = []
+        sub.append(count)
+        if subsi["timestamp"][0] is None:
+            continue
+        else:
+            sub.append(str(datetime.timedelta(seconds=math.floor(subsi["timestamp"][0]))))
+        if subsi["timestamp"][1] is None:
+            sub.append(str(datetime.timedelta(seconds=math.floor(subsi["timestamp"][0]+10))))
+        else:
+            sub.append(str(datetime.timedelta(seconds=math.floor(subsi["timestamp"][1]))))
+        sub.append(subsi["text"])
+
+        text.append(f'{sub[0]}\n0{sub[1]},000  -->  0{sub[2]},000\n{sub[3]}\n\n')
+    return "".join(text), count
+
 def write_subs(filesub, subs):
     """Taking the output "subs" from VideoSubbing.create_subs(), which is of the form pipe(...)["chunks"],
-        formats the timestamps and text into the .srt format and saves it to the file "filesub" """
-    with filesub.open(mode='w', encoding="utf-8") as f:
-        for i, subsi in enumerate(subs):
-            sub = []
-            sub.append(i+1)
-            if subs[i]["timestamp"][0] is None:
-                continue
-            else:
-                sub.append(str(datetime.timedelta(seconds=math.floor(subsi["timestamp"][0]))))
-            if subs[i]["timestamp"][1] is None:
-                sub.append(str(datetime.timedelta(seconds=math.floor(subsi["timestamp"][0]+10))))
-            else:
-                sub.append(str(datetime.timedelta(seconds=math.floor(subsi["timestamp"][1]))))
-            sub.append(subsi["text"])
-
-            f.write(f'{sub[0]}\n0{sub[1]},000  -->  0{sub[2]},000\n{sub[3]}\n\n')
+        formats the timestamps and text into the .srt format and saves it to the file "filesub".
+        The file is written to a temporary file first and then renamed, so an interrupted run never leaves a truncated .srt behind."""
+    with SubtitleWriter(filesub) as writer:
+        writer.write(subs)
 
 def find_model(model_name):
     if model_name == "CripserWhisper":
@@ -70,18 +139,6 @@ def find_model(model_name):
         return "openai/whisper-large-v3-turbo"
     return model_name
 
-def get_list_of_videos(path: Path, include_subfolders):
-    list_of_videos = []
-    append_videos_from_folder(path, list_of_videos)
-    if include_subfolders:
-        folder_list = [f for f in path.glob('**/*') if f.is_dir()]
-        for folder in folder_list:
-            append_videos_from_folder(folder, list_of_videos)
-    return list_of_videos
-
-def append_videos_from_folder(path: Path, list_of_videos: list):
-    for filetype in valid_video_file_types:
-        allowed_filename = r"*"+filetype
-        for file in path.glob(allowed_filename):
-            if file.is_file():
-                list_of_videos.append(file)
+def get_list_of_videos(path: Path, include_subfolders, index_path=None):
+    """Returns all video files in path, and all of it's subfolders if include_subfolders. See media_scan.scan_videos for index_path."""
+    return [video.path for video in scan_videos(path, include_subfolders, index_path)]
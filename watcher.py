@@ -0,0 +1,246 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from media_scan import scan_videos
+from planning import subtitle_suffix
+from constants import valid_video_file_types
+
+try:
+    #Optional, only used on Linux when installed. Without it folders are polled instead.
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+class FolderWatcher:
+    """
+    Watches folders for new video files without subtitles, and reports each one once it has stopped growing.
+    Changes are picked up with inotify when the optional inotify_simple package is available, and by polling every
+    poll_interval seconds otherwise. Polling rescans reuse an in-memory scan index, so unchanged folders aren't listed again.
+    A file is ready once its size and mtime have stayed the same for settle_s seconds. A video has subtitles once
+    video_name + subtitle_suffix exists, see planning.subtitle_suffix.
+    """
+    def __init__(self, paths, include_subfolders=True, poll_interval=30, settle_s=30, subtitle_suffix=".srt"):
+        self.paths = [Path(path) for path in paths]
+        self.subtitle_suffix = subtitle_suffix
+        self.include_subfolders = include_subfolders
+        self.poll_interval = poll_interval
+        self.settle_s = settle_s
+        self._index = {}
+        #Candidates waiting to settle: path -> (size, mtime_ns, time the size and mtime were first seen)
+        self._candidates = {}
+        #Files already reported, with the size and mtime they had, so they are only reported again if they change
+        self._reported = {}
+        self._inotify = None
+        self._watch_dirs = {}
+        self._rescan_requested = threading.Event()
+        if inotify_simple is not None:
+            self._inotify = inotify_simple.INotify()
+            for path in self.paths:
+                self._add_watches(path)
+
+    def _add_watches(self, directory):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.MODIFY
+        directories = [directory]
+        if self.include_subfolders:
+            directories += [Path(root) for root, _, _ in os.walk(directory)][1:]
+        for path in directories:
+            try:
+                self._watch_dirs[self._inotify.add_watch(str(path), mask)] = path
+            except OSError as e:
+                logging.warning("Could not watch %s: %s", path, e)
+
+    def request_rescan(self):
+        """Asks for a full rescan of the watched folders at the next poll."""
+        self._rescan_requested.set()
+
+    def _scan(self):
+        for path in self.paths:
+            for video in scan_videos(path, self.include_subfolders, index=self._index, subtitle_suffix=self.subtitle_suffix):
+                if not video.has_srt:
+                    self._consider(video.path)
+
+    def _needs_subtitles(self, path):
+        """The test _scan applies, for a single path: a video file without subtitles. Anything else, such as the
+            subtitle, temporary and manifest files written while processing, is ignored."""
+        return path.suffix.lower() in valid_video_file_types and not path.with_suffix(self.subtitle_suffix).exists()
+
+    def _consider(self, path):
+        if path not in self._candidates:
+            self._candidates[path] = None
+
+    def _read_events(self, timeout_s):
+        flags = inotify_simple.flags
+        for event in self._inotify.read(timeout=int(timeout_s*1000)):
+            directory = self._watch_dirs.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = directory / event.name
+            if event.mask & flags.ISDIR:
+                if self.include_subfolders and event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self._add_watches(path)
+                    for video in scan_videos(path, True, index=self._index, subtitle_suffix=self.subtitle_suffix):
+                        if not video.has_srt:
+                            self._consider(video.path)
+            elif self._needs_subtitles(path):
+                self._consider(path)
+
+    def _settled(self):
+        """Returns the candidates whose size and mtime haven't changed for settle_s seconds, removing them from the candidates."""
+        now = time.monotonic()
+        ready = []
+        for path, seen in list(self._candidates.items()):
+            try:
+                stat = path.stat()
+            except OSError:
+                del self._candidates[path]
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self._reported.get(path) == state:
+                del self._candidates[path]
+            elif seen is None or seen[:2] != state:
+                self._candidates[path] = (*state, now)
+            elif now - seen[2] >= self.settle_s:
+                del self._candidates[path]
+                self._reported[path] = state
+                ready.append(path)
+        return ready
+
+    def watch(self, stop_event):
+        """Yields each new video file once it is ready, until stop_event is set."""
+        self._scan()
+        last_scan = time.monotonic()
+        while not stop_event.is_set():
+            #Candidates need checking at least every second while they settle
+            wait_s = 1 if self._candidates else self.poll_interval
+            if self._inotify is not None:
+                self._read_events(wait_s)
+            else:
+                self._rescan_requested.wait(wait_s)
+            if self._rescan_requested.is_set() or (self._inotify is None and time.monotonic() - last_scan >= self.poll_interval):
+                self._rescan_requested.clear()
+                self._scan()
+                last_scan = time.monotonic()
+            for path in self._settled():
+                yield path
+
+class WatchService:
+    """
+    Long running service that subtitles new files in watched folders as they arrive, using one resident pipeline.
+    Ready files are queued and processed by concurrency worker threads. A small control interface on
+    http://127.0.0.1:control_port reports status at GET /status, and accepts POST /pause, /resume, /rescan and /stop.
+    """
+    def __init__(self, paths, pipe, parameters, include_subfolders=True, concurrency=1, poll_interval=30, settle_s=30, manifest=None, metrics=None):
+        self.watcher = FolderWatcher(paths, include_subfolders, poll_interval, settle_s, subtitle_suffix(parameters))
+        self.pipe = pipe
+        self.parameters = parameters
+        self.concurrency = max(1, concurrency)
+        self.manifest = manifest
+        self.metrics = metrics
+        self.queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.running = threading.Event()
+        self.running.set()
+        self._lock = threading.Lock()
+        self._processing = set()
+        self._done = 0
+        self._failed = []
+        self._server = None
+
+    def status(self):
+        with self._lock:
+            return {
+                "paused": not self.running.is_set(),
+                "queued": self.queue.qsize(),
+                "processing": sorted(str(path) for path in self._processing),
+                "done": self._done,
+                "failed": [str(path) for path in self._failed[-100:]],
+                "watching": [str(path) for path in self.watcher.paths],
+                "inotify": self.watcher._inotify is not None,
+            }
+
+    def _work(self):
+        from subtitling import subtitle_files
+
+        while not self.stop_event.is_set():
+            try:
+                path = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            #Paused workers hold on to their file until resumed or stopped
+            while not self.running.wait(1):
+                if self.stop_event.is_set():
+                    return
+            with self._lock:
+                self._processing.add(path)
+            try:
+                failed = subtitle_files([path], self.pipe, self.parameters, self.manifest, self.metrics)
+            except Exception as e:
+                logging.error('Error at %s', path, exc_info=e)
+                failed = [path]
+            with self._lock:
+                self._processing.discard(path)
+                if failed:
+                    self._failed.append(path)
+                else:
+                    self._done += 1
+
+    def serve_control(self, port, host="127.0.0.1"):
+        """Starts the control interface on a background thread."""
+        service = self
+
+        class ControlHandler(BaseHTTPRequestHandler):
+            def _reply(self, code, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/status":
+                    self._reply(200, service.status())
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                actions = {"/pause": service.running.clear, "/resume": service.running.set,
+                           "/rescan": service.watcher.request_rescan, "/stop": service.stop_event.set}
+                if self.path not in actions:
+                    self._reply(404, {"error": "not found"})
+                    return
+                actions[self.path]()
+                self._reply(200, service.status())
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), ControlHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def run(self):
+        """Watches and processes files until stop() is called or /stop is requested."""
+        workers = [threading.Thread(target=self._work, daemon=True) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        try:
+            for path in self.watcher.watch(self.stop_event):
+                logging.info("Queued %s", path)
+                self.queue.put(path)
+        finally:
+            self.stop_event.set()
+            for worker in workers:
+                worker.join()
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,131 @@
+import dataclasses
+import logging
+import os
+import time
+import traceback
+
+from models import get_pipeline, wrap_pipeline
+from cpu_backends import compile_model
+
+#State of a worker process, set up once by _init_worker
+_worker_pipe = None
+_worker_parameters = None
+_worker_manifest = None
+_worker_metrics = None
+
+def core_slices(processes, cores=None):
+    """Splits the cores this process may run on into processes contiguous, roughly equal slices."""
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    processes = max(1, min(processes, len(cores)))
+    size, extra = divmod(len(cores), processes)
+    slices = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+def _init_worker(model, model_id, torch_dtype, parameters, slices, threads_per_process, counter, manifest_path=None, collect_metrics=False):
+    """Runs once in each worker process: pins it to its slice of cores, sets its torch thread budget, wraps the
+        shared model in a pipeline of its own, opens its own connection to the job manifest if there is one and
+        records metrics of its own if collect_metrics, which are sent back with each result."""
+    global _worker_pipe, _worker_parameters, _worker_manifest, _worker_metrics
+    import torch
+    from manifest import JobManifest
+    from metrics import RunMetrics
+
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    cores = slices[index % len(slices)]
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads_per_process or len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        #Can only be set before any inter-op parallel work has started
+        pass
+
+    if parameters.compile_model:
+        model = compile_model(model)
+    _worker_pipe = wrap_pipeline(model, model_id, "cpu", torch_dtype)
+    _worker_parameters = parameters
+    if manifest_path is not None:
+        _worker_manifest = JobManifest(manifest_path)
+    if collect_metrics:
+        _worker_metrics = RunMetrics()
+
+def _subtitle_in_worker(item):
+    """Subtitles a single file in a worker process, item being (file, replace), as subtitle_files would: in segments if it
+        is long enough, and decoded whole otherwise. Returns (file, started, error, records), where error is None on
+        success and records are the metrics of the files finished, if metrics are collected."""
+    from subtitling import subtitle_file, subtitle_file_segmented, needs_segments
+
+    file, replace = item
+    started = time.time()
+    parameters = dataclasses.replace(_worker_parameters, replace=replace)
+    #Recorded here rather than when the result comes back, so that a file being worked on when the run stops shows as running
+    if _worker_manifest is not None:
+        _worker_manifest.mark_running(file, started)
+    error = None
+    try:
+        if needs_segments(file, parameters):
+            subtitle_file_segmented(file, _worker_pipe, parameters, metrics=_worker_metrics)
+        else:
+            subtitle_file(file, _worker_pipe, parameters, metrics=_worker_metrics)
+    except Exception as e:
+        error = f"{e!r}\n{traceback.format_exc()}"
+        if _worker_metrics is not None:
+            _worker_metrics.finish_file(file, status="failed")
+    return file, started, error, _worker_metrics.take_finished() if _worker_metrics is not None else []
+
+def subtitle_files_multiprocess(files, model_id, parameters, processes, threads_per_process=0, torch_dtype=None, manifest=None, metrics=None):
+    """Produces subtitle files for a list of video files on processes CPU worker processes, each pinned to its own slice of
+        cores with its own torch thread budget. Files are handed out from a shared queue as workers become free.
+        The model is loaded once in this process and its weights placed in shared memory, so that every worker uses the
+        same copy rather than loading its own. The metrics of each file are recorded in its worker and added to metrics
+        as it finishes. Returns the list of files that failed."""
+    import torch.multiprocessing as torch_mp
+    from planning import plan_files, subtitle_path
+
+    plan = plan_files(files, parameters, manifest)
+    print(plan.report())
+    for file in plan.skip:
+        if manifest is not None and manifest.state(file) == "pending" and subtitle_path(file, parameters).exists():
+            manifest.mark_done(file, subtitle_path(file, parameters))
+        if metrics is not None:
+            metrics.finish_file(file, status="skipped")
+    videos = plan.files()
+    if not videos:
+        return []
+
+    pipe = get_pipeline(model_id, "cpu", torch_dtype, parameters.cpu_backend)
+    model = pipe.model
+    model.share_memory()
+
+    slices = core_slices(processes)
+    #Spawn rather than fork, since forking a process that has already used OpenMP can deadlock the workers
+    context = torch_mp.get_context("spawn")
+    counter = context.Value("i", 0)
+
+    failed = []
+    with context.Pool(len(slices), initializer=_init_worker,
+                      initargs=(model, model_id, model.dtype, parameters, slices, threads_per_process, counter,
+                                manifest.path if manifest is not None else None, metrics is not None)) as pool:
+        items = [(file, plan.parameters_for(file, parameters).replace) for file in videos]
+        for file, started, error, records in pool.imap_unordered(_subtitle_in_worker, items):
+            print(file)
+            if metrics is not None:
+                metrics.add_finished(records)
+            if error is None:
+                if manifest is not None and subtitle_path(file, parameters).exists():
+                    manifest.mark_done(file, subtitle_path(file, parameters))
+            else:
+                logging.error('Error at %s: %s', file, error)
+                if manifest is not None:
+                    manifest.mark_failed(file, error)
+                failed.append(file)
+    return failed